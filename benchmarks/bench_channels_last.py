@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks.bench_channels_last
+
+compare the throughput (synthesized voxels per second) of a randomly
+initialized unet in the default (contiguous) and the channels-last
+memory format for 2d (slice-by-slice) and 3d (patch-based) prediction,
+and for a training step, e.g.:
+
+    python benchmarks/bench_channels_last.py --threads 8 --size 128
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+from synthnn import channels_last_format, Predictor, to_channels_last, Unet
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='benchmark the channels-last memory format')
+    parser.add_argument('--size', type=int, default=96, help='image size (cubed) [Default=96]')
+    parser.add_argument('--patch-size', type=int, default=64, help='patch size (cubed) for 3d prediction [Default=64]')
+    parser.add_argument('--batch-size', type=int, default=8, help='batch size for 2d prediction and training [Default=8]')
+    parser.add_argument('-nl', '--n-layers', type=int, default=3, help='number of layers in the unet [Default=3]')
+    parser.add_argument('-cbp', '--channel-base-power', type=int, default=4, help='channel base power [Default=4]')
+    parser.add_argument('-nm', '--normalization', type=str, default='instance', choices=('instance', 'batch', 'none'),
+                        help='normalization layer in the unet [Default=instance]')
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed runs (the best is reported) [Default=3]')
+    parser.add_argument('--threads', type=int, default=None, help='number of intra-op threads [Default=pytorch default]')
+    parser.add_argument('--no-train', action='store_true', default=False, help='skip the training benchmark')
+    return parser
+
+
+def best_time(fn, repeats):
+    fn()  # warm up (e.g., oneDNN primitive creation)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_predict(args, is_3d, channels_last):
+    torch.manual_seed(0)
+    model = Unet(args.n_layers, channel_base_power=args.channel_base_power, normalization=args.normalization,
+                 is_3d=is_3d, enable_dropout=False).eval()
+    predictor = Predictor(model, patch_size=args.patch_size if is_3d else 0, batch_size=1 if is_3d else args.batch_size,
+                          channels_last=channels_last, device=torch.device('cpu'))
+    img = np.random.randn(args.size, args.size, args.size).astype(np.float32)
+    return img.size / best_time(lambda: predictor.predict(img), args.repeats)
+
+
+def bench_train(args, is_3d, channels_last):
+    torch.manual_seed(0)
+    model = Unet(args.n_layers, channel_base_power=args.channel_base_power, normalization=args.normalization, is_3d=is_3d)
+    size = (args.patch_size,) * 3 if is_3d else (args.size,) * 2
+    bs = 1 if is_3d else args.batch_size
+    src, tgt = torch.randn((bs, 1) + size), torch.randn((bs, 1) + size)
+    if channels_last:
+        to_channels_last(model)
+        src = src.contiguous(memory_format=channels_last_format(is_3d))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    def step():
+        loss = model.criterion(model(src), tgt)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return src.numel() / best_time(step, args.repeats)
+
+
+def main(args=None):
+    args = arg_parser().parse_args(args)
+    if args.threads is not None: torch.set_num_threads(args.threads)
+    print(f'torch {torch.__version__}, {torch.get_num_threads()} thread(s), image size {args.size}, '
+          f'patch size {args.patch_size}, {args.normalization} norm')
+    benches = [('predict', bench_predict)] + ([] if args.no_train else [('train', bench_train)])
+    for name, bench in benches:
+        for is_3d in (False, True):
+            contiguous = bench(copy.copy(args), is_3d, False)
+            channels_last = bench(copy.copy(args), is_3d, True)
+            print(f'{name} {"3d" if is_3d else "2d"}: contiguous {contiguous / 1e6:8.3f} Mvox/s, '
+                  f'channels-last {channels_last / 1e6:8.3f} Mvox/s ({channels_last / contiguous:.2f}x)')
+
+
+if __name__ == "__main__":
+    main()
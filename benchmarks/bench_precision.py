@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks.bench_precision
+
+compare the training throughput (voxels per second) of a randomly
+initialized unet with automatic mixed precision in float32, bfloat16,
+and (on the gpu) float16, as with nn-train --precision, e.g.:
+
+    python benchmarks/bench_precision.py --threads 8 --size 128
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+import argparse
+import time
+
+import torch
+
+from synthnn import Unet
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='benchmark mixed precision training')
+    parser.add_argument('--size', type=int, default=128, help='slice size (squared) for 2d training [Default=128]')
+    parser.add_argument('--patch-size', type=int, default=64, help='patch size (cubed) for 3d training [Default=64]')
+    parser.add_argument('--batch-size', type=int, default=8, help='batch size for 2d training [Default=8]')
+    parser.add_argument('-nl', '--n-layers', type=int, default=3, help='number of layers in the unet [Default=3]')
+    parser.add_argument('-cbp', '--channel-base-power', type=int, default=4, help='channel base power [Default=4]')
+    parser.add_argument('-nm', '--normalization', type=str, default='instance', choices=('instance', 'batch', 'none'),
+                        help='normalization layer in the unet [Default=instance]')
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed steps (the best is reported) [Default=3]')
+    parser.add_argument('--threads', type=int, default=None, help='number of intra-op threads [Default=pytorch default]')
+    parser.add_argument('--cuda', action='store_true', default=False, help='benchmark on the gpu (adds fp16)')
+    return parser
+
+
+def bench_train(args, is_3d, precision, device):
+    torch.manual_seed(0)
+    model = Unet(args.n_layers, channel_base_power=args.channel_base_power, normalization=args.normalization,
+                 is_3d=is_3d).to(device)
+    size = (args.patch_size,) * 3 if is_3d else (args.size,) * 2
+    bs = 1 if is_3d else args.batch_size
+    src, tgt = torch.randn((bs, 1) + size, device=device), torch.randn((bs, 1) + size, device=device)
+    dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(precision)
+    scaler = torch.amp.GradScaler(device.type, enabled=precision == 'fp16')
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    def step():
+        with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+            out = model(src)
+        loss = model.criterion(tgt, out.float())
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        if device.type == 'cuda': torch.cuda.synchronize(device)
+        return loss.item()
+    step()  # warm up (e.g., oneDNN primitive creation)
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        loss = step()
+        times.append(time.perf_counter() - start)
+    return src.numel() / min(times), loss
+
+
+def main(args=None):
+    args = arg_parser().parse_args(args)
+    if args.threads is not None: torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    precisions = ('fp32', 'bf16', 'fp16') if args.cuda else ('fp32', 'bf16')
+    print(f'torch {torch.__version__}, {device}, {torch.get_num_threads()} thread(s), size {args.size}, '
+          f'patch size {args.patch_size}, {args.normalization} norm')
+    for is_3d in (False, True):
+        fp32 = None
+        for precision in precisions:
+            vps, loss = bench_train(args, is_3d, precision, device)
+            fp32 = fp32 or vps
+            print(f'train {"3d" if is_3d else "2d"} {precision}: {vps / 1e6:8.3f} Mvox/s ({vps / fp32:.2f}x), '
+                  f'loss {loss:.3e}')
+
+
+if __name__ == "__main__":
+    main()
@@ -35,7 +35,10 @@ args = dict(
     keywords="mr image-synthesis",
     entry_points={
         'console_scripts': ['nn-train=synthnn.exec.nn_train:main',
-                            'nn-predict=synthnn.exec.nn_predict:main']
+                            'nn-predict=synthnn.exec.nn_predict:main',
+                            'nn-serve=synthnn.exec.nn_serve:main',
+                            'nn-export=synthnn.exec.nn_export:main',
+                            'nn-cache=synthnn.exec.nn_cache:main']
     },
     dependency_links=[f'git+git://github.com/jcreinhold/niftidataset.git@master#egg=niftidataset-{version}']
 )
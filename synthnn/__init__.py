@@ -2,3 +2,4 @@ from .errors import *
 from .util import *
 from .models import *
 from .plot import *
+from .inference import *
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.exec.nn_cache
+
+command line interface to convert directories of source and target
+NIfTI or TIFF images into a chunked, uncompressed dataset store (see
+synthnn.util.store), which nn_train can train from (see --store)
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+import argparse
+import logging
+import sys
+import warnings
+
+with warnings.catch_warnings():
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    warnings.filterwarnings('ignore', category=UserWarning)
+    from synthnn.util.exec import setup_log
+    from synthnn import build_store
+
+
+######## Helper functions ########
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='build a chunked dataset store for training a CNN for MR image synthesis')
+
+    required = parser.add_argument_group('Required')
+    required.add_argument('-s', '--source-dir', type=str, required=True, nargs='+',
+                          help='path to directory with source images (multiple paths can be provided for multi-modal synthesis)')
+    required.add_argument('-t', '--target-dir', type=str, required=True, nargs='+',
+                          help='path to directory with target images (multiple paths can be provided for multi-modal synthesis)')
+    required.add_argument('-o', '--store', type=str, required=True,
+                          help='path to the store directory (subjects which are new or changed are added to an existing store)')
+
+    options = parser.add_argument_group('Options')
+    options.add_argument('-cs', '--chunk-size', type=int, default=32,
+                         help='number of voxels per side of the (cubic) chunks [Default=32]')
+    options.add_argument('--dtype', type=str, default='float32', choices=('float32', 'float16'),
+                         help='dtype of the stored images (float16 halves the size) [Default=float32]')
+    options.add_argument('--tiff', action='store_true', default=False, help='dataset are tiff images [Default=False]')
+    options.add_argument('-v', '--verbosity', action="count", default=0,
+                         help="increase output verbosity (e.g., -vv is more than -v)")
+    return parser
+
+
+######### Main routine ###########
+
+def main(args=None):
+    args = arg_parser().parse_args(args)
+    setup_log(args.verbosity)
+    logger = logging.getLogger(__name__)
+    try:
+        n_added, n_skipped = build_store(args.store, args.source_dir, args.target_dir, args.chunk_size,
+                                         args.dtype, args.tiff)
+        logger.info(f'Added {n_added} subjects to {args.store} ({n_skipped} already stored)')
+        return 0
+    except Exception as e:
+        logger.exception(e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.exec.nn_export
+
+command line interface to export a trained pytorch NN (see nn_train)
+to TorchScript and/or ONNX, so that nn_predict can run the exported
+network with the torchscript or onnxruntime backend
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+import argparse
+import logging
+import os
+import sys
+import warnings
+
+with warnings.catch_warnings():
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    warnings.filterwarnings('ignore', category=UserWarning)
+    import numpy as np
+    import torch
+    from synthnn.util.exec import AttrDict, get_device, load_config, load_model, setup_log
+    from synthnn import example_input, export_onnx, export_torchscript, load_backend, SynthNNError
+
+
+######## Helper functions ########
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='export a trained CNN for MR image synthesis to TorchScript/ONNX')
+
+    required = parser.add_argument_group('Required')
+    required.add_argument('config', type=str, help='config file created by nn-train (see -ocf)')
+
+    options = parser.add_argument_group('Options')
+    options.add_argument('-f', '--format', type=str, nargs='+', default=['torchscript'],
+                         choices=('torchscript', 'onnx'), help='format(s) to export to [Default=torchscript]')
+    options.add_argument('-m', '--method', type=str, default='trace', choices=('trace', 'script'),
+                         help='create the TorchScript network by tracing or compiling (scripting) it [Default=trace]')
+    options.add_argument('-o', '--output', type=str, default=None,
+                         help='path (without extension) of the exported network(s), the extension .ts (TorchScript) '
+                              'or .onnx (ONNX) is added [Default=trained model path]')
+    options.add_argument('--opset', type=int, default=17, help='ONNX opset version [Default=17]')
+    options.add_argument('-v', '--verbosity', action="count", default=0,
+                         help="increase output verbosity (e.g., -vv is more than -v)")
+    return parser
+
+
+######### Main routine ###########
+
+def main(args=None):
+    args = arg_parser().parse_args(args)
+    setup_log(args.verbosity)
+    logger = logging.getLogger(__name__)
+    try:
+        config = load_config(args.config)
+        config.disable_cuda = True  # export on the cpu, the exported network can be loaded on any device
+        if config.temperature_map and config.ord_params is None:
+            raise SynthNNError('temperature_map is only a valid option when using ordinal regression')
+        device, _, _ = get_device(config, logger)
+        model = load_model(config, device)  # dropout is disabled, so the exported network is deterministic
+        base = args.output or os.path.splitext(config.trained_model)[0]
+        example = example_input(config)
+        check = torch.randn((2,) + example.shape[1:-1] + (2 * example.shape[-1],))  # check other shapes work
+        with torch.no_grad():
+            expected = model.predict(check, config.temperature_map).numpy()
+        for fmt in args.format:
+            fn = base + ('.ts' if fmt == 'torchscript' else '.onnx')
+            if fmt == 'torchscript':
+                export_torchscript(model, example, fn, args.method, config.temperature_map)
+            else:
+                export_onnx(model, example, fn, args.opset, config.temperature_map)
+            backend = 'torchscript' if fmt == 'torchscript' else 'onnxruntime'
+            try:
+                exported = load_backend(AttrDict(config, exported_model=fn), device, backend)
+            except SynthNNError as e:  # e.g., onnxruntime is not installed, the export itself succeeded
+                logger.warning(f'Could not check the exported network: {e}')
+            else:
+                with torch.no_grad():
+                    err = np.abs(exported.predict(check).numpy() - expected).max()
+                logger.info(f'Maximum absolute difference between exported and eager network: {err:.3e}')
+            logger.info(f'Exported network ({fmt}) saved as: {fn}')
+        return 0
+    except Exception as e:
+        logger.exception(e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -12,9 +12,9 @@ Created on: Nov 2, 2018
 """
 
 import logging
-from math import floor
 import os
 import sys
+import tempfile
 import warnings
 
 with warnings.catch_warnings():
@@ -23,45 +23,265 @@ with warnings.catch_warnings():
     import nibabel as nib
     import numpy as np
     import torch
-    from synthnn.util.exec import get_args, get_device, setup_log
-    from synthnn import glob_nii, split_filename, SynthNNError
+    import torch.multiprocessing as mp
+    from synthnn.util.exec import AttrDict, get_args, get_device, load_model, setup_log
+    from synthnn import (autotune, available_memory, batch_memory, config_hash, foreground_mask, get_patch_plan, glob_nii, lazy_nii,
+                         load_backend, Manifest, NiftiWriter, optimize_for_inference, output_ext, parse_memory, plan_key,
+                         PlanCache, precision_report, Predictor, prefetch, reduce_precision, slab_memory, split_filename,
+                         SynthNNError, to_channels_last)
+
+# options which do not change the synthesized images (so they are ignored when checking if a subject is finished)
+RUNTIME_OPTIONS = ('autotune', 'autotune_cache', 'channels_last', 'compression_level', 'cpu_affinity', 'disable_cuda',
+                   'gpu_selector', 'manifest', 'max_memory', 'mc_batch_size', 'memory_budget', 'memory_map', 'multi_gpu',
+                   'n_gpus', 'queue_depth', 'resume', 'scratch_dir', 'shard', 'threads', 'verbosity', 'workers',
+                   'writer_threads')
 
 
 ######## Helper functions ########
 
-def fwd(mdl, img, temperature_map): return mdl.predict(img, temperature_map).cpu().detach().numpy()
+def load_imgs(fns, lazy=False):
+    """
+    load the images of a subject stacked in the channel dimension, or, if lazy and the images are uncompressed,
+    the memory-mapped channels, which 2d networks read slab-by-slab (so the volumes are never fully in memory)
+    """
+    img_nib = nib.load(fns[0])
+    if lazy:
+        channels = [lazy_nii(f) for f in fns]
+        if all(c is not None for c in channels): return img_nib, channels
+    img = np.stack([nib.load(f).get_data().view(np.float32) for f in fns])  # set to float32 to save memory
+    if img.ndim == 3: img = img[np.newaxis, ...]
+    return img_nib, img
 
 
-def batch2d(model, img, out_img, axis, device, bs, i, nsyn, temperature_map):
-    s = np.transpose(img[:,i:i+bs,:,:],[1,0,2,3]) if axis == 0 else \
-        np.transpose(img[:,:,i:i+bs,:],[2,0,1,3]) if axis == 1 else \
-        np.transpose(img[:,:,:,i:i+bs],[3,0,1,2])
-    img_b = torch.from_numpy(s).to(device)
-    for j in range(nsyn):
-        if axis == 0:
-            out_img[j,:,i:i+bs,:,:] = np.transpose(fwd(model, img_b, temperature_map), [1,0,2,3])
-        elif axis == 1:
-            out_img[j,:,:,i:i+bs,:] = np.transpose(fwd(model, img_b, temperature_map), [1,2,0,3])
-        else:
-            out_img[j,:,:,:,i:i+bs] = np.transpose(fwd(model, img_b, temperature_map), [1,2,3,0])
+def get_mask(k, img, shape, args):
+    """ foreground mask of the k-th subject, from the mask directory or the foreground threshold (None if neither is set) """
+    if args.mask_dir is not None:
+        mask = np.asanyarray(nib.load(glob_nii(args.mask_dir)[k]).dataobj) != 0
+        if mask.shape != tuple(shape):
+            raise SynthNNError(f'Mask shape {mask.shape} does not match the image shape {tuple(shape)} (subject {k}).')
+        return mask
+    if args.foreground_threshold is not None: return foreground_mask(img, args.foreground_threshold)
+    return None
+
+
+def out_of_core(shape, n_input, n_output, args):
+    """ synthesize an image out of core, i.e., if holding the image and the output in memory would exceed max_memory """
+    return args.max_memory is not None and 4 * int(np.prod(shape)) * (n_input + n_output) > parse_memory(args.max_memory)
+
+
+def scratch_array(shape, args):
+    """
+    float32 array in a memory-mapped file (in fortran order, as in NIfTI files, so slabs along the last axis are
+    contiguous) in the scratch directory, where the file is unlinked right away, so the disk space is freed once
+    the array is (e.g., after the output is saved)
+    """
+    scratch_dir = args.scratch_dir or os.path.dirname(os.path.abspath(args.predict_out or os.getcwd() + '/syn_'))
+    with tempfile.NamedTemporaryFile(dir=scratch_dir, prefix='.synthnn-', suffix='.dat') as f:
+        return np.memmap(f, dtype=np.float32, mode='w+', shape=tuple(shape), order='F')
+
+
+def stage_nii(fn, args, slab_size=16):
+    """ image data as a memory-mapped array, where compressed images are decompressed slab-by-slab into the scratch directory """
+    data = lazy_nii(fn)
+    if data is not None: return data
+    proxy = lazy_nii(fn, compressed=True)  # read in ascending order along the last axis, i.e., in one pass
+    data = scratch_array(proxy.shape, args)
+    for i in range(0, proxy.shape[-1], slab_size): data[..., i:i+slab_size] = proxy[..., i:i+slab_size]
+    return data
+
+
+def to_nifti(out_img, img_nib, dtype=None):
+    """ create the output image with the input image's affine and header (and optionally a new data type) """
+    out_img_nib = nib.Nifti1Image(out_img, img_nib.affine, img_nib.header)
+    if dtype is not None: out_img_nib.set_data_dtype(dtype)  # nibabel sets scl_slope/scl_inter for integer types
+    return out_img_nib
+
+
+def save_imgs(writer, out_img_nib, out_fns, logger, manifest=None, in_fns=None):
+    """ write the output images concurrently (see NiftiWriter) and record the subject once all of them are saved """
+    def finished():
+        for out_fn in out_fns: logger.info(f'Finished synthesis. Saved as: {out_fn}.')
+        if manifest is not None: manifest.record(in_fns, out_fns)
+    writer.submit(out_img_nib, out_fns, finished)
+
+
+def get_out_fns(fns, args, stats):
+    """
+    output filenames of the subject with input images fns (one for each output channel and each statistic if
+    mc_stats set), named after the first input image, so an output keeps its name (e.g., for resume) when
+    images are added to or removed from the prediction directories
+    """
+    output_dir = args.predict_out or os.getcwd() + '/syn_'
+    _, base, _ = split_filename(fns[0])
+    suffixes = [f'_{stat}' for stat in stats] if args.mc_stats else ['']
+    ext = output_ext(args.output_compression)
+    return [output_dir + f'{base}_{i}{sfx}{ext}' for sfx in suffixes for i in range(args.n_output)]
+
+
+def get_predictor(model, args, device, bs):
+    stats = args.mc_stats or (['var'] if args.calc_var else ['mean'])
+    return Predictor(model, args.net3d, args.patch_size, args.patch_stride, args.patch_weight,
+                     args.batch_size if args.net3d else bs, args.sample_axis, args.monte_carlo, args.mc_batch_size,
+                     stats, args.temperature_map, args.channels_last, args.background_value, device)
+
+
+def set_precision(model, args, device, bs, logger, report=True):
+    """ convert the network to the precision in the config and report its deviation from the full precision output """
+    if args.backend != 'eager': raise SynthNNError('Reduced precision requires the eager backend.')
+    if args.precision.endswith('int8') and device.type != 'cpu':
+        raise SynthNNError('Int8 quantization is only supported for CPU prediction (see disable_cuda).')
+    calibration_dir = args.calibration_dir or args.source_dir
+    calibration_fns = list(zip(*[glob_nii(cd) for cd in calibration_dir]))[:args.n_calibration]
+    if len(calibration_fns) == 0:
+        raise SynthNNError(f'No calibration images (NIfTI) found in: {calibration_dir} (see calibration_dir).')
+    def calibrate(m):
+        predictor = get_predictor(m, args, device, bs)
+        for fns in calibration_fns: predictor.predict(load_imgs(fns)[1])
+    reduced = reduce_precision(model, args.precision, calibrate)
+    if not report: return reduced
+    report = precision_report(get_predictor(model, args, device, bs).predict, get_predictor(reduced, args, device, bs).predict,
+                              load_imgs(calibration_fns[0])[1])
+    logger.info(f'Deviation of {args.precision} from fp32 output on {calibration_fns[0][0]}: '
+                f'max absolute {report["max_abs_dev"]:.3e}, mean absolute {report["mean_abs_dev"]:.3e}')
+    return reduced
+
+
+def predict_subjects(predictor, subjects, args, logger, manifest=None):
+    """ synthesize the images of each subject, given as (index, filenames) pairs, and save the outputs """
+    num_imgs = len(glob_nii((args.predict_dir or args.valid_source_dir)[0]))
+    stats, n_output = predictor.stats, args.n_output
+    # images are loaded (and outputs saved) in background threads when queue_depth > 0,
+    # so that the i/o for neighboring subjects overlaps with the synthesis of the current one,
+    # where the output images of a subject are written (and compressed) on writer_threads threads
+    depth = args.queue_depth
+    lazy = args.memory_map and not args.net3d
+    def load(subject):
+        k, fns = subject
+        img_nib = nib.load(fns[0])  # only the header is read
+        ooc = out_of_core(img_nib.shape, len(fns), len(stats) * n_output, args)
+        img = [stage_nii(f, args) for f in fns] if ooc else load_imgs(fns, lazy)[1]
+        return img_nib, img, get_mask(k, img, img_nib.shape, args), ooc
+    n_out = len(stats) * n_output
+    measured = {}  # memory used by the network for a batch (for out-of-core synthesis)
+    with NiftiWriter(args.output_compression, args.compression_level, args.writer_threads, max(depth, 1) * n_out) as writer:
+        for (k, fn), (img_nib, img, mask, ooc) in zip(subjects, prefetch(load, subjects, depth)):
+            _, base, _ = split_filename(fn[0])
+            logger.info(f'Starting synthesis of image: {base}. ({k+1}/{num_imgs})')
+            shape = tuple(img_nib.shape)
+            if ooc:  # the output is written to (and saved from) files, and 3d patches are run slab-by-slab
+                if predictor.net3d and predictor.patch_size > 0: check_slab_memory(predictor, shape, len(fn), args, measured)
+                logger.info(f'Synthesizing image of shape {shape} out of core (max_memory: {args.max_memory})')
+                out_img = predictor.predict(img, mask, [scratch_array(shape, args) for _ in range(n_out)])
+            else:
+                out_img = predictor.predict(img, mask).reshape((-1,) + shape)
+            out_fns = get_out_fns(fn, args, stats)
+            out_img_nib = [to_nifti(out, img_nib, args.output_dtype) for out in out_img]
+            save_imgs(writer, out_img_nib, out_fns, logger, manifest, fn)
+            if depth == 0: writer.wait()
+
 
+def check_slab_memory(predictor, shape, n_input, args, measured):
+    """
+    raise an error if the slabs held by out-of-core 3d synthesis (see stream_patches) and the memory used
+    by the network for a batch of patches (measured once, with a batch of zeros, and kept in measured) exceed max_memory
+    """
+    psz, bs = predictor.patch_size, predictor.batch_size
+    if 'batch' not in measured: measured['batch'] = batch_memory(predictor, (bs, n_input) + (psz,) * 3)
+    plan = get_patch_plan(shape, psz, predictor.patch_stride, predictor.patch_weight)
+    need = slab_memory(plan, n_input, len(predictor.stats) * predictor.n_output, bs) + measured['batch']
+    if need > parse_memory(args.max_memory):
+        raise SynthNNError(f'Out-of-core synthesis of an image of shape {shape} needs at least {need / (1 << 20):.0f} MB '
+                           f'(max_memory: {args.max_memory}), use a smaller patch_size or batch_size.')
 
-def save_imgs(out_img_nib, output_dir, k, logger):
-    for i, oin in enumerate(out_img_nib):
-        out_fn = output_dir + f'{k}_{i}.nii.gz'
-        oin.to_filename(out_fn)
-        logger.info(f'Finished synthesis. Saved as: {out_fn}.')
 
+def get_shard(subjects, shard):
+    """ deterministic subset of the subjects for shard "i/N" (0 <= i < N), e.g., for cluster array jobs """
+    try:
+        i, n = (int(x) for x in shard.split('/'))
+    except (AttributeError, ValueError):
+        raise SynthNNError(f'Invalid shard: {shard}. Expected a string of the form "i/N" (e.g., "0/4").')
+    if n < 1 or not 0 <= i < n:
+        raise SynthNNError(f'Invalid shard: {shard}. The shard index i must satisfy 0 <= i < N.')
+    return subjects[i::n]
+
+
+def get_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+
+def set_threads(n_threads, cpus=None):
+    """ set the intra-op thread budget (and optionally pin the process to a set of cpus) """
+    if n_threads is not None: torch.set_num_threads(n_threads)
+    if cpus is not None and hasattr(os, 'sched_setaffinity'): os.sched_setaffinity(0, cpus)
+
+
+def _worker(model, args, subjects, n_threads, cpus, manifest):
+    """ synthesize a subset of the subjects in a separate process (the model weights are in shared memory) """
+    args = AttrDict(args)
+    setup_log(args.verbosity)
+    logger = logging.getLogger(__name__)
+    set_threads(n_threads, cpus)
+    if model is None: model = load_backend(args, torch.device('cpu'))  # exported networks are loaded in each worker
+    if args.precision != 'fp32':  # quantized weights cannot be shared, so each worker converts the (shared) network
+        model = set_precision(model, args, torch.device('cpu'), args.batch_size, logger, report=False)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    predict_subjects(get_predictor(model, args, torch.device('cpu'), args.batch_size), subjects, args, logger, manifest)
+
+
+def predict_workers(model, args, subjects, logger, manifest=None):
+    """ shard the subjects across worker processes, where each worker gets its own thread budget """
+    n_workers = min(args.workers, len(subjects))
+    cpus = get_cpus()
+    n_threads = args.threads or max(len(cpus) // n_workers, 1)
+    if args.backend == 'eager':
+        model.share_memory()  # so that the weights are not copied into each worker
+    else:
+        model = None
+    ctx = mp.get_context('spawn')
+    procs = []
+    for w in range(n_workers):
+        worker_cpus = None
+        if args.cpu_affinity:
+            worker_cpus = cpus[(w * n_threads) % len(cpus):][:n_threads] or cpus
+        p = ctx.Process(target=_worker, args=(model, dict(args), subjects[w::n_workers], n_threads,
+                                                 worker_cpus, manifest))
+        p.start()
+        procs.append(p)
+    logger.info(f'Started {n_workers} workers with {n_threads} thread(s) each')
+    for p in procs: p.join()
+    failed = [w for w, p in enumerate(procs) if p.exitcode != 0]
+    if failed: raise SynthNNError(f'Prediction failed in worker(s): {failed}')
 
-def get_overlapping_3d_idxs(psz, img):
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        stride = psz // 2
-        indices = [torch.from_numpy(idxs) for idxs in np.indices(img.shape[1:])]
-        for i in range(3):  # create blocks from imgs (and indices)
-            indices = [idxs.unfold(i, psz, stride) for idxs in indices]
-        x, y, z = [idxs.contiguous().view(-1, psz, psz, psz) for idxs in indices]
-    return x, y, z
+
+def tune(model, args, device, subjects, logger):
+    """
+    set the batch size (and the patch size and stride for 3d networks) which synthesize the images of the
+    first subject's shape the fastest within the memory budget (see autotune), where tuned plans are cached
+    """
+    n_workers = min(args.workers or 1, len(subjects))
+    budget = parse_memory(args.memory_budget) if args.memory_budget is not None else int(0.8 * available_memory(device))
+    budget //= n_workers  # each worker holds its own image, output, and activations
+    set_threads(args.threads or max(len(get_cpus()) // n_workers, 1) if n_workers > 1 else args.threads)
+    shape = (len(subjects[0][1]),) + nib.load(subjects[0][1][0]).shape  # only the header is read
+    cache = PlanCache(args.autotune_cache or os.path.splitext(args.trained_model)[0] + '.autotune.json')
+    key = plan_key(args, shape, device)
+    plan = cache.get(key)
+    if plan is None:
+        logger.info(f'Autotuning for images of shape {shape} with a memory budget of {budget / (1 << 20):.0f} MB')
+        plan = autotune(lambda **kw: get_predictor(model, AttrDict(args, **kw), device, kw['batch_size']), shape, budget,
+                        patch_stride=args.patch_stride)
+        try:
+            cache.put(key, plan)
+        except OSError as e:
+            logger.warning(f'Could not save the tuned plan to {cache.fn}: {e}')
+    else:
+        logger.info(f'Using the tuned plan for images of shape {shape} from {cache.fn}')
+    logger.info(f'Tuned plan: batch size {plan.batch_size}' +
+                (f', patch size {plan.patch_size}, patch stride {plan.patch_stride}' if args.net3d else '') +
+                f' ({plan.voxels_per_sec / 1e6:.2f} Mvoxels/s, {plan.peak_memory / (1 << 20):.0f} MB)')
+    args.batch_size, args.patch_size, args.patch_stride = plan.batch_size, plan.patch_size, plan.patch_stride
+    return plan.batch_size
 
 
 ######### Main routine ###########
@@ -85,125 +305,76 @@ def main(args=None):
         if args.ord_params is None and args.temperature_map:
             raise SynthNNError('temperature_map is only a valid option when using ordinal regression')
 
-        # load the trained model
-        if args.nn_arch.lower() == 'nconv':
-            from synthnn.models.nconvnet import SimpleConvNet
-            model = SimpleConvNet(args.n_layers, kernel_size=args.kernel_size, dropout_p=args.dropout_prob,
-                                  n_input=args.n_input, n_output=args.n_output, is_3d=args.net3d)
-        elif args.nn_arch.lower() == 'unet':
-            from synthnn.models.unet import Unet
-            model = Unet(args.n_layers, kernel_size=args.kernel_size, dropout_p=args.dropout_prob,
-                         channel_base_power=args.channel_base_power, add_two_up=args.add_two_up, normalization=args.normalization,
-                         activation=args.activation, output_activation=args.out_activation, is_3d=args.net3d,
-                         interp_mode=args.interp_mode, enable_dropout=nsyn > 1, enable_bias=args.enable_bias,
-                         n_input=args.n_input, n_output=args.n_output, no_skip=args.no_skip,
-                         ord_params=args.ord_params+[device] if args.ord_params is not None else None)
-        elif args.nn_arch == 'vae':
-            from synthnn.models.vae import VAE
-            model = VAE(args.n_layers, args.img_dim, channel_base_power=args.channel_base_power,
-                         activation=args.activation, is_3d=args.net3d,
-                         n_input=args.n_input, n_output=args.n_output, latent_size=args.latent_size)
+        # load the trained model (and put it on the GPU if available and desired),
+        # or the exported network (see nn-export) for the torchscript and onnxruntime backends
+        if args.backend == 'eager':
+            model = load_model(args, device, enable_dropout=nsyn > 1)
+            # fold padding into the convolutions, fuse batch norm, and remove no-op modules (quantized
+            # convolutions only support zero padding, so the padding is not folded for static int8)
+            model = optimize_for_inference(model, inplace=True, fold_padding=args.precision != 'static_int8')
+            # convert to channels-last once here, so that the (shared or reduced precision) network keeps the format
+            if args.channels_last: to_channels_last(model)
+            logger.debug(model)
         else:
-            raise SynthNNError(f'Invalid NN type: {args.nn_arch}. {{nconv, unet}} are the only supported options.')
-        state_dict = torch.load(args.trained_model, map_location=device)
-        model.load_state_dict(state_dict)
-        model.eval()
-        logger.debug(model)
-
-        # put the model on the GPU if available and desired
-        if use_cuda: model.cuda(device=device)
-
-        # setup and start prediction loop (whole slice by whole slice)
-        axis = args.sample_axis or 0
-        if axis < 0 or axis > 2 and not isinstance(axis,int):
-            raise ValueError('sample_axis must be an integer between 0 and 2 inclusive')
+            if nsyn > 1: raise SynthNNError('Monte Carlo dropout (i.e., monte_carlo > 1) requires the eager backend.')
+            if args.channels_last: raise SynthNNError('The channels-last memory format requires the eager backend.')
+            model = load_backend(args, device)
+
+        # setup the predictor, which synthesizes 2D networks slice by slice and 3D networks by patch (or whole image)
         bs = args.batch_size // args.n_gpus if args.n_gpus > 1 and use_cuda else args.batch_size
-        psz = args.patch_size
+
+        # run the network at reduced precision (e.g., bf16 or int8 on the cpu), where the deviation from the
+        # full precision output is reported on a calibration subject to help pick the fastest acceptable precision
+        reduced = set_precision(model, args, device, bs, logger) if args.precision != 'fp32' else model
         predict_dir = args.predict_dir or args.valid_source_dir
-        output_dir = args.predict_out or os.getcwd() + '/syn_'
         num_imgs = len(glob_nii(predict_dir[0]))
         if any([len(glob_nii(pd)) != num_imgs for pd in predict_dir]) or num_imgs == 0:
             raise SynthNNError('Number of images in prediction directories must be positive and have an equal number '
                                'of images in each directory (e.g., so that img_t1_1 aligns with img_t2_1 etc. for multimodal synth)')
-        predict_fns = zip(*[glob_nii(pd) for pd in predict_dir])
-
-        if args.net3d and psz > 0 and args.calc_var:
-            raise SynthNNError('Patch-based 3D variance calculation not currently supported.')
-
-        if args.net3d:  # 3D Synthesis Loop
-            for k, fn in enumerate(predict_fns):
-                _, base, _ = split_filename(fn[0])
-                logger.info(f'Starting synthesis of image: {base}. ({k+1}/{num_imgs})')
-                img_nib = nib.load(fn[0])
-                img = np.stack([nib.load(f).get_data().view(np.float32) for f in fn])  # set to float32 to save memory
-                if img.ndim == 3: img = img[np.newaxis, ...]
-                if psz > 0:  # patch-based 3D synthesis
-                    out_img = np.zeros((args.n_output,) + img.shape[1:])
-                    count_mtx = np.zeros(img.shape[1:])
-                    x, y, z = get_overlapping_3d_idxs(psz, img)
-                    dec_idxs = np.floor(np.percentile(np.arange(x.shape[0]), np.arange(0, 101, 5)))
-                    pct_complete = 0
-                    j = 0
-                    # The below for-loop handles collecting overlapping patches and putting
-                    # them into a batch format that pytorch models expect (i.e., [N,C,H,W,D])
-                    # and running the batch through the network (storing the results in out_img).
-                    for i, (xx, yy, zz) in enumerate(zip(x, y, z)):
-                        if i in dec_idxs:
-                            logger.info(f'{pct_complete}% Complete')
-                            pct_complete += 5
-                        count_mtx[xx, yy, zz] = count_mtx[xx, yy, zz] + 1
-                        if j == 0:
-                            batch = np.zeros((args.batch_size,) + img[:, xx, yy, zz].shape, dtype=np.float32)
-                            batch_idxs = [(xx, yy, zz)]
-                            batch[j, ...] = img[:, xx, yy, zz]
-                            j += 1
-                        elif j != args.batch_size:
-                            batch_idxs.append((xx, yy, zz))
-                            batch[j, ...] = img[:, xx, yy, zz]
-                            j += 1
-                        else:
-                            batch = torch.from_numpy(batch).to(device)
-                            predicted = np.zeros(batch.shape)
-                            for _ in range(nsyn):
-                                predicted += fwd(model, batch, args.temperature_map)
-                            for ii, (bx, by, bz) in enumerate(batch_idxs):
-                                out_img[:, bx, by, bz] = out_img[:, bx, by, bz] + predicted[ii, ...]
-                            j = 0
-                    count_mtx[count_mtx == 0] = 1  # avoid division by zero
-                    out_img_nib = [nib.Nifti1Image(out_img[i]/count_mtx, img_nib.affine, img_nib.header) for i in range(args.n_output)]
-                else:  # whole-image-based 3D synthesis
-                    out_img = np.zeros((nsyn,) + img.shape)
-                    test_img = torch.from_numpy(img).to(device)[None, ...]  # add empty batch dimension
-                    for j in range(nsyn):
-                        out_img[j] = fwd(model, test_img, args.temperature_map)[0]  # remove empty batch dimension
-                    out_img = np.mean(out_img, axis=0) if not args.calc_var else np.var(out_img, axis=0)
-                    out_img_nib = [nib.Nifti1Image(out_img[i], img_nib.affine, img_nib.header) for i in range(args.n_output)]
-                save_imgs(out_img_nib, output_dir, k, logger)
-
-        else:  # 2D Synthesis Loop -- goes by slice, does not use patches
-            for k, fn in enumerate(predict_fns):
-                _, base, _ = split_filename(fn[0])
-                logger.info(f'Starting synthesis of image: {base}. ({k+1}/{num_imgs})')
-                img_nib = nib.load(fn[0])
-                img = np.stack([nib.load(f).get_data().view(np.float32) for f in fn])  # set to float32 to save memory
-                if img.ndim == 3: img = img[np.newaxis, ...]
-                out_img = np.zeros((nsyn, args.n_output) + img.shape[1:])
-                num_batches = floor(img.shape[axis+1] / bs)  # add one to axis to ignore channel dim
-                if img.shape[axis+1] / bs != num_batches:
-                    lbi = int(num_batches * bs)  # last batch index
-                    num_batches += 1
-                    lbs = img.shape[axis+1] - lbi  # last batch size
-                else:
-                    lbi = None
-                for i in range(num_batches if lbi is None else num_batches-1):
-                    logger.info(f'Starting batch ({i+1}/{num_batches})')
-                    batch2d(model, img, out_img, axis, device, bs, i*bs, nsyn, args.temperature_map)
-                if lbi is not None:
-                    logger.info(f'Starting batch ({num_batches}/{num_batches})')
-                    batch2d(model, img, out_img, axis, device, lbs, lbi, nsyn, args.temperature_map)
-                out_img = np.mean(out_img, axis=0) if not args.calc_var else np.var(out_img, axis=0)
-                out_img_nib = [nib.Nifti1Image(out_img[i], img_nib.affine, img_nib.header) for i in range(args.n_output)]
-                save_imgs(out_img_nib, output_dir, k, logger)
+        subjects = list(enumerate(zip(*[glob_nii(pd) for pd in predict_dir])))
+
+        # the slices (2d) or patches (3d) without foreground, given by a mask for each subject or an intensity
+        # threshold, are skipped and set to background_value (the output inside the foreground is unchanged)
+        if args.mask_dir is not None and args.foreground_threshold is not None:
+            raise SynthNNError('Only one of mask_dir and foreground_threshold can be set.')
+        if args.mask_dir is not None and len(glob_nii(args.mask_dir)) != num_imgs:
+            raise SynthNNError(f'Number of masks in {args.mask_dir} must equal the number of images to synthesize ({num_imgs}).')
+        if isinstance(args.foreground_threshold, str) and args.foreground_threshold.lower() != 'otsu':
+            raise SynthNNError(f'Invalid foreground threshold: {args.foreground_threshold}. Expected a number or otsu.')
+        if args.shard is not None: subjects = get_shard(subjects, args.shard)
+
+        # probe the network with trial shapes to pick the fastest batch size (and patch size and stride for 3d)
+        # within the memory budget, instead of the batch size (and patch size) in the config
+        if args.autotune and subjects: bs = tune(reduced, args, device, subjects, logger)
+
+        # statistics of the (monte carlo) samples to output, where the samples are folded into the batch
+        # dimension (up to mc_batch_size inputs per forward pass) and accumulated in a single pass
+        predictor = get_predictor(reduced, args, device, bs)
+
+        # output data type (None keeps the data type of the input image)
+        if args.output_dtype not in (None, 'float32', 'int16', 'uint16'):
+            raise SynthNNError(f'Invalid output data type: {args.output_dtype}. '
+                               f'{{float32, int16, uint16}} are the only supported options.')
+        output_ext(args.output_compression)  # raises an error for an invalid compression
+
+        # finished subjects are recorded in a manifest (when resume is set or a manifest is given), so that
+        # a resumed run skips the subjects whose inputs, config, and weights have not changed since then
+        manifest = None
+        if args.resume or args.manifest:
+            fn = args.manifest or (args.predict_out or os.getcwd() + '/syn_') + 'manifest.jsonl'
+            manifest = Manifest(fn, config_hash(args, RUNTIME_OPTIONS, [args.trained_model]))
+        if args.resume:
+            n_subjects = len(subjects)
+            subjects = [(k, fn) for k, fn in subjects if not manifest.is_complete(fn, get_out_fns(fn, args, predictor.stats))]
+            logger.info(f'Resuming: skipping {n_subjects - len(subjects)} finished subject(s), {len(subjects)} remaining')
+
+        # subjects are sharded across worker processes (for cpu prediction) when workers > 1
+        if (args.workers or 1) > 1:
+            if use_cuda: raise SynthNNError('Multiple workers are only supported for CPU prediction (see disable_cuda).')
+            predict_workers(model, args, subjects, logger, manifest)
+        else:
+            set_threads(args.threads)
+            predict_subjects(predictor, subjects, args, logger, manifest)
 
         return 0
     except Exception as e:
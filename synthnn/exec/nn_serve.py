@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.exec.nn_serve
+
+command line interface to run a persistent synthesis server which keeps
+trained pytorch NNs (see nn_train) loaded and micro-batches the slices
+or patches of concurrent requests
+
+images are sent to (and returned from) the server as serialized numpy
+arrays (i.e., the .npy format) over http, see request_synthesis
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+import argparse
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import logging
+import os
+import queue
+from socketserver import ThreadingMixIn
+import sys
+import threading
+import time
+from urllib.request import Request, urlopen
+import warnings
+
+with warnings.catch_warnings():
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    warnings.filterwarnings('ignore', category=UserWarning)
+    import numpy as np
+    import torch
+    from synthnn.util.exec import get_device, load_config, setup_log
+    from synthnn import foreground_mask, Predictor, SynthNNError
+
+logger = logging.getLogger(__name__)
+
+
+######## Helper functions ########
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='serve trained CNNs for MR image synthesis over http')
+
+    required = parser.add_argument_group('Required')
+    required.add_argument('config', type=str, nargs='+',
+                          help='config file(s) created by nn-train (see -ocf), the model is served under the '
+                               'config file name, or use name=config.json to choose the name')
+
+    options = parser.add_argument_group('Options')
+    options.add_argument('--disable-cuda', action='store_true', default=False,
+                         help='Disable CUDA regardless of availability')
+    options.add_argument('-H', '--host', type=str, default='127.0.0.1',
+                         help='address to serve on [Default=127.0.0.1]')
+    options.add_argument('-mb', '--max-batch', type=int, default=None,
+                         help='maximum number of slices/patches per forward pass [Default=batch size in config]')
+    options.add_argument('-ml', '--max-latency', type=float, default=10,
+                         help='maximum time (in ms) to wait for more slices/patches to fill a batch [Default=10]')
+    options.add_argument('-p', '--port', type=int, default=8000, help='port to serve on [Default=8000]')
+    options.add_argument('-v', '--verbosity', action="count", default=0,
+                         help="increase output verbosity (e.g., -vv is more than -v)")
+    return parser
+
+
+def _percentiles(x, qs=(50, 95)):
+    return {f'p{q}': float(np.percentile(x, q)) if len(x) > 0 else None for q in qs}
+
+
+class _Item:
+    __slots__ = ('x', 'future', 'time')
+
+    def __init__(self, x):
+        self.x = x
+        self.future = Future()
+        self.time = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    collect single inputs (i.e., 2d slices or 3d patches) submitted from concurrent
+    requests into batches for one model, where a batch is run once it holds max_batch
+    inputs or once its oldest input has waited max_latency seconds
+
+    Args:
+        model (torch.nn.Module): trained network (in eval mode)
+        device (torch.device): device the model is on
+        max_batch (int): maximum number of inputs per forward pass
+        max_latency (float): maximum time (in seconds) to wait for a batch to fill
+        temperature_map (bool): output the temperature map (for ordinal regression models)
+        memory_format (torch.memory_format): memory format of the batches (see to_channels_last)
+    """
+    def __init__(self, model, device, max_batch, max_latency=0.01, temperature_map=False,
+                 memory_format=torch.preserve_format):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.temperature_map = temperature_map
+        self.memory_format = memory_format
+        self.queue = queue.Queue()
+        self.pending = []  # inputs which were collected but did not fit in (or match the shape of) the last batch
+        self.n_items = self.n_batches = 0
+        self.latencies = deque(maxlen=1000)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, x:torch.Tensor) -> Future:
+        """ submit a single input (i.e., without batch dimension) and get a future of the output """
+        item = _Item(x)
+        self.queue.put(item)
+        return item.future
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _collect(self):
+        if not self.pending:
+            try:
+                self.pending.append(self.queue.get(timeout=0.1))
+            except queue.Empty:
+                return []
+        shape = self.pending[0].x.shape
+        deadline = self.pending[0].time + self.max_latency
+        while sum(p.x.shape == shape for p in self.pending) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0: break
+            try:
+                self.pending.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        batch = [p for p in self.pending if p.x.shape == shape][:self.max_batch]
+        self.pending = [p for p in self.pending if all(p is not b for b in batch)]
+        return batch
+
+    def _run(self):
+        with torch.no_grad():
+            while not self._stop.is_set():
+                batch = self._collect()
+                if not batch: continue
+                try:
+                    x = torch.stack([b.x for b in batch]).to(self.device, memory_format=self.memory_format)
+                    out = self.model.predict(x, self.temperature_map).cpu().numpy()
+                except Exception as e:
+                    for b in batch: b.future.set_exception(e)
+                    continue
+                now = time.perf_counter()
+                for b, o in zip(batch, out):
+                    self.latencies.append(now - b.time)
+                    b.future.set_result(o)
+                self.n_items += len(batch)
+                self.n_batches += 1
+
+    def stats(self) -> dict:
+        latencies = [1000 * l for l in list(self.latencies)]
+        return {'queue_depth': self.queue.qsize() + len(self.pending),
+                'items': self.n_items,
+                'batches': self.n_batches,
+                'mean_batch_size': self.n_items / self.n_batches if self.n_batches > 0 else None,
+                'item_latency_ms': _percentiles(latencies)}
+
+
+class _BatchedPredictor(Predictor):
+    """ predictor which runs its slices/patches through a micro-batcher shared with concurrent requests """
+    batcher = None
+
+    def _forward(self, x:torch.Tensor) -> np.ndarray:
+        futures = [self.batcher.submit(xi) for xi in x]
+        return np.stack([f.result() for f in futures])
+
+
+class ServedModel:
+    """ a trained network (from a config file) along with its micro-batcher and request statistics """
+    def __init__(self, config_fn, disable_cuda=False, max_batch=None, max_latency=0.01):
+        self.args = args = load_config(config_fn)
+        args.disable_cuda = args.disable_cuda or disable_cuda
+        self.device, _, _ = get_device(args, logger)
+        self.max_batch = max_batch or args.batch_size
+        self.predictor = _BatchedPredictor.from_config(args, self.device, batch_size=self.max_batch)
+        self.model = self.predictor.model
+        self.batcher = MicroBatcher(self.model, self.device, self.max_batch, max_latency, args.temperature_map,
+                                    self.predictor.memory_format)
+        self.predictor.batcher = self.batcher
+        self.request_latencies = deque(maxlen=1000)
+        self.n_requests = 0
+        self._lock = threading.Lock()  # requests are handled concurrently
+
+    def synthesize(self, img:np.ndarray) -> np.ndarray:
+        """ synthesize an image ([C,H,W,D] or [H,W,D] for a single input channel) """
+        start = time.perf_counter()
+        threshold = self.args.foreground_threshold  # slices/patches without foreground are skipped
+        out_img = self.predictor.predict(img, foreground_mask(img, threshold) if threshold is not None else None)
+        with self._lock:
+            self.request_latencies.append(time.perf_counter() - start)
+            self.n_requests += 1
+        return out_img
+
+    def stats(self) -> dict:
+        latencies = [1000 * l for l in list(self.request_latencies)]
+        return dict(requests=self.n_requests, request_latency_ms=_percentiles(latencies), **self.batcher.stats())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _respond(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, msg):
+        self._respond(code, json.dumps({'error': msg}).encode())
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._respond(200, json.dumps({n: m.stats() for n, m in self.server.models.items()}).encode())
+        elif self.path == '/models':
+            self._respond(200, json.dumps(sorted(self.server.models)).encode())
+        else:
+            self._error(404, f'Unknown path: {self.path}')
+
+    def do_POST(self):
+        name = self.path[len('/predict/'):] if self.path.startswith('/predict/') else None
+        if name not in self.server.models:
+            self._error(404, f'Unknown model or path: {self.path}')
+            return
+        try:
+            img = np.load(io.BytesIO(self.rfile.read(int(self.headers['Content-Length']))), allow_pickle=False)
+            out_img = self.server.models[name].synthesize(img)
+        except SynthNNError as e:
+            self._error(400, str(e))
+            return
+        except Exception as e:
+            logger.exception(e)
+            self._error(500, str(e))
+            return
+        buf = io.BytesIO()
+        np.save(buf, out_img, allow_pickle=False)
+        self._respond(200, buf.getvalue(), 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class SynthesisServer(ThreadingMixIn, HTTPServer):
+    """
+    http server for synthesis with one or more served models, where
+    POST /predict/<name> with an image (as .npy) returns the synthesized image (as .npy),
+    GET /stats returns the queue depth and latency statistics of each model, and
+    GET /models returns the names of the served models
+
+    Args:
+        address (Tuple[str,int]): host and port to serve on (port 0 picks a free port)
+        models (Dict[str,ServedModel]): models to serve by name
+    """
+    daemon_threads = True
+
+    def __init__(self, address, models):
+        super().__init__(address, _Handler)
+        self.models = models
+
+    def server_close(self):
+        super().server_close()
+        for m in self.models.values(): m.batcher.close()
+
+
+def request_synthesis(img:np.ndarray, name:str, host:str='127.0.0.1', port:int=8000, timeout:float=None) -> np.ndarray:
+    """ client to synthesize an image with a model served by nn-serve """
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(img, dtype=np.float32), allow_pickle=False)
+    req = Request(f'http://{host}:{port}/predict/{name}', data=buf.getvalue(),
+                  headers={'Content-Type': 'application/octet-stream'})
+    with urlopen(req, timeout=timeout) as resp:
+        return np.load(io.BytesIO(resp.read()), allow_pickle=False)
+
+
+def request_stats(host:str='127.0.0.1', port:int=8000, timeout:float=None) -> dict:
+    """ client to get the statistics of the models served by nn-serve """
+    with urlopen(f'http://{host}:{port}/stats', timeout=timeout) as resp:
+        return json.loads(resp.read())
+
+
+######### Main routine ###########
+
+def main(args=None):
+    args = arg_parser().parse_args(args)
+    setup_log(args.verbosity)
+    try:
+        models = {}
+        for cfg in args.config:
+            name, fn = cfg.split('=', 1) if '=' in cfg else (os.path.splitext(os.path.basename(cfg))[0], cfg)
+            models[name] = ServedModel(fn, args.disable_cuda, args.max_batch, args.max_latency / 1000)
+            logger.info(f'Loaded model: {name} (from {fn}) on {models[name].device}')
+        server = SynthesisServer((args.host, args.port), models)
+        logger.info(f'Serving {", ".join(sorted(models))} on http://{args.host}:{server.server_address[1]}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('Shutting down')
+        finally:
+            server.server_close()
+        return 0
+    except Exception as e:
+        logger.exception(e)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -15,6 +15,7 @@ import argparse
 import logging
 import os
 import sys
+import time
 import warnings
 
 with warnings.catch_warnings():
@@ -25,12 +26,16 @@ with warnings.catch_warnings():
     import numpy as np
     import torch
     from torch import nn
-    from torch.utils.data import DataLoader
+    import torch.distributed as dist
+    from torch.nn.parallel import DistributedDataParallel
+    from torch.utils.data import DataLoader, DistributedSampler, Subset
     from torchvision.transforms import Compose
     from torch.utils.data.sampler import SubsetRandomSampler
     from niftidataset import MultimodalNiftiDataset, MultimodalTiffDataset
     import niftidataset.transforms as tfms
-    from synthnn import SynthNNError, init_weights, BurnCosineLR
+    from synthnn import SynthNNError, init_weights, BurnCosineLR, channels_last_format, to_channels_last
+    from synthnn import BatchAugment, CACHE_MODES, CachedDataset, ChunkStore, copy_sample, parse_memory, PatchQueue, shm_dir, StoreDataset, VolumeCache
+    from synthnn import all_reduce_mean, all_reduce_sum, dist_info, init_distributed, is_launched, launch, shared_tempdir
     from synthnn.util.exec import get_args, get_device, setup_log, write_out_config
 
 
@@ -40,41 +45,81 @@ def arg_parser():
     parser = argparse.ArgumentParser(description='train a CNN for MR image synthesis')
 
     required = parser.add_argument_group('Required')
-    required.add_argument('-s', '--source-dir', type=str, required=True, nargs='+',
-                          help='path to directory with source images (multiple paths can be provided for multi-modal synthesis)')
-    required.add_argument('-t', '--target-dir', type=str, required=True, nargs='+',
-                          help='path to directory with target images (multiple paths can be provided for multi-modal synthesis)')
+    required.add_argument('-s', '--source-dir', type=str, default=None, nargs='+',
+                          help='path to directory with source images (multiple paths can be provided for multi-modal synthesis), '
+                               'not required when training from a dataset store (see --store)')
+    required.add_argument('-t', '--target-dir', type=str, default=None, nargs='+',
+                          help='path to directory with target images (multiple paths can be provided for multi-modal synthesis), '
+                               'not required when training from a dataset store (see --store)')
     required.add_argument('-o', '--trained-model', type=str, default=None,
                           help='path to output the trained model')
 
     options = parser.add_argument_group('Options')
     options.add_argument('-bs', '--batch-size', type=int, default=5,
-                         help='batch size (num of images to process at once) [Default=5]')
+                         help='batch size (num of images to process at once, per process with --distributed) [Default=5]')
+    options.add_argument('--cache', type=str, default='none', choices=CACHE_MODES,
+                         help='decode each volume once and keep it in the memory of each process (memory) or in '
+                              'shared memory, memory-mapped by all dataloader workers (shared) [Default=none]')
+    options.add_argument('--cache-dir', type=str, default=None,
+                         help='directory for the shared cache, which is kept so later runs can reuse it '
+                              '[Default=a temporary directory in /dev/shm, removed after training]')
+    options.add_argument('--cache-dtype', type=str, default='float32', choices=('float32', 'float16'),
+                         help='dtype of the cached volumes (float16 halves the memory) [Default=float32]')
+    options.add_argument('--cache-memory', type=str, default=None,
+                         help='maximum size of the cache in megabytes or with a unit (e.g., 8G), the least recently '
+                              'used volumes are evicted (per process with --cache memory) [Default=None, i.e., unbounded]')
+    options.add_argument('-cl', '--channels-last', action='store_true', default=False,
+                         help='use the channels-last memory format for the network and its inputs, '
+                              'which is often faster on the cpu [Default=False]')
     options.add_argument('-c', '--clip', type=float, default=None,
                          help='gradient clipping threshold [Default=None]')
     options.add_argument('--disable-cuda', action='store_true', default=False,
                          help='Disable CUDA regardless of availability')
+    options.add_argument('-db', '--dist-backend', type=str, default=None, choices=('gloo', 'nccl'),
+                         help='backend of distributed training [Default=nccl with CUDA, otherwise gloo]')
+    options.add_argument('-dist', '--distributed', action='store_true', default=False,
+                         help='train with one process per gpu (or several processes on the cpu) with distributed data '
+                              'parallel, where the processes are started by torchrun or, if not, by nn-train on this '
+                              'machine (see --nproc) [Default=False]')
     options.add_argument('-mp', '--fp16', action='store_true', default=False,
-                         help='enable mixed precision training')
+                         help='enable mixed precision training (alias for --precision fp16)')
     options.add_argument('-gs', '--gpu-selector', type=int, nargs='+', default=None,
                          help='use gpu(s) selected here, None uses all available gpus if --multi-gpus enabled '
                               'else None uses first available GPU [Default=None]')
     options.add_argument('-lrs', '--lr-scheduler', action='store_true', default=False,
                          help='use a cosine-annealing based learning rate scheduler [Default=False]')
-    options.add_argument('-mg', '--multi-gpu', action='store_true', default=False, help='use multiple gpus [Default=False]')
+    options.add_argument('-mg', '--multi-gpu', action='store_true', default=False,
+                         help='use multiple gpus (i.e., --distributed with CUDA) [Default=False]')
     options.add_argument('-n', '--n-jobs', type=int, default=0,
                             help='number of CPU processors to use (use 0 if CUDA enabled) [Default=0]')
+    options.add_argument('-np', '--nproc', type=int, default=None,
+                         help='number of processes nn-train starts on this machine with --distributed (when not started '
+                              'by torchrun) [Default=number of selected gpus with CUDA, otherwise 1]')
     options.add_argument('-ocf', '--out-config-file', type=str, default=None,
                          help='output a config file for the options used in this experiment '
                               '(saves them as a json file with the name as input in this argument)')
+    options.add_argument('-pr', '--precision', dest='train_precision', type=str, default='fp32',
+                         choices=('fp32', 'fp16', 'bf16'),
+                         help='train with automatic mixed precision (autocast) in float16 (with gradient scaling) '
+                              'or bfloat16 (which is also supported on the cpu), the losses are computed in float32 '
+                              '[Default=fp32]')
     options.add_argument('-ps', '--patch-size', type=int, default=64,
                          help='patch size^3 extracted from image [Default=64]')
+    options.add_argument('-ppv', '--patches-per-volume', type=int, default=1,
+                         help='number of random patches (or slices) drawn from each volume once it is loaded, where '
+                              'the patches of several volumes are mixed in a shuffle buffer (see --queue-size) [Default=1]')
     options.add_argument('-pm','--pin-memory', action='store_true', default=False, help='pin memory in dataloader [Default=False]')
     options.add_argument('-pl', '--plot-loss', type=str, default=None,
                             help='plot the loss vs epoch and save at the filename provided here [Default=None]')
+    options.add_argument('-qs', '--queue-size', type=int, default=None,
+                         help='number of patches in the shuffle buffer when drawing several patches per volume '
+                              '[Default=4 * patches-per-volume]')
     options.add_argument('-sa', '--sample-axis', type=int, default=2,
                             help='axis on which to sample for 2d (None for random orientation when NIfTI images given) [Default=2]')
     options.add_argument('-sd', '--seed', type=int, default=0, help='set seed for reproducibility [Default=0]')
+    options.add_argument('--store', type=str, default=None,
+                         help='train from a dataset store built by nn-cache instead of the source and target directories, '
+                              'only the chunks touched by each crop or slice are read [Default=None]')
     options.add_argument('--tiff', action='store_true', default=False, help='dataset are tiff images [Default=False]')
     options.add_argument('-vs', '--valid-split', type=float, default=0.2,
                           help='split the data in source_dir and target_dir into train/validation '
@@ -133,6 +178,10 @@ def arg_parser():
     vae_options.add_argument('-ls', '--latent-size', type=int, default=2048, help='if using VAE, this controls latent dimension size [Default=2048]')
 
     aug_options = parser.add_argument_group('Data Augmentation Options')
+    aug_options.add_argument('-ba', '--batch-augment', action='store_true', default=False,
+                             help='apply the augmentation to whole training batches (as tensors on the device) instead of '
+                                  'per sample in the dataloader workers, which also supports affine and flipping '
+                                  'augmentation for 3d networks [Default=False]')
     aug_options.add_argument('-p', '--prob', type=float, nargs=4, default=None, help='probability of (Affine, Flip, Gamma, Noise) [Default=None]')
     aug_options.add_argument('-r', '--rotate', type=float, default=0, help='max rotation angle [Default=0]')
     aug_options.add_argument('-ts', '--translate', type=float, default=None, help='max fractional translation [Default=None]')
@@ -148,36 +197,69 @@ def arg_parser():
 
 
 def criterion(out, tgt, model):
-    """ helper function to handle multiple outputs in model evaluation """
-    if isinstance(out, tuple):
-        loss = model.module.criterion(tgt, *out) if isinstance(model, nn.DataParallel) else model.criterion(tgt, *out)
-    else:
-        loss = model.module.criterion(tgt, out) if isinstance(model, nn.DataParallel) else model.criterion(tgt, out)
+    """ helper function to handle multiple outputs in model evaluation (the loss is computed in fp32) """
+    out = tuple(o.float() for o in out) if isinstance(out, tuple) else (out.float(),)
+    loss = model.module.criterion(tgt.float(), *out) if isinstance(model, DistributedDataParallel) else model.criterion(tgt.float(), *out)
     return loss
 
 
 ######### Main routine ###########
 
 def main(args=None):
+    argv = args  # passed on to the processes of distributed training
     args, no_config_file = get_args(args, arg_parser)
+    use_cuda = torch.cuda.is_available() and not args.disable_cuda
+    distributed = args.distributed or (args.multi_gpu and use_cuda)
+    rank = dist_info()[0] if distributed else 0
     setup_log(args.verbosity)
+    if rank > 0: logging.getLogger().setLevel(logging.ERROR)  # only the first process logs progress
     logger = logging.getLogger(__name__)
+    cache = None
     try:
+        if args.multi_gpu and not use_cuda: logger.warning('Multi-GPU functionality is not available on your system.')
+
+        # start the training processes on this machine (unless started by torchrun), which run main again
+        if distributed and not is_launched():
+            n_gpus = len(args.gpu_selector) if args.gpu_selector is not None else torch.cuda.device_count()
+            nproc = args.nproc or (n_gpus if use_cuda else 1)
+            return launch(main, argv, nproc)
+
         # set random seeds for reproducibility
         torch.manual_seed(args.seed)
         np.random.seed(args.seed)
 
-        # define device to put tensors on
+        # define device to put tensors on (each process of distributed training uses its own gpu)
         device, use_cuda, n_gpus = get_device(args, logger)
-
-        # import and initialize mixed precision training package
-        amp_handle = None
-        if args.fp16:
-            try:
-                from apex import amp
-                amp_handle = amp.init()
-            except ImportError:
-                logger.info('Mixed precision training (i.e., the package `apex`) not available.')
+        world_size = 1
+        if distributed:
+            device, rank, world_size = init_distributed(args.dist_backend, use_cuda, args.gpu_selector)
+            logger.debug(f'Distributed training with {world_size} processes')
+
+        # setup automatic mixed precision (the forward passes run under autocast, the losses in fp32)
+        if args.fp16: args.train_precision = 'fp16'
+        amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(args.train_precision)
+        if args.train_precision == 'bf16' and use_cuda and not torch.cuda.is_bf16_supported():
+            raise SynthNNError('bf16 training is not supported on this GPU, use fp16 instead.')
+        if args.train_precision == 'fp16' and not use_cuda:
+            logger.warning('fp16 training on the cpu is slow (if supported at all), bf16 is preferred.')
+        def autocast(): return torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+        # scale the loss in fp16 so that small gradients do not underflow (a no-op otherwise)
+        scaler = torch.amp.GradScaler(device.type, enabled=args.train_precision == 'fp16')
+        logger.debug(f'Training precision: {args.train_precision}')
+
+        # read the training images from a dataset store (see nn-cache) if given
+        store = None
+        if args.store is not None:
+            store = ChunkStore(args.store)
+            if args.source_dir is None: args.source_dir = store.index['source_dirs']
+            if args.target_dir is None: args.target_dir = store.index['target_dirs']
+            if (len(args.source_dir), len(args.target_dir)) != (store.n_input, store.n_output):
+                raise SynthNNError(f'Store {args.store} has {store.n_input} source and {store.n_output} target images '
+                                   f'per subject, but {len(args.source_dir)} and {len(args.target_dir)} directories were given.')
+            args.tiff = store.tiff
+            logger.debug(f'Training from the store {args.store} ({len(store)} subjects)')
+        elif args.source_dir is None or args.target_dir is None:
+            raise SynthNNError('Source and target directories (or a dataset store, see --store) are required.')
 
         use_3d = args.net3d and not args.tiff
         if args.net3d and args.tiff: logger.warning('Cannot train a 3D network with TIFF images, creating a 2D network.')
@@ -211,17 +293,22 @@ def main(args=None):
 
         # put the model on the GPU if available and desired
         if use_cuda: model.cuda(device=device)
-        use_multi = args.multi_gpu and n_gpus > 1 and use_cuda
-        if args.multi_gpu and n_gpus <= 1: logger.warning('Multi-GPU functionality is not available on your system.')
-        if use_multi:
-            n_gpus = len(args.gpu_selector) if args.gpu_selector is not None else n_gpus
-            logger.debug(f'Enabling use of {n_gpus} gpus')
-            model = torch.nn.DataParallel(model, device_ids=args.gpu_selector)
 
         # initialize the weights with user-defined initialization routine
         logger.debug(f'Initializing weights with {args.init}')
         init_weights(model, args.init, args.init_gain)
 
+        # convert the network to the channels-last memory format (the inputs are converted when moved to the device)
+        memory_format = torch.preserve_format
+        if args.channels_last:
+            logger.debug('Using the channels-last memory format')
+            to_channels_last(model)
+            memory_format = channels_last_format(use_3d)
+
+        # replicate the network in each process (with the weights of the first), gradients are all-reduced
+        if distributed:
+            model = DistributedDataParallel(model, device_ids=[device] if use_cuda else None)
+
         # check number of jobs requested and CPUs available
         num_cpus = os.cpu_count()
         if num_cpus < args.n_jobs:
@@ -232,12 +319,30 @@ def main(args=None):
         # control random cropping patch size (or if used at all)
         if not args.tiff:
             cropper = tfms.RandomCrop3D(args.patch_size) if args.net3d else tfms.RandomCrop2D(args.patch_size, args.sample_axis)
-            tfm = [cropper] if args.patch_size > 0 else [] if args.net3d else [tfms.RandomSlice(args.sample_axis)]
+            crop = [cropper] if args.patch_size > 0 else [] if args.net3d else [tfms.RandomSlice(args.sample_axis)]
         else:
-            tfm = []
+            crop = []
+
+        # copy the (cropped) samples out of the cache before any other transform
+        use_cache = args.cache != 'none'
+        if use_cache:
+            crop.append(copy_sample)
+            cache_dir, owner = args.cache_dir, None
+            if distributed and args.cache == 'shared' and cache_dir is None:
+                # the processes on a machine share one cache, which the first of them removes
+                cache_dir, owner = shared_tempdir('synthnn-cache-', shm_dir()), dist_info()[1] == 0
+            cache = VolumeCache(args.cache, args.cache_dtype, parse_memory(args.cache_memory)
+                                if args.cache_memory is not None else None, cache_dir, owner=owner)
+            logger.debug(f'Caching decoded volumes ({args.cache}, {args.cache_dtype})')
 
         # add data augmentation if desired
-        if args.prob is not None:  # currently only support transforms on tiff images
+        tfm, augment = [], None
+        if args.prob is not None and args.batch_augment:
+            logger.debug('Adding batched data augmentation')
+            augment = BatchAugment(args.prob, args.rotate, args.translate, args.scale, args.vflip, args.hflip,
+                                   args.gamma, args.gain, args.noise_std, args.tfm_x, args.tfm_y)
+            tfm.append(tfms.ToTensor())
+        elif args.prob is not None:  # currently only support transforms on tiff images
             logger.debug('Adding data augmentation transforms')
             if args.net3d and (args.prob[0] > 0 or args.prob[1] > 0):
                 logger.warning('Cannot do affine or flipping data augmentation with 3d networks')
@@ -249,17 +354,46 @@ def main(args=None):
             logger.debug('No data augmentation will be used (except random cropping if patch_size > 0)')
             tfm.append(tfms.ToTensor())
 
+        # with several patches per volume, the datasets return whole volumes which the patch queue crops
+        use_queue = args.patches_per_volume > 1
+        if use_queue: logger.debug(f'Drawing {args.patches_per_volume} patches per volume')
+
+        def get_dataset(source_dirs, target_dirs):
+            transform = None if use_queue else Compose(crop + tfm)
+            if use_cache: return CachedDataset(source_dirs, target_dirs, cache, transform, args.tiff)
+            return MultimodalNiftiDataset(source_dirs, target_dirs, transform) if not args.tiff else \
+                   MultimodalTiffDataset(source_dirs, target_dirs, transform)
+
+        # keep the workers (and so their caches) alive between epochs
+        loader_kwargs = dict(batch_size=args.batch_size, num_workers=args.n_jobs, pin_memory=args.pin_memory,
+                             persistent_workers=use_cache and args.n_jobs > 0)
+
+        def get_loader(dataset, indices=None, shuffle=False):
+            if use_queue:
+                transform = None if isinstance(dataset, StoreDataset) else Compose(crop + tfm)  # the store crops itself
+                queue = PatchQueue(dataset, args.patches_per_volume, args.queue_size, indices, shuffle, transform,
+                                   world_size, rank, args.seed)
+                return DataLoader(queue, **loader_kwargs)
+            if distributed and shuffle:  # each process loads its part of the training subjects (padded with repeats)
+                subset = dataset if indices is None else Subset(dataset, indices)
+                sampler = DistributedSampler(subset, world_size, rank, shuffle=True, seed=args.seed)
+                return DataLoader(subset, sampler=sampler, **loader_kwargs)
+            if distributed:  # validation subjects are split without padding, so none is counted twice
+                indices = list(range(len(dataset)) if indices is None else indices)
+                return DataLoader(Subset(dataset, indices[rank::world_size]), **loader_kwargs)
+            if indices is not None: return DataLoader(dataset, sampler=SubsetRandomSampler(indices), **loader_kwargs)
+            return DataLoader(dataset, shuffle=shuffle, **loader_kwargs)
+
         # define dataset and split into training/validation set
-        dataset = MultimodalNiftiDataset(args.source_dir, args.target_dir, Compose(tfm)) if not args.tiff else \
-                  MultimodalTiffDataset(args.source_dir, args.target_dir, Compose(tfm))
+        dataset = get_dataset(args.source_dir, args.target_dir) if store is None else \
+                  StoreDataset(store, args.patch_size, use_3d, args.sample_axis, Compose(tfm))  # the store crops itself
         logger.debug(f'Number of training images: {len(dataset)}')
 
         if args.valid_source_dir is not None and args.valid_target_dir is not None:
-            valid_dataset = MultimodalNiftiDataset(args.valid_source_dir, args.valid_target_dir, Compose(tfm)) if not args.tiff else \
-                            MultimodalTiffDataset(args.valid_source_dir, args.valid_target_dir, Compose(tfm))
+            valid_dataset = get_dataset(args.valid_source_dir, args.valid_target_dir)
             logger.debug(f'Number of validation images: {len(valid_dataset)}')
-            train_loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.n_jobs, shuffle=True, pin_memory=args.pin_memory)
-            validation_loader = DataLoader(valid_dataset, batch_size=args.batch_size, num_workers=args.n_jobs, pin_memory=args.pin_memory)
+            train_loader = get_loader(dataset, shuffle=True)
+            validation_loader = get_loader(valid_dataset)
         else:
             # setup training and validation set
             num_train = len(dataset)
@@ -268,12 +402,9 @@ def main(args=None):
             validation_idx = np.random.choice(indices, size=split, replace=False)
             train_idx = list(set(indices) - set(validation_idx))
 
-            train_sampler = SubsetRandomSampler(train_idx)
-            validation_sampler = SubsetRandomSampler(validation_idx)
-
             # set up data loader for nifti images
-            train_loader = DataLoader(dataset, sampler=train_sampler, batch_size=args.batch_size, num_workers=args.n_jobs, pin_memory=args.pin_memory)
-            validation_loader = DataLoader(dataset, sampler=validation_sampler, batch_size=args.batch_size, num_workers=args.n_jobs, pin_memory=args.pin_memory)
+            train_loader = get_loader(dataset, train_idx, shuffle=True)
+            validation_loader = get_loader(dataset, validation_idx)
 
         # train the model
         logger.info(f'LR: {args.learning_rate:.5f}')
@@ -282,24 +413,35 @@ def main(args=None):
             logger.debug('Enabling burn-in cosine annealing LR scheduler')
             scheduler = BurnCosineLR(optimizer, args.n_epochs)
         use_valid = args.valid_split > 0 or (args.valid_source_dir is not None and args.valid_target_dir is not None)
+        if distributed:  # draw different crops, augmentation, and dropout in each process (the split is shared)
+            torch.manual_seed(args.seed + rank)
+            np.random.seed(args.seed + rank)
         train_losses, validation_losses = [], []
         for t in range(args.n_epochs):
             # training
-            t_losses = []
+            t_losses, n_voxels = [], 0
             if use_valid: model.train(True)
+            if distributed:  # the processes share a new permutation of the training subjects each epoch
+                (train_loader.dataset if use_queue else train_loader.sampler).set_epoch(t)
+            start = time.perf_counter()
             for src, tgt in train_loader:
                 src, tgt = src.to(device), tgt.to(device)
-                out = model(src)
+                if augment is not None: src, tgt = augment(src, tgt)
+                src = src.to(memory_format=memory_format)
+                with autocast():
+                    out = model(src)
                 loss = criterion(out, tgt, model)
                 t_losses.append(loss.item())
+                n_voxels += src[:, 0].numel()
                 optimizer.zero_grad()
-                if args.fp16 and amp_handle is not None:
-                    with amp_handle.scale_loss(loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    loss.backward()
-                if args.clip is not None: nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-                optimizer.step()
+                scaler.scale(loss).backward()
+                if args.clip is not None:
+                    scaler.unscale_(optimizer)
+                    nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+                scaler.step(optimizer)
+                scaler.update()
+            # the throughput (of all processes) includes the time waiting for data
+            throughput = all_reduce_sum([n_voxels], device)[0] / (time.perf_counter() - start)
             train_losses.append(t_losses)
             if args.lr_scheduler: scheduler.step()
 
@@ -308,18 +450,26 @@ def main(args=None):
             if use_valid: model.train(False)
             with torch.set_grad_enabled(False):
                 for src, tgt in validation_loader:
-                    src, tgt = src.to(device), tgt.to(device)
-                    out = model(src)
+                    src, tgt = src.to(device, memory_format=memory_format), tgt.to(device)
+                    with autocast():
+                        out = model(src)
                     loss = criterion(out, tgt, model)
                     v_losses.append(loss.item())
                 validation_losses.append(v_losses)
 
-            if np.any(np.isnan(t_losses)): raise SynthNNError('NaN in training loss, cannot recover. Exiting.')
-            log = f'Epoch: {t+1} - Training Loss: {np.mean(t_losses):.2e}'
-            if use_valid: log += f', Validation Loss: {np.mean(v_losses):.2e}'
+            # mean losses of all processes
+            t_loss, v_loss = all_reduce_mean(t_losses, device), all_reduce_mean(v_losses, device)
+            if np.isnan(t_loss): raise SynthNNError('NaN in training loss, cannot recover. Exiting.')
+            log = f'Epoch: {t+1} - Training Loss: {t_loss:.2e}'
+            if use_valid: log += f', Validation Loss: {v_loss:.2e}'
             if args.lr_scheduler: log += f', LR: {scheduler.get_lr()[0]:.2e}'
+            log += f', Throughput ({args.train_precision}): {throughput / 1e6:.3f} Mvox/s'
             logger.info(log)
 
+        # only the first process writes the config file, the model, and the plot (the replicas are identical)
+        if rank > 0: return 0
+        if distributed: model = model.module  # save the network itself (without the `module.` prefix)
+
         # output a config file if desired
         if args.out_config_file is not None:
             write_out_config(args, n_gpus, n_input, n_output, use_3d)
@@ -333,17 +483,6 @@ def main(args=None):
             logger.warning('Saving the entire model. Preferred to create a config file and only save model weights')
             torch.save(model, args.trained_model)
 
-        # strip multi-gpu specific attributes from saved model (so that it can be loaded easily)
-        if use_multi and use_config_file:
-            from collections import OrderedDict
-            state_dict = torch.load(args.trained_model, map_location='cpu')
-            # create new OrderedDict that does not contain `module.`
-            new_state_dict = OrderedDict()
-            for k, v in state_dict.items():
-                name = k[7:]  # remove `module.`
-                new_state_dict[name] = v
-            torch.save(new_state_dict, args.trained_model)
-
         # plot the loss vs epoch (if desired)
         if args.plot_loss is not None:
             plot_error = True if args.n_epochs <= 50 else False
@@ -358,6 +497,9 @@ def main(args=None):
     except Exception as e:
         logger.exception(e)
         return 1
+    finally:
+        if cache is not None: cache.close()
+        if dist.is_available() and dist.is_initialized(): dist.destroy_process_group()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,4 @@
+from .backends import *
+from .precision import *
+from .predictor import *
+from .autotune import *
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.inference.autotune
+
+pick the batch size (2d) or the patch size, stride, and batch size (3d)
+which maximize the synthesized voxels per second within a memory budget,
+by probing the network with trial shapes and measuring their peak memory
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['autotune',
+           'available_memory',
+           'batch_memory',
+           'MemoryProbe',
+           'parse_memory',
+           'plan_key',
+           'PlanCache',
+           'TunePlan']
+
+import ctypes
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+import tracemalloc
+from typing import Callable, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+from ..errors import SynthNNError
+from ..util.patch import get_patch_plan, min_patch_stride
+from .predictor import inference_mode, Predictor
+
+logger = logging.getLogger(__name__)
+
+# config options which change the memory use or speed of the network (the tuned options are not included)
+PLAN_OPTIONS = ('activation', 'add_two_up', 'backend', 'calc_var', 'channel_base_power', 'channels_last', 'img_dim',
+                'interp_mode', 'kernel_size', 'latent_size', 'mc_batch_size', 'mc_stats', 'monte_carlo', 'n_input',
+                'n_layers', 'n_output', 'net3d', 'nn_arch', 'no_skip', 'normalization', 'ord_params', 'patch_stride',
+                'patch_weight', 'precision', 'sample_axis', 'temperature_map')
+
+PATCH_SIZES = (32, 48, 64, 96, 128, 160, 192, 256)
+
+_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+class TunePlan(NamedTuple):
+    """
+    prediction options chosen by autotune
+
+    Args:
+        batch_size (int): number of slices (2d) or patches (3d) run through the network at once
+        patch_size (int): patch size (cubed) for 3d networks, 0 uses the whole image
+        patch_stride (Union[int,str]): step between patches (auto derives it from the receptive field)
+        voxels_per_sec (float): measured throughput (synthesized voxels per second)
+        peak_memory (int): estimated peak memory (in bytes) of synthesizing an image
+    """
+    batch_size: int
+    patch_size: int
+    patch_stride: Optional[Union[int, str]]
+    voxels_per_sec: float
+    peak_memory: int
+
+
+def parse_memory(size:Union[int,float,str]) -> int:
+    """ memory size in bytes from a number of megabytes or a string with a unit, e.g., 512M or 8G """
+    if isinstance(size, (int, float)): return int(size * _UNITS['M'])
+    s = str(size).strip().upper().rstrip('B')
+    try:
+        return int(float(s[:-1]) * _UNITS[s[-1]]) if s and s[-1] in _UNITS else int(float(s) * _UNITS['M'])
+    except ValueError:
+        raise SynthNNError(f'Invalid memory size: {size}. Expected megabytes or a size with a unit (e.g., 8G).')
+
+
+def available_memory(device:torch.device) -> int:
+    """ free memory (in bytes) on the gpu, or the available system memory for the cpu """
+    if device.type == 'cuda': return torch.cuda.mem_get_info(device)[0]
+    try:
+        with open('/proc/meminfo') as f:
+            return next(int(l.split()[1]) * 1024 for l in f if l.startswith('MemAvailable:'))
+    except (OSError, StopIteration):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def _malloc_trim():
+    """ return freed heap memory to the os (glibc only), so that the rss grows with memory that is reused """
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _proc_status(field:str) -> int:
+    with open('/proc/self/status') as f:
+        return next(int(l.split()[1]) * 1024 for l in f if l.startswith(field + ':'))
+
+
+class MemoryProbe:
+    """
+    context manager which measures the peak memory (in bytes, as the peak attribute) allocated within it,
+    using the CUDA allocator statistics on the gpu, and on the cpu the peak resident set size (which is reset
+    through /proc/self/clear_refs on linux) or, where that is not available, tracemalloc (which only sees
+    allocations made through python, e.g., numpy, and not those made by pytorch)
+    """
+    def __init__(self, device:torch.device):
+        self.device = device
+        self.peak = 0
+        self._mode = None
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            self._mode = 'cuda'
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._base = torch.cuda.memory_allocated(self.device)
+        else:
+            try:
+                _malloc_trim()
+                with open('/proc/self/clear_refs', 'w') as f: f.write('5')  # reset the peak rss (VmHWM)
+                self._mode, self._base = 'rss', _proc_status('VmRSS')
+            except (OSError, StopIteration):
+                self._mode, self._base = 'tracemalloc', 0
+                tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._mode == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device) - self._base
+        elif self._mode == 'rss':
+            self.peak = _proc_status('VmHWM') - self._base
+        else:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return False
+
+
+def batch_memory(predictor:Predictor, shape:Tuple[int,...]) -> int:
+    """ peak memory (in bytes, see MemoryProbe) of running a batch of a given shape through a predictor's network """
+    x = torch.zeros(shape)
+    with inference_mode():
+        with MemoryProbe(predictor.device) as probe:
+            predictor._sample(x)
+    return probe.peak
+
+
+def _probe(predictor:Predictor, shape:Tuple[int,...], repeats:int) -> Optional[Tuple[float, int]]:
+    """ best time (in seconds) and peak memory of running a batch of the given shape, None if out of memory """
+    x = torch.randn(shape)
+    try:
+        with inference_mode():
+            with MemoryProbe(predictor.device) as probe:
+                predictor._sample(x)  # the first run also warms up (e.g., oneDNN primitive creation, cudnn benchmark)
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                predictor._sample(x)
+                times.append(time.perf_counter() - start)
+    except RuntimeError as e:  # includes torch.cuda.OutOfMemoryError
+        if 'out of memory' not in str(e).lower(): raise
+        return None
+    finally:
+        del x
+        if predictor.device.type == 'cuda': torch.cuda.empty_cache()
+    return min(times), probe.peak
+
+
+def _batch_sizes(n:int, max_batch:int) -> Sequence[int]:
+    return [2 ** i for i in range(int(math.log2(max(min(n, max_batch), 1))) + 1)]
+
+
+def autotune(make_predictor:Callable[..., Predictor], shape:Tuple[int,...], memory_budget:int, max_batch:int=256,
+             patch_sizes:Sequence[int]=PATCH_SIZES, repeats:int=2,
+             patch_stride:Optional[Union[int,str]]=None) -> TunePlan:
+    """
+    find the prediction options which synthesize an image of a given shape the fastest within a memory budget
+
+    2d networks are probed with increasing batch sizes (powers of two up to the number of slices) and 3d networks
+    with the whole image and with increasing patch sizes (each with increasing batch sizes), until a trial exceeds
+    the budget; the memory of a trial is the measured peak memory of a forward pass plus an estimate of the memory
+    held by the image and the output, and the speed of a trial is the measured time per batch times the number of
+    batches needed for the image (so the overlap between patches is accounted for)
+
+    Args:
+        make_predictor (Callable): function which creates a predictor given batch_size, patch_size,
+            and patch_stride keyword arguments (e.g., a partial of Predictor with the other options set)
+        shape (Tuple[int,...]): shape of the images to synthesize ([C,H,W,D])
+        memory_budget (int): maximum memory (in bytes) to use
+        max_batch (int): maximum batch size to try
+        patch_sizes (Sequence[int]): patch sizes to try for 3d networks (those larger than the image are skipped)
+        repeats (int): number of timed runs per trial (the best is used)
+        patch_stride (Union[int,str]): configured step between patches (an integer stride is capped at each patch
+            size), where patch sizes whose stride is below min_patch_stride are skipped [Default=patch_size//2]
+
+    Returns:
+        plan (TunePlan): fastest options within the budget
+    """
+    predictor = make_predictor(batch_size=1, patch_size=0, patch_stride=None)
+    n_input, spatial = shape[0], tuple(shape[1:])
+    n_voxels = int(np.prod(spatial))
+    n_out = len(predictor.stats) * predictor.n_output
+    fixed = 2 * 4 * n_voxels * (n_input + n_out)  # float32 image and output (and a copy of each, e.g., padding)
+    trials = []
+
+    def trial(batch_size, patch_size, patch_stride, batch_shape, n_batches):
+        try:
+            p = make_predictor(batch_size=batch_size, patch_size=patch_size, patch_stride=patch_stride)
+        except SynthNNError:
+            return False
+        result = _probe(p, batch_shape, repeats)
+        if result is None or fixed + result[1] > memory_budget:
+            logger.debug(f'Trial (batch size {batch_size}, patch size {patch_size}) exceeds the memory budget')
+            return False
+        t, peak = result
+        trials.append(TunePlan(batch_size, patch_size, p.patch_stride if patch_size > 0 else None,
+                               n_voxels / (n_batches * t), fixed + peak))
+        logger.debug(f'Trial: {trials[-1]}')
+        return True
+
+    if not predictor.net3d:
+        axis = predictor.sample_axis
+        n_slices, slice_shape = spatial[axis], spatial[:axis] + spatial[axis+1:]
+        for bs in _batch_sizes(n_slices, max_batch):
+            if not trial(bs, 0, None, (bs, n_input) + slice_shape, math.ceil(n_slices / bs)): break
+    else:
+        for psz in (p for p in patch_sizes if p < max(spatial)):
+            stride = min(patch_stride, psz) if isinstance(patch_stride, int) else patch_stride
+            p = make_predictor(batch_size=1, patch_size=psz, patch_stride=stride)
+            plan = get_patch_plan(spatial, psz, p.patch_stride, p.patch_weight)
+            if plan.stride < min_patch_stride(psz):  # too many patches to be worth timing
+                logger.debug(f'Skipping patch size {psz} with a patch stride of {plan.stride}')
+                continue
+            n_patches = plan.n_patches
+            fits = False
+            for bs in _batch_sizes(n_patches, max_batch):
+                if not trial(bs, psz, stride, (bs, n_input) + (psz,) * 3, math.ceil(n_patches / bs)): break
+                fits = True
+            if not fits: break  # larger patches (and the whole image) will not fit either
+        else:
+            trial(1, 0, None, (1, n_input) + spatial, 1)
+    if not trials:
+        raise SynthNNError(f'No prediction options fit in the memory budget ({memory_budget / (1 << 20):.0f} MB) '
+                           f'for an image of shape {shape}.')
+    return max(trials, key=lambda tp: tp.voxels_per_sec)
+
+
+def plan_key(config:dict, shape:Tuple[int,...], device:torch.device) -> str:
+    """ key of a tuned plan for a (flattened) config, input shape, device, and memory budget """
+    key = {k: config.get(k) for k in PLAN_OPTIONS}
+    key.update(shape=list(shape), device=str(device), torch=torch.__version__, threads=torch.get_num_threads(),
+               memory_budget=config.get('memory_budget'), workers=config.get('workers'))
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PlanCache:
+    """
+    tuned plans stored in a JSON file (keyed by plan_key), so later runs skip probing
+
+    Args:
+        fn (str): path to the cache file (created when a plan is first stored)
+    """
+    def __init__(self, fn:str):
+        self.fn = fn
+
+    def _read(self) -> dict:
+        try:
+            with open(self.fn) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key:str) -> Optional[TunePlan]:
+        plan = self._read().get(key)
+        return TunePlan(**plan) if plan is not None else None
+
+    def put(self, key:str, plan:TunePlan):
+        plans = self._read()
+        plans[key] = plan._asdict()
+        tmp_fn = f'{self.fn}.{os.getpid()}.tmp'  # write then rename, so concurrent readers never see a partial file
+        with open(tmp_fn, 'w') as f:
+            json.dump(plans, f, indent=2, sort_keys=True)
+        os.replace(tmp_fn, self.fn)
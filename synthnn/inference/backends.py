@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.inference.backends
+
+export trained networks to TorchScript or ONNX and run the exported
+networks in place of the (eager) pytorch model for prediction
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['BACKENDS',
+           'example_input',
+           'export_onnx',
+           'export_torchscript',
+           'exported_fn',
+           'load_backend',
+           'OnnxRuntimeModel',
+           'TorchScriptModel']
+
+import json
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+from ..errors import SynthNNError
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('eager', 'torchscript', 'onnxruntime')
+
+# the prediction options fixed when a network is exported are stored with it (under this key) and checked when it is loaded
+METADATA_KEY = 'synthnn'
+
+
+class _Predict(nn.Module):
+    """ wrap the predict method of a network as forward, since only forward is exported """
+    def __init__(self, model:nn.Module, temperature_map:bool=False):
+        super().__init__()
+        self.model = model
+        self.temperature_map = temperature_map
+
+    def forward(self, x:torch.Tensor) -> torch.Tensor:
+        return self.model.predict(x, self.temperature_map)
+
+
+def example_input(args, batch_size:int=1) -> torch.Tensor:
+    """ example input (i.e., for tracing) of the shape the network expects given a (flattened) config """
+    size = args.patch_size or 2 ** ((args.n_layers or 0) + 2)  # whole images are downsampled n_layers + 1 times in unet
+    return torch.randn((batch_size, args.n_input) + (size,) * (3 if args.net3d else 2))
+
+
+def exported_fn(args, backend:str) -> str:
+    """ filename of the exported network for a backend given a (flattened) config """
+    if args.get('exported_model'): return args.exported_model
+    ext = {'torchscript': '.ts', 'onnxruntime': '.onnx'}[backend]
+    return os.path.splitext(args.trained_model)[0] + ext
+
+
+def export_torchscript(model:nn.Module, example:torch.Tensor, fn:str, method:str='trace',
+                       temperature_map:bool=False) -> torch.jit.ScriptModule:
+    """
+    export the predict method of a network to TorchScript, either by tracing it on an example input
+    (shapes used for resizing are recorded dynamically, so other image sizes work) or by compiling it,
+    where temperature_map is stored with the network (see load_backend)
+    """
+    model = model.eval()
+    with torch.no_grad():
+        if method == 'trace':
+            ts = torch.jit.trace(_Predict(model, temperature_map).eval(), example, check_trace=False)
+        elif method == 'script':  # forward is compiled, which is the same as predict without ordinal regression
+            if getattr(model, 'ord_params', None) is not None:
+                raise SynthNNError('Networks with ordinal regression can only be exported by tracing.')
+            try:
+                ts = torch.jit.script(model)
+            except Exception as e:
+                raise SynthNNError(f'Network could not be compiled with torch.jit.script (use trace instead): {e}')
+        else:
+            raise SynthNNError(f'Invalid TorchScript export method: {method}. {{trace, script}} are the only supported options.')
+    ts = torch.jit.freeze(ts)
+    ts.save(fn, _extra_files={f'{METADATA_KEY}.json': json.dumps(dict(temperature_map=temperature_map))})
+    return ts
+
+
+def export_onnx(model:nn.Module, example:torch.Tensor, fn:str, opset:int=17, temperature_map:bool=False):
+    """ export the predict method of a network to an ONNX graph with dynamic batch and spatial axes, where
+    temperature_map is stored in the metadata of the graph (see load_backend) """
+    model = _Predict(model.eval(), temperature_map).eval()
+    axes = {i: n for i, n in enumerate(('batch', 'channel', 'x', 'y', 'z')[:example.ndim]) if n != 'channel'}
+    kwargs = dict(input_names=['input'], output_names=['output'], dynamic_axes={'input': axes, 'output': axes},
+                  opset_version=opset)
+    with torch.no_grad():
+        try:
+            torch.onnx.export(model, example, fn, dynamo=False, **kwargs)
+        except TypeError:  # older versions of pytorch only have the (torchscript-based) exporter used above
+            torch.onnx.export(model, example, fn, **kwargs)
+    import onnx
+    graph = onnx.load(fn)
+    onnx.helper.set_model_props(graph, {METADATA_KEY: json.dumps(dict(temperature_map=temperature_map))})
+    onnx.save(graph, fn)
+
+
+class TorchScriptModel:
+    """
+    exported TorchScript network with the interface of a synthnn network used for prediction
+
+    Args:
+        fn (str): path to the exported network (see export_torchscript)
+        n_input (int): number of input channels
+        n_output (int): number of output channels
+        is_3d (bool): network is 3d
+        device (torch.device): device to run the network on
+    """
+    def __init__(self, fn:str, n_input:int, n_output:int, is_3d:bool, device:Optional[torch.device]=None):
+        self.device = device or torch.device('cpu')
+        extra_files = {f'{METADATA_KEY}.json': ''}
+        self.module = torch.jit.load(fn, map_location=self.device, _extra_files=extra_files)
+        self.n_input, self.n_output, self.is_3d = n_input, n_output, is_3d
+        self.metadata = json.loads(extra_files[f'{METADATA_KEY}.json'] or '{}')  # empty if exported by older versions
+
+    def eval(self):
+        return self
+
+    def predict(self, x:torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        return self.module(x.to(self.device))
+
+
+class OnnxRuntimeModel:
+    """
+    exported ONNX network run with onnxruntime, with the interface of a synthnn network used for prediction
+
+    Args:
+        fn (str): path to the exported network (see export_onnx)
+        n_input (int): number of input channels
+        n_output (int): number of output channels
+        is_3d (bool): network is 3d
+        device (torch.device): device to run the network on (uses the CUDA provider on gpu if available)
+        n_threads (int): number of intra-op threads [Default=chosen by onnxruntime]
+    """
+    def __init__(self, fn:str, n_input:int, n_output:int, is_3d:bool, device:Optional[torch.device]=None,
+                 n_threads:Optional[int]=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise SynthNNError('The onnxruntime backend requires the package `onnxruntime`.')
+        self.device = device or torch.device('cpu')
+        opts = ort.SessionOptions()
+        if n_threads is not None: opts.intra_op_num_threads = n_threads
+        providers = ['CPUExecutionProvider']
+        if self.device.type == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(fn, opts, providers=providers)
+        self.n_input, self.n_output, self.is_3d = n_input, n_output, is_3d
+        self.metadata = json.loads(self.session.get_modelmeta().custom_metadata_map.get(METADATA_KEY, '{}'))
+
+    def eval(self):
+        return self
+
+    def predict(self, x:torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        x = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {'input': x})[0])
+
+
+def load_backend(args, device:torch.device, backend:Optional[str]=None):
+    """
+    load the exported network for a (non-eager) backend given a (flattened) config, where the options fixed
+    at export (i.e., temperature_map) must match the config, since they cannot be changed after export
+    """
+    backend = backend or args.backend
+    if backend not in BACKENDS[1:]:
+        raise SynthNNError(f'Invalid backend: {backend}. {{{", ".join(BACKENDS)}}} are the only supported options.')
+    fn = exported_fn(args, backend)
+    if not os.path.isfile(fn):
+        raise SynthNNError(f'Exported network for the {backend} backend not found: {fn} (see nn-export).')
+    if backend == 'torchscript':
+        model = TorchScriptModel(fn, args.n_input, args.n_output, args.net3d, device)
+    else:
+        model = OnnxRuntimeModel(fn, args.n_input, args.n_output, args.net3d, device, args.get('threads'))
+    temperature_map = bool(args.get('temperature_map'))
+    if 'temperature_map' not in model.metadata:
+        logger.warning(f'{fn} does not record the options it was exported with, temperature_map={temperature_map} '
+                       f'cannot be checked (re-export it with nn-export).')
+    elif model.metadata['temperature_map'] != temperature_map:
+        raise SynthNNError(f'{fn} was exported with temperature_map={model.metadata["temperature_map"]}, but the '
+                           f'config sets temperature_map={temperature_map}; re-export it with nn-export.')
+    return model
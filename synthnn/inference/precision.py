@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.inference.precision
+
+run trained networks at reduced precision on the cpu (bfloat16 autocast,
+dynamic int8, or calibrated static int8 quantization) and measure how much
+the output deviates from the full precision (float32) output
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['PRECISIONS',
+           'precision_report',
+           'reduce_precision',
+           'ReducedPrecisionModel']
+
+import copy
+import logging
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+from ..errors import SynthNNError
+from ..models.vae import VAE
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ('fp32', 'bf16', 'dynamic_int8', 'static_int8')
+
+
+class _Forward(nn.Module):
+    """ forward with only the input as argument, so that the network can be symbolically traced (for FX) """
+    def __init__(self, model:nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x:torch.Tensor) -> torch.Tensor:
+        return self.model(x)
+
+
+class ReducedPrecisionModel(nn.Module):
+    """
+    network run at reduced precision with the interface of a synthnn network used for prediction
+
+    Args:
+        model (nn.Module): network whose predict method is used (and whose attributes are kept)
+        module (nn.Module): module which replaces predict (e.g., a quantized copy of the network) [Default=None]
+        autocast_dtype (torch.dtype): run predict under autocast with this data type [Default=None]
+    """
+    def __init__(self, model:nn.Module, module:Optional[nn.Module]=None, autocast_dtype:Optional[torch.dtype]=None):
+        super().__init__()
+        self.model = model
+        self.module = module
+        self.autocast_dtype = autocast_dtype
+        self.n_input, self.n_output, self.is_3d = model.n_input, model.n_output, model.is_3d
+
+    @property
+    def receptive_field(self) -> int:
+        return self.model.receptive_field
+
+    def predict(self, x:torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        if self.module is not None: return self.module(x)
+        if self.autocast_dtype is None: return self.model.predict(x, *args, **kwargs)
+        with torch.autocast(x.device.type, dtype=self.autocast_dtype):
+            y = self.model.predict(x, *args, **kwargs)
+        return y.float()
+
+
+def reduce_precision(model:nn.Module, precision:str, calibrate:Optional[Callable[[nn.Module], None]]=None) -> nn.Module:
+    """
+    convert a (trained, eval mode) network to run at reduced precision on the cpu
+
+    Args:
+        model (nn.Module): network to convert (it is not modified)
+        precision (str): one of fp32 (the network is returned unchanged), bf16 (autocast to bfloat16),
+            dynamic_int8 (int8 weights with activations quantized on the fly, which pytorch only
+            supports for linear layers, i.e., the vae), or static_int8 (int8 weights and activations,
+            where the activation ranges are calibrated beforehand)
+        calibrate (Callable): function which runs the given network (with the synthnn network interface)
+            on calibration data, required for static_int8
+
+    Returns:
+        model (nn.Module): network with the synthnn network interface (i.e., predict, n_input, etc.)
+    """
+    if precision not in PRECISIONS:
+        raise SynthNNError(f'Invalid precision: {precision}. {{{", ".join(PRECISIONS)}}} are the only supported options.')
+    if precision == 'fp32': return model
+    if precision == 'bf16': return ReducedPrecisionModel(model, autocast_dtype=torch.bfloat16)
+    from torch.ao import quantization as tq
+    if precision == 'dynamic_int8':
+        qmodel = tq.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+        if not any(isinstance(m, nn.Linear) for m in model.modules()):
+            logger.warning('Dynamic int8 quantization only applies to linear layers, which this network does not have '
+                           '(use static_int8 to quantize convolutional layers).')
+        return ReducedPrecisionModel(qmodel)
+    if getattr(model, 'ord_params', None) is not None or isinstance(model, VAE):
+        raise SynthNNError('Static int8 quantization is not supported for ordinal regression networks or the VAE.')
+    if calibrate is None: raise SynthNNError('Static int8 quantization requires calibration data.')
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    example = torch.randn((1, model.n_input) + (16,) * (3 if model.is_3d else 2))
+    qconfig = tq.get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(_Forward(copy.deepcopy(model)).eval(), qconfig, (example,))
+    calibrate(ReducedPrecisionModel(model, prepared))  # observers record the range of the activations
+    return ReducedPrecisionModel(model, convert_fx(prepared))
+
+
+def precision_report(reference:Callable[[np.ndarray], np.ndarray], candidate:Callable[[np.ndarray], np.ndarray],
+                     img:np.ndarray) -> dict:
+    """
+    maximum and mean absolute deviation of the output of a (reduced precision)
+    predict function from the output of a reference (full precision) predict function
+    """
+    dev = np.abs(candidate(img).astype(np.float64) - reference(img))
+    return {'max_abs_dev': float(dev.max()), 'mean_abs_dev': float(dev.mean())}
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.inference.predictor
+
+synthesize images held in memory (numpy arrays or torch tensors)
+with a trained network, i.e., without reading or writing files
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['Predictor']
+
+import logging
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from torch import nn
+
+from ..errors import SynthNNError
+from ..models.memory_format import channels_last_format, to_channels_last
+from ..util.exec import AttrDict, get_device, load_config, load_model
+from ..util.foreground import foreground_patches
+from ..util.patch import get_patch_overlap, get_patch_plan, predict_patches, stream_patches
+from ..util.stats import mc_predict
+
+logger = logging.getLogger(__name__)
+
+# inference mode (pytorch >= 1.9) also skips the version counter bookkeeping that no_grad keeps
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+class Predictor:
+    """
+    synthesize images with a trained network, where 2d networks are applied slice-by-slice
+    (along sample_axis) and 3d networks are applied to the whole image or patch-by-patch
+
+    Args:
+        model (nn.Module): trained network (with a predict method, e.g., Unet)
+        net3d (bool): network is 3d [Default=model.is_3d]
+        patch_size (int): patch size (cubed) for patch-based 3d synthesis, 0 uses the whole image [Default=0]
+        patch_stride (Union[int,str]): step between patches, auto derives it from the receptive field (falling back to
+            the default when the receptive field is too large for the patch size) [Default=patch_size//2]
+        patch_weight (str): blending of overlapping patches (uniform, gaussian, or linear) [Default=uniform]
+        batch_size (int): number of slices or patches to run through the network at once [Default=1]
+        sample_axis (int): axis along which to take slices for 2d networks [Default=0]
+        monte_carlo (int): number of samples to draw (for networks with dropout enabled) [Default=1]
+        mc_batch_size (int): maximum number of inputs per forward pass when drawing samples [Default=batch_size]
+        stats (Sequence[str]): statistics of the samples to return (see RunningStats) [Default=('mean',)]
+        temperature_map (bool): output the temperature map (for ordinal regression networks) [Default=False]
+        channels_last (bool): convert the network (in place) and its inputs to the channels-last memory format,
+            which is often faster on the cpu (see to_channels_last) [Default=False]
+        background (float): output value of the slices/patches skipped for having no foreground (see predict) [Default=0]
+        device (torch.device): device to run the network on [Default=device of the model parameters]
+    """
+    def __init__(self, model:nn.Module, net3d:Optional[bool]=None, patch_size:int=0,
+                 patch_stride:Optional[Union[int,str]]=None, patch_weight:str='uniform', batch_size:int=1,
+                 sample_axis:int=0, monte_carlo:int=1, mc_batch_size:Optional[int]=None,
+                 stats:Sequence[str]=('mean',), temperature_map:bool=False, channels_last:bool=False,
+                 background:float=0., device:Optional[torch.device]=None):
+        self.model = (to_channels_last(model) if channels_last else model).eval()
+        self.device = device or next(model.parameters()).device
+        self.net3d = model.is_3d if net3d is None else net3d
+        self.n_input, self.n_output = model.n_input, model.n_output
+        self.patch_size = patch_size or 0
+        self.patch_weight = patch_weight
+        self.batch_size = batch_size
+        self.sample_axis = sample_axis or 0
+        if self.sample_axis not in (0, 1, 2):
+            raise ValueError('sample_axis must be an integer between 0 and 2 inclusive')
+        self.monte_carlo = monte_carlo or 1
+        self.mc_batch_size = mc_batch_size or batch_size
+        self.stats = list(stats)
+        self.temperature_map = temperature_map
+        self.background = background or 0.
+        self.memory_format = channels_last_format(self.net3d) if channels_last else torch.preserve_format
+        self.patch_stride = patch_stride
+        if self.net3d and self.patch_size > 0 and patch_stride == 'auto':
+            if not hasattr(model, 'receptive_field'):
+                raise SynthNNError('Automatic patch stride requires a network with a known receptive field (e.g., unet).')
+            try:
+                self.patch_stride = self.patch_size - get_patch_overlap(model.receptive_field, self.patch_size)
+                logger.info(f'Receptive field: {model.receptive_field}, using a patch stride of {self.patch_stride}')
+            except SynthNNError as e:
+                self.patch_stride = None
+                logger.warning(f'{e} Using the default patch stride ({max(self.patch_size // 2, 1)}) instead.')
+
+    @classmethod
+    def from_config(cls, config:Union[str,dict], device:Optional[torch.device]=None, **kwargs) -> 'Predictor':
+        """
+        create a predictor from a config file (as created by nn-train) or the equivalent (flattened) dictionary,
+        where keyword arguments override the options in the config file
+        """
+        args = load_config(config) if isinstance(config, str) else AttrDict(config)
+        if device is None: device, _, _ = get_device(args, logger)
+        options = dict(net3d=args.net3d, patch_size=args.patch_size, patch_stride=args.get('patch_stride'),
+                       patch_weight=args.get('patch_weight', 'uniform'), batch_size=args.batch_size,
+                       sample_axis=args.sample_axis, monte_carlo=args.get('monte_carlo'),
+                       mc_batch_size=args.get('mc_batch_size'),
+                       stats=args.get('mc_stats') or (['var'] if args.get('calc_var') else ['mean']),
+                       temperature_map=args.get('temperature_map', False),
+                       channels_last=args.get('channels_last', False),
+                       background=args.get('background_value', 0.))
+        options.update(kwargs)
+        model = load_model(args, device, enable_dropout=(options['monte_carlo'] or 1) > 1)
+        return cls(model, device=device, **options)
+
+    @classmethod
+    def from_checkpoint(cls, fn:str, device:Optional[torch.device]=None, **kwargs) -> 'Predictor':
+        """ create a predictor from a whole saved model (i.e., as saved by nn-train without a config file) """
+        device = device or torch.device('cpu')
+        try:
+            model = torch.load(fn, map_location=device, weights_only=False)
+        except TypeError:  # older versions of pytorch do not have (or need) weights_only
+            model = torch.load(fn, map_location=device)
+        if not isinstance(model, nn.Module):
+            raise SynthNNError(f'{fn} does not hold a whole model (only weights?), use Predictor.from_config instead.')
+        if (kwargs.get('monte_carlo') or 1) > 1 and hasattr(model, 'enable_dropout'): model.enable_dropout = True
+        return cls(model, device=device, **kwargs)
+
+    def _forward(self, x:torch.Tensor) -> np.ndarray:
+        x = x.to(self.device, memory_format=self.memory_format)
+        return self.model.predict(x, self.temperature_map).cpu().numpy()
+
+    def _sample(self, x:torch.Tensor) -> np.ndarray:
+        """ statistics of the (monte carlo) samples of the network output stacked in the channel dimension """
+        rs = mc_predict(self._forward, x, self.monte_carlo, self.mc_batch_size, self.stats)
+        return np.concatenate(rs.result(), axis=1)
+
+    def _predict_slices(self, img:Union[np.ndarray, Sequence[np.ndarray]], shape:Tuple[int,...],
+                        mask:Optional[np.ndarray]=None, out:Optional[Sequence[np.ndarray]]=None):
+        axis = self.sample_axis  # axis of each channel ([H,W,D]) along which slices are taken
+        idxs = np.arange(shape[axis])
+        if mask is not None:  # only the slices with foreground are run through the network
+            idxs = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+            logger.info(f'Skipping {shape[axis] - len(idxs)}/{shape[axis]} slices with no foreground')
+        if out is None: out = np.empty((len(self.stats) * self.n_output,) + shape, dtype=np.float32)
+        out_slices = [np.moveaxis(o, axis, 0) for o in out]  # views with the slices in the first dimension
+        if len(idxs) < shape[axis]:
+            skipped = np.ones(shape[axis], dtype=bool)
+            skipped[idxs] = False
+            for o in out_slices: o[skipped] = self.background
+        n, bs = len(idxs), max(min(self.batch_size, len(idxs)), 1)
+        batch = torch.empty((bs, len(img)) + shape[:axis] + shape[axis+1:], dtype=torch.float32)
+        if self.memory_format != torch.preserve_format: batch = batch.contiguous(memory_format=self.memory_format)
+        batch_np = batch.numpy()  # shares memory with the tensor, so filling this fills the batch
+        num_batches = -(-n // bs)
+        for j, i in enumerate(range(0, n, bs), 1):
+            logger.info(f'Starting batch ({j}/{num_batches})')
+            batch_idxs = idxs[i:i+bs]
+            k, start = len(batch_idxs), int(batch_idxs[0])
+            contiguous = batch_idxs[-1] - start + 1 == k
+            for c, channel in enumerate(img):  # only the slab of the batch is read from (e.g., memory-mapped) channels
+                if contiguous:
+                    slab = (slice(None),) * axis + (slice(start, start + k),)
+                    batch_np[:k, c] = np.moveaxis(np.asarray(channel[slab]), axis, 0)
+                else:
+                    for b, s in enumerate(batch_idxs): batch_np[b, c] = np.asarray(channel[(slice(None),) * axis + (int(s),)])
+            predicted = self._sample(batch[:k])
+            for c, o in enumerate(out_slices): o[slice(start, start + k) if contiguous else batch_idxs] = predicted[:, c]
+        return out
+
+    def _predict_patches(self, img:Union[np.ndarray, Sequence[np.ndarray]], shape:Tuple[int,...],
+                         mask:Optional[np.ndarray]=None, out:Optional[Sequence[np.ndarray]]=None):
+        plan = get_patch_plan(shape, self.patch_size, self.patch_stride, self.patch_weight)
+        logger.info(f'Using {plan.n_patches} patches (coverage: {plan.coverage:.0%}, redundancy: {plan.redundancy:.1f}x)')
+        keep = None
+        if mask is not None:  # only the patches with foreground are run through the network
+            keep = foreground_patches(plan, mask)
+            logger.info(f'Skipping {plan.n_patches - int(keep.sum())}/{plan.n_patches} patches with no foreground')
+        if out is None:
+            return predict_patches(self._sample, img, plan, self.batch_size, len(self.stats) * self.n_output,
+                                   self.device, keep, self.background)
+        stream_patches(self._sample, img, plan, self.batch_size, out, self.device, keep, self.background)
+        return out
+
+    def _predict_volume(self, img:np.ndarray) -> np.ndarray:
+        return self._sample(torch.from_numpy(img)[None, ...])[0]  # add (and then remove) empty batch dimension
+
+    def predict(self, img:Union[np.ndarray, torch.Tensor, Sequence[np.ndarray]], mask:Optional[np.ndarray]=None,
+                out:Optional[Sequence[np.ndarray]]=None) -> Union[np.ndarray, Sequence[np.ndarray]]:
+        """
+        synthesize an image
+
+        Args:
+            img (Union[np.ndarray, torch.Tensor, Sequence[np.ndarray]]): image with channels first, i.e., [C,H,W,D]
+                (or [H,W,D] for networks with a single input channel), or a sequence of the channels ([H,W,D] each),
+                which 2d networks (and 3d networks given out) only read slab-by-slab (e.g., memory-mapped volumes,
+                see lazy_nii)
+            mask (np.ndarray): foreground mask [H,W,D] (see foreground_mask), where the slices (2d) or patches (3d)
+                without foreground are skipped and set to the background value, so that the output is unchanged
+                inside the mask (a 3d network applied to the whole image runs on the whole image regardless)
+            out (Sequence[np.ndarray]): output channels ([H,W,D] each, one for each statistic and output channel)
+                to write the synthesized image into, e.g., memory-mapped files for images which do not fit in memory,
+                where 3d patches are then run in slab order (see stream_patches) [Default=return a new array]
+
+        Returns:
+            out_img (Union[np.ndarray, Sequence[np.ndarray]]): synthesized image [n_output,H,W,D], or
+                [n_stats,n_output,H,W,D] if more than one statistic of the (monte carlo) samples is requested,
+                or out (if given)
+        """
+        streamed = out is not None and (not self.net3d or self.patch_size > 0)  # the whole image need not be held
+        if isinstance(img, (list, tuple)):
+            shapes = {tuple(c.shape) for c in img}
+            if len(img) != self.n_input or len(shapes) != 1 or len(next(iter(shapes))) != 3:
+                raise SynthNNError(f'Expected {self.n_input} channel(s) of the same shape [H,W,D], '
+                                   f'got channels of shape(s) {sorted(shapes)}.')
+            shape = next(iter(shapes))
+            if self.net3d and not streamed:  # the whole image is needed
+                img = np.stack([np.asarray(c, dtype=np.float32) for c in img])
+        else:
+            if isinstance(img, torch.Tensor): img = img.detach().cpu().numpy()
+            img = np.asarray(img, dtype=np.float32)
+            if img.ndim == 3: img = img[np.newaxis, ...]
+            if img.ndim != 4 or img.shape[0] != self.n_input:
+                raise SynthNNError(f'Expected an image with {self.n_input} channel(s) of shape [C,H,W,D] '
+                                   f'(or [H,W,D]), got an array of shape {img.shape}.')
+            shape = img.shape[1:]
+        if mask is not None:
+            mask = np.asarray(mask).astype(bool, copy=False)
+            if mask.shape != tuple(shape):
+                raise SynthNNError(f'Mask shape {mask.shape} does not match the image shape {tuple(shape)}.')
+        if out is not None and (len(out) != len(self.stats) * self.n_output or any(o.shape != shape for o in out)):
+            raise SynthNNError(f'Expected {len(self.stats) * self.n_output} output channel(s) of shape {shape}.')
+        with inference_mode():
+            if self.net3d and self.patch_size > 0:
+                out_img = self._predict_patches(img, shape, mask, out)
+            elif self.net3d:
+                out_img = self._predict_volume(img)
+            else:
+                out_img = self._predict_slices(img, shape, mask, out)
+        if out is not None:
+            if not streamed:
+                for o, oi in zip(out, out_img): o[...] = oi
+            return out
+        out_img = out_img.reshape((len(self.stats), self.n_output) + shape)
+        return out_img if len(self.stats) > 1 else out_img[0]
@@ -1,2 +1,4 @@
 from .unet import *
 from .nconvnet import *
+from .optimize import *
+from .memory_format import *
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.models.memory_format
+
+convert networks (and their inputs) to the channels-last memory format,
+i.e., NHWC for 2d networks and NDHWC for 3d networks, which the cpu
+(oneDNN) and tensor core convolution kernels are fastest with
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['channels_last_format',
+           'is_channels_last',
+           'to_channels_last']
+
+import logging
+
+import torch
+from torch import nn
+
+from ..errors import SynthNNError
+
+logger = logging.getLogger(__name__)
+
+
+def channels_last_format(is_3d:bool) -> torch.memory_format:
+    """ channels-last memory format for 2d (NHWC) or 3d (NDHWC) tensors """
+    return torch.channels_last_3d if is_3d else torch.channels_last
+
+
+def is_channels_last(model:nn.Module) -> bool:
+    """ network (or a network it wraps, e.g., a ReducedPrecisionModel) has been converted with to_channels_last """
+    return any(getattr(m, 'memory_format', torch.contiguous_format) != torch.contiguous_format for m in model.modules())
+
+
+def _keep_format(module:nn.Module, inputs:tuple, output):
+    """
+    forward hook which returns the output in the memory format of the input, since some modules
+    (e.g., instance norm) return contiguous (NCHW) outputs regardless of the format of the input
+    """
+    if not inputs or not isinstance(inputs[0], torch.Tensor) or not isinstance(output, torch.Tensor): return None
+    x = inputs[0]
+    if x.ndim not in (4, 5) or output.ndim != x.ndim: return None
+    fmt = channels_last_format(x.ndim == 5)
+    if x.is_contiguous() or not x.is_contiguous(memory_format=fmt) or output.is_contiguous(memory_format=fmt): return None
+    return output.contiguous(memory_format=fmt)
+
+
+def to_channels_last(model:nn.Module) -> nn.Module:
+    """
+    convert a network to the channels-last memory format (in place), so that its activations stay channels-last
+    through the network when its input is channels-last (see channels_last_format), i.e., the convolutions do not
+    convert their input and output, modules which would return contiguous outputs (e.g., instance norm) return
+    channels-last outputs instead, and the upsampling and concatenation in unet keep the format
+
+    Args:
+        model (nn.Module): network (with the is_3d attribute, e.g., Unet)
+
+    Returns:
+        model (nn.Module): the converted network (the state dict is unchanged, so it can be saved as usual)
+    """
+    if not isinstance(model, nn.Module):
+        raise SynthNNError('The channels-last memory format is only supported for (eager) pytorch networks.')
+    if is_channels_last(model): return model
+    fmt = channels_last_format(model.is_3d)
+    model.to(memory_format=fmt)
+    n_hooks = 0
+    for m in model.modules():
+        if hasattr(m, 'memory_format'): m.memory_format = fmt  # e.g., unet, which converts interpolated/concatenated tensors
+        if next(m.children(), None) is None and not isinstance(m, (nn.Conv2d, nn.Conv3d)):
+            m.register_forward_hook(_keep_format)
+            n_hooks += 1
+    model.memory_format = fmt
+    logger.debug(f'Converted network to {fmt} ({n_hooks} modules keep the format of their input)')
+    return model
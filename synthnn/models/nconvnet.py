@@ -42,7 +42,7 @@ class SimpleConvNet(torch.nn.Module):
             nn.Conv3d(n_input, n_output, ksz) if is_3d else nn.Conv2d(n_input, n_output, ksz),
             nn.ReLU(),
             nn.InstanceNorm3d(n_output, affine=True) if is_3d else nn.InstanceNorm2d(n_output, affine=True),
-            nn.Dropout3d(dropout_p) if is_3d else nn.Dropout2d(dropout_p)) for ksz in self.kernel_sz])
+            nn.Dropout3d(float(dropout_p)) if is_3d else nn.Dropout2d(float(dropout_p))) for ksz in self.kernel_sz])
 
     def forward(self, x:torch.Tensor) -> torch.Tensor:
         for l in self.layers:
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.models.optimize
+
+simplify a trained network for inference, i.e., fold padding modules into
+the convolutions, fuse batch norm into the preceding convolution, and remove
+modules which do nothing in eval mode
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['optimize_for_inference']
+
+import copy
+import logging
+from typing import Optional
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+logger = logging.getLogger(__name__)
+
+_PAD_MODES = ((nn.ReplicationPad1d, nn.ReplicationPad2d, nn.ReplicationPad3d), 'replicate'), \
+             ((nn.ReflectionPad1d, nn.ReflectionPad2d, nn.ReflectionPad3d), 'reflect'), \
+             ((nn.ZeroPad2d, nn.ConstantPad1d, nn.ConstantPad2d, nn.ConstantPad3d), 'zeros')
+_CONVS = (nn.Conv1d, nn.Conv2d, nn.Conv3d)
+_BATCH_NORMS = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)
+_DROPOUTS = (nn.Dropout, nn.Dropout2d, nn.Dropout3d, nn.AlphaDropout)
+_NORMS = _BATCH_NORMS + (nn.InstanceNorm1d, nn.InstanceNorm2d, nn.InstanceNorm3d, nn.GroupNorm, nn.LayerNorm)
+
+
+def _fold_pad(pad:nn.Module, conv:nn.Module) -> Optional[nn.Module]:
+    """ convolution with the padding done by its padding_mode (or None if the padding cannot be folded) """
+    if not isinstance(conv, _CONVS) or conv.padding_mode != 'zeros' or any(p != 0 for p in conv.padding): return None
+    mode = next((m for types, m in _PAD_MODES if isinstance(pad, types)), None)
+    if mode is None or (mode == 'zeros' and getattr(pad, 'value', 0) != 0): return None
+    p = pad.padding if isinstance(pad.padding, tuple) else (pad.padding,)
+    if len(set(p)) != 1 or len(p) != 2 * conv.weight.ndim - 4: return None  # padding must be symmetric
+    folded = conv.__class__(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, p[0], conv.dilation,
+                            conv.groups, conv.bias is not None, mode if p[0] > 0 else 'zeros')
+    folded.load_state_dict(conv.state_dict())
+    return folded.to(conv.weight.device).eval()
+
+
+def _is_noop(m:nn.Module) -> bool:
+    return isinstance(m, (nn.Identity,) + _DROPOUTS) or (isinstance(m, nn.LeakyReLU) and m.negative_slope == 1.)
+
+
+def _optimize_seq(seq:nn.Sequential, fold_padding:bool=True) -> nn.Module:
+    mods = []
+    for m in seq:
+        if _is_noop(m): continue
+        if fold_padding and mods and isinstance(m, _CONVS) and not isinstance(mods[-1], _CONVS):
+            folded = _fold_pad(mods[-1], m)
+            if folded is not None: mods[-1] = folded; continue
+        if mods and isinstance(m, _BATCH_NORMS) and isinstance(mods[-1], _CONVS) and m.track_running_stats:
+            mods[-1] = fuse_conv_bn_eval(mods[-1], m); continue
+        if mods and isinstance(mods[-1], _CONVS + _NORMS) and hasattr(m, 'inplace'):
+            m.inplace = True  # the input is a new tensor (the output of the previous module), so it can be overwritten
+        mods.append(m)
+    return mods[0] if len(mods) == 1 else nn.Sequential(*mods) if mods else nn.Identity()
+
+
+def _optimize(module:nn.Module, fold_padding:bool=True) -> nn.Module:
+    for name, child in list(module._modules.items()):  # children first, so nested sequentials are simplified first
+        if child is not None: module._modules[name] = _optimize(child, fold_padding)
+    return _optimize_seq(module, fold_padding) if isinstance(module, nn.Sequential) else module
+
+
+def optimize_for_inference(model:nn.Module, inplace:bool=False, fold_padding:bool=True) -> nn.Module:
+    """
+    simplify a (trained) network for inference, where the output is unchanged (up to floating point error)
+
+    padding modules followed by a convolution (e.g., ReplicationPad3d then Conv3d in unet) are folded into
+    the convolution's padding_mode, batch norm layers following a convolution are fused into its weights,
+    activations following a convolution or normalization are done in-place, and identity modules (e.g.,
+    LeakyReLU(1), which is the linear activation, and dropout modules in eval mode) are removed; note that
+    the network is put in eval mode and its state dict keys change
+
+    Args:
+        model (nn.Module): network to optimize
+        inplace (bool): modify the network in place, otherwise a copy is optimized
+        fold_padding (bool): fold padding modules into the convolutions (quantized convolutions,
+            see reduce_precision, only support zero padding, so disable this before quantizing)
+
+    Returns:
+        model (nn.Module): optimized network (of the same class, so predict etc. still work)
+    """
+    if not inplace: model = copy.deepcopy(model)
+    model.eval()
+    n_before = sum(1 for _ in model.modules())
+    with torch.no_grad():
+        model = _optimize(model, fold_padding)
+    logger.debug(f'Optimized network for inference ({n_before} -> {sum(1 for _ in model.modules())} modules)')
+    return model
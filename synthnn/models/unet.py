@@ -65,6 +65,8 @@ class Unet(torch.nn.Module):
             from CT Using Synthetic MR Images,” MLMI, vol. 10541, pp. 291–298, 2017.
 
     """
+    memory_format = torch.contiguous_format  # memory format of upsampled/concatenated tensors (see to_channels_last)
+
     def __init__(self, n_layers:int, kernel_size:int=3, dropout_p:float=0, channel_base_power:int=5,
                  add_two_up:bool=False, normalization:str='instance', activation:str='relu', output_activation:str='linear',
                  is_3d:bool=True, interp_mode:str='nearest', enable_dropout:bool=True,
@@ -117,12 +119,12 @@ class Unet(torch.nn.Module):
             x = self._dropout(self._down(dout[-1]))
         x = self.upsampconvs[0](self._dropout(self._up(self.bridge(x), dout[-1].shape[2:])))
         for i, (ul, d) in enumerate(zip(self.up_layers, reversed(dout)), 1):
-            x = ul(torch.cat((x, d), dim=1))
+            x = ul(self._cat(x, d))
             x = self._dropout(self._up(x, dout[-i-1].shape[2:]))
             x = self.upsampconvs[i](x)
         if not return_var:
-            x = self.finish(torch.cat((x, dout[0]), dim=1)) if not isinstance(self.finish,nn.ModuleList) else \
-                self.finish[0](torch.cat((x, dout[0]), dim=1)) / self.finish[1](x)
+            x = self.finish(self._cat(x, dout[0])) if not isinstance(self.finish,nn.ModuleList) else \
+                self.finish[0](self._cat(x, dout[0])) / self.finish[1](x)
         else:
             x = self.finish[1](x)
         return x
@@ -151,9 +153,12 @@ class Unet(torch.nn.Module):
         return y
 
     def _up(self, x:torch.Tensor, sz:Union[Tuple[int,int,int], Tuple[int,int]]) -> torch.Tensor:
-        y = F.interpolate(x, size=sz, mode=self.interp_mode)
+        y = F.interpolate(x, size=sz, mode=self.interp_mode).contiguous(memory_format=self.memory_format)
         return y
 
+    def _cat(self, x:torch.Tensor, y:torch.Tensor) -> torch.Tensor:
+        return torch.cat((x, y), dim=1).contiguous(memory_format=self.memory_format)
+
     def _dropout(self, x:torch.Tensor) -> torch.Tensor:
         x = F.dropout3d(x, self.dropout_p, training=self.enable_dropout) if self.is_3d else \
             F.dropout2d(x, self.dropout_p, training=self.enable_dropout)
@@ -201,6 +206,20 @@ class Unet(torch.nn.Module):
             fc_temp = nn.Sequential(fc_temp_c, nn.Softplus())
             return nn.ModuleList([fc, fc_temp])
 
+    @property
+    def receptive_field(self) -> int:
+        """ receptive field (in voxels along an axis) of an output voxel, following the path in _fwd_skip """
+        k, r, j = self.kernel_sz, 1, 1  # kernel size, receptive field, jump (i.e., cumulative stride)
+        r += 2 * (k - 1) * j  # start block
+        for _ in range(self.n_layers):  # down layers and bridge (each preceded by a max pool)
+            r += j; j *= 2
+            r += 2 * (k - 1) * j
+        j //= 2; r += 2 * j  # first upsampconv (kernel size 3)
+        for _ in range(self.n_layers - 1):  # up layers (each followed by an upsampconv)
+            r += (k + self.a2u - 1 + k - 1) * j
+            j //= 2; r += 2 * j
+        return r
+
     def predict(self, x:torch.Tensor, return_var:bool=False) -> torch.Tensor:
         if self.ord_params is None:
             return self.forward(x)
@@ -235,8 +254,10 @@ class _OrdLoss(nn.Module):
         return y_hat
 
     def forward(self, y:torch.Tensor, yd_hat:torch.Tensor):
-        yd = self._digitize(y)
-        CE = self.ce(yd_hat, yd)
-        y_hat = self.predict(yd_hat)
-        MAE = self.mae(y_hat, y)
+        with torch.autocast(yd_hat.device.type, enabled=False):  # computed in fp32 under mixed precision
+            y, yd_hat = y.float(), yd_hat.float()
+            yd = self._digitize(y)
+            CE = self.ce(yd_hat, yd)
+            y_hat = self.predict(yd_hat)
+            MAE = self.mae(y_hat, y)
         return CE + MAE
@@ -65,7 +65,7 @@ class VAE(Unet):
         for dl in self.down_layers:
             x = dl(x)
             x = self._down(x)
-        x = F.relu(self.fc_bn1(self.fc1(x.view(x.size(0), self.esz))))
+        x = F.relu(self.fc_bn1(self.fc1(x.reshape(x.size(0), self.esz))))
         mu = self.fc21(x)
         logvar = self.fc22(x)
         return mu, logvar
@@ -113,6 +113,8 @@ class VAELoss(nn.Module):
         self.mse_loss = nn.MSELoss(reduction="sum")
 
     def forward(self, x, recon_x, mu, logvar):
-        MSE = self.mse_loss(recon_x, x)
-        KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2)-logvar.exp())
+        with torch.autocast(recon_x.device.type, enabled=False):  # computed in fp32 under mixed precision
+            x, recon_x, mu, logvar = x.float(), recon_x.float(), mu.float(), logvar.float()
+            MSE = self.mse_loss(recon_x, x)
+            KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2)-logvar.exp())
         return MSE + KLD
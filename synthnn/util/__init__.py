@@ -1,3 +1,14 @@
+from .augment import *
+from .cache import *
+from .distributed import *
+from .foreground import *
 from .helper import *
 from .io import *
-from .optim import *
\ No newline at end of file
+from .manifest import *
+from .optim import *
+from .patch import *
+from .pipeline import *
+from .sampler import *
+from .store import *
+from .stats import *
+from .writer import *
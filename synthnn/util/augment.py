@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.augment
+
+data augmentation of whole (collated) batches of 2d or 3d tensors, with
+random parameters drawn per sample, so that augmentation runs on the
+device of the network (and on the intra-op threads of pytorch) instead
+of per sample in the dataloader workers
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['BatchAugment']
+
+import logging
+import math
+from typing import Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+def _uniform(n:int, high:float, device:torch.device, *shape) -> torch.Tensor:
+    """ random values uniformly distributed in [-high, high] """
+    return (2 * torch.rand((n,) + shape, device=device) - 1) * high
+
+
+def _rotation(angles:torch.Tensor) -> torch.Tensor:
+    """ rotation matrices [N,2,2] from angles [N,1] (2d) or [N,3,3] from angles about each axis [N,3] (3d) """
+    c, s = torch.cos(angles), torch.sin(angles)
+    one, zero = torch.ones_like(c[:, 0]), torch.zeros_like(c[:, 0])
+    if angles.shape[1] == 1:
+        return torch.stack((torch.stack((c[:, 0], -s[:, 0]), -1), torch.stack((s[:, 0], c[:, 0]), -1)), 1)
+    def rot(i, j, k):  # rotation in the plane of axes j and k by the i-th angle
+        r = [[None] * 3 for _ in range(3)]
+        for a in range(3):
+            for b in range(3): r[a][b] = one if a == b else zero
+        r[j][j], r[j][k], r[k][j], r[k][k] = c[:, i], -s[:, i], s[:, i], c[:, i]
+        return torch.stack([torch.stack(row, -1) for row in r], 1)
+    return rot(0, 1, 2) @ rot(1, 0, 2) @ rot(2, 0, 1)
+
+
+class BatchAugment:
+    """
+    augment batches of (source, target) tensors ([N,C,H,W] or [N,C,H,W,D]) with the transforms (and options)
+    of niftidataset's get_transforms, where each transform is applied to each sample with its probability:
+
+        affine: rotation (about each axis in 3d), translation, and (isotropic) scaling, applied with the same
+            parameters to the source and target (resampled with bilinear interpolation, zeros outside)
+        flip: flip the last (hflip) and/or second-to-last (vflip) spatial axes of the source and target
+        gamma: gain * sign(x) * |x| ** gamma on the source (tfm_x) and/or target (tfm_y)
+        noise: additive gaussian noise on the source (tfm_x) and/or target (tfm_y)
+
+    Args:
+        prob (Sequence[float]): probability of (affine, flip, gamma, noise)
+        rotate (float): max rotation angle (in degrees)
+        translate (float): max translation (as a fraction of the image size)
+        scale (float): max scale, i.e., scaled by (1-scale, 1+scale)
+        vflip (bool): flip the second-to-last spatial axis
+        hflip (bool): flip the last spatial axis
+        gamma (float): gamma is drawn from (1-gamma, 1+gamma)
+        gain (float): gain is drawn from (1-gain, 1+gain)
+        noise_std (float): standard deviation of the noise
+        tfm_x (bool): apply the intensity transforms (gamma and noise) to the source
+        tfm_y (bool): apply the intensity transforms (gamma and noise) to the target
+    """
+    def __init__(self, prob:Sequence[float], rotate:float=0., translate:Optional[float]=None,
+                 scale:Optional[float]=None, vflip:bool=False, hflip:bool=False, gamma:Optional[float]=None,
+                 gain:Optional[float]=None, noise_std:float=0., tfm_x:bool=True, tfm_y:bool=False):
+        self.p_affine, self.p_flip, self.p_gamma, self.p_noise = prob
+        self.rotate = math.radians(rotate or 0.)
+        self.translate = translate or 0.
+        self.scale = scale or 0.
+        self.vflip, self.hflip = vflip, hflip
+        self.gamma, self.gain = gamma or 0., gain or 0.
+        self.noise_std = noise_std or 0.
+        self.tfm_x, self.tfm_y = tfm_x, tfm_y
+
+    def _select(self, n:int, p:float, device:torch.device) -> torch.Tensor:
+        return torch.rand(n, device=device) < p
+
+    def affine(self, x:torch.Tensor) -> torch.Tensor:
+        """ resample each sample of a batch [N,C,...] with a random affine transform """
+        n, nd, device = x.shape[0], x.ndim - 2, x.device
+        a = _rotation(_uniform(n, self.rotate, device, 1 if nd == 2 else 3))
+        if self.scale > 0: a = a / (1 + _uniform(n, self.scale, device))[:, None, None]
+        # affine_grid uses normalized coordinates (in the order W,H[,D]), so the transform is conjugated
+        # by the image size, i.e., the rotation is in voxels and not distorted for non-square images
+        size = torch.tensor(x.shape[2:][::-1], dtype=x.dtype, device=device)
+        a = a * size[None, None, :] / size[None, :, None]
+        t = 2 * _uniform(n, self.translate, device, nd) if self.translate > 0 else torch.zeros(n, nd, device=device)
+        grid = F.affine_grid(torch.cat((a.to(x.dtype), t[..., None].to(x.dtype)), -1), x.shape, align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    def _intensity(self, x:torch.Tensor) -> torch.Tensor:
+        n, device = x.shape[0], x.device
+        shape = (n,) + (1,) * (x.ndim - 1)
+        if self.p_gamma > 0 and (self.gamma > 0 or self.gain > 0):
+            sel = self._select(n, self.p_gamma, device).view(shape)
+            gamma = (1 + _uniform(n, self.gamma, device)).view(shape)
+            gain = (1 + _uniform(n, self.gain, device)).view(shape)
+            x = torch.where(sel, gain * torch.sign(x) * x.abs() ** gamma, x)
+        if self.p_noise > 0 and self.noise_std > 0:
+            sel = self._select(n, self.p_noise, device).view(shape)
+            x = torch.where(sel, x + self.noise_std * torch.randn_like(x), x)
+        return x
+
+    def __call__(self, src:torch.Tensor, tgt:torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        n, n_src, device = src.shape[0], src.shape[1], src.device
+        use_affine = self.p_affine > 0 and (self.rotate > 0 or self.translate > 0 or self.scale > 0)
+        use_flip = self.p_flip > 0 and (self.hflip or self.vflip)
+        if use_affine or use_flip:
+            x = torch.cat((src, tgt.to(src.dtype)), 1)  # same geometry for the source and target
+            if use_affine:
+                idx = self._select(n, self.p_affine, device).nonzero()[:, 0]
+                if idx.numel() > 0: x = x.index_copy(0, idx, self.affine(x[idx]))
+            if use_flip:
+                shape = (n,) + (1,) * (x.ndim - 1)
+                for flip, dim in ((self.hflip, -1), (self.vflip, -2)):
+                    if flip: x = torch.where(self._select(n, self.p_flip, device).view(shape), x.flip(dim), x)
+            src, tgt = x[:, :n_src], x[:, n_src:].to(tgt.dtype)
+        if self.tfm_x: src = self._intensity(src)
+        if self.tfm_y: tgt = self._intensity(tgt)
+        return src, tgt
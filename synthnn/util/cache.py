@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.cache
+
+cache decoded (i.e., read and decompressed) training volumes, either in
+the memory of each process or in shared memory (as uncompressed .npy
+files memory-mapped by every dataloader worker), so that each volume is
+decoded once instead of once per sample
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['CACHE_MODES',
+           'CachedDataset',
+           'copy_sample',
+           'load_volume',
+           'shm_dir',
+           'VolumeCache']
+
+from collections import OrderedDict
+from glob import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import nibabel as nib
+import numpy as np
+from torch.utils.data import Dataset
+
+from ..errors import SynthNNError
+from .io import glob_nii, glob_tiff
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = ('none', 'memory', 'shared')
+
+CACHE_DTYPES = ('float32', 'float16')
+
+
+def load_volume(fn:str) -> np.ndarray:
+    """ image data of a NIfTI or TIFF file as a float32 array """
+    if fn.lower().endswith(('.tif', '.tiff')):
+        from PIL import Image
+        with Image.open(fn) as img:
+            return np.asarray(img, dtype=np.float32)
+    return nib.load(fn).get_fdata(dtype=np.float32)
+
+
+def copy_sample(sample:Tuple[np.ndarray, ...]) -> Tuple[np.ndarray, ...]:
+    """
+    copy a (e.g., cropped) sample out of a VolumeCache as writable float32 arrays, so that the
+    transforms which follow neither modify the cached volumes nor see their (e.g., float16) dtype
+    """
+    return tuple(np.array(x, dtype=np.float32) for x in sample)
+
+
+def shm_dir() -> str:
+    """ directory backed by shared memory (tmpfs) if available, otherwise the temporary directory """
+    return '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+
+class VolumeCache:
+    """
+    least-recently-used cache of decoded volumes, keyed by their files (and the size and modification time of
+    the files, so changed files are decoded again), where the volumes of a subject are stacked into one array
+
+    in memory mode, each process (e.g., each dataloader worker) holds the volumes it has decoded; in shared mode,
+    the first process to need a volume writes it as an uncompressed .npy file to cache_dir (by default a new
+    directory in /dev/shm, i.e., shared memory) and every process memory-maps it, so the workers share a single
+    read-only copy; the bound applies to each process in memory mode and to cache_dir in shared mode
+
+    Args:
+        mode (str): memory or shared (see CACHE_MODES)
+        dtype (str): dtype of the cached volumes, float16 halves the memory (but overflows above 65504)
+        max_memory (int): maximum size (in bytes) of the cache [Default=unbounded]
+        cache_dir (str): directory for the shared cache, which is kept when given (so later runs reuse it)
+            [Default=a temporary directory in /dev/shm, removed on close]
+        loader (Callable[[str], np.ndarray]): function which reads a volume [Default=load_volume]
+        owner (bool): remove cache_dir on close, e.g., for a temporary directory shared by the processes of
+            distributed training (see shared_tempdir) [Default=only if cache_dir is not given]
+    """
+    def __init__(self, mode:str='memory', dtype:str='float32', max_memory:Optional[int]=None,
+                 cache_dir:Optional[str]=None, loader:Callable[[str], np.ndarray]=load_volume,
+                 owner:Optional[bool]=None):
+        if mode not in CACHE_MODES[1:]:
+            raise SynthNNError(f'Invalid cache mode: {mode}. {{{", ".join(CACHE_MODES[1:])}}} are the only supported options.')
+        if dtype not in CACHE_DTYPES:
+            raise SynthNNError(f'Invalid cache dtype: {dtype}. {{{", ".join(CACHE_DTYPES)}}} are the only supported options.')
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.max_memory = max_memory
+        self.loader = loader
+        self.arrays = OrderedDict()  # key -> array (memory) or memory-mapped array (shared), in lru order
+        self.nbytes = 0
+        self._owner = False
+        self.cache_dir = None
+        if mode == 'shared':
+            if cache_dir is None:
+                cache_dir = tempfile.mkdtemp(prefix='synthnn-cache-', dir=shm_dir())
+                self._owner = True
+            if owner is not None: self._owner = owner
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_dir = cache_dir
+            logger.debug(f'Caching decoded volumes in {cache_dir}')
+
+    def key(self, fns:Sequence[str]) -> str:
+        """ key of the (stacked) volumes of a set of files """
+        files = []
+        for fn in fns:
+            st = os.stat(fn)
+            files.append((os.path.abspath(fn), st.st_size, st.st_mtime_ns))
+        return hashlib.sha1(json.dumps([files, self.dtype.str]).encode()).hexdigest()
+
+    def decode(self, fns:Sequence[str]) -> np.ndarray:
+        """ read the volumes of a set of files, stacked along the first axis in the cache dtype """
+        vols = [self.loader(fn) for fn in fns]
+        if any(v.shape != vols[0].shape for v in vols):
+            raise SynthNNError(f'Images do not have the same shape: {", ".join(f"{fn} {v.shape}" for fn, v in zip(fns, vols))}')
+        x = np.stack(vols)
+        del vols
+        if self.dtype == np.float16 and x.size > 0 and np.abs(x).max() > np.finfo(np.float16).max:
+            raise SynthNNError(f'Intensities of {fns} overflow float16, cache the volumes as float32 instead.')
+        return x.astype(self.dtype, copy=False)
+
+    def get(self, fns:Sequence[str]) -> np.ndarray:
+        """ (read-only in shared mode) stacked volumes [C,...] of a set of files, decoded if not cached """
+        key = self.key(fns)
+        x = self.arrays.get(key)
+        if x is not None:
+            if self.mode == 'memory' or self._touch(key):
+                self.arrays.move_to_end(key)
+                return x
+            self._drop(key)  # evicted (by another process) from the shared cache
+        x = self.decode(fns) if self.mode == 'memory' else self._get_shared(key, fns)
+        self._insert(key, x)
+        return x
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _touch(self, key:str) -> bool:
+        """ mark a shared volume as recently used (for eviction), False if it has been evicted """
+        try:
+            os.utime(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _get_shared(self, key:str, fns:Sequence[str]) -> np.ndarray:
+        path = self._path(key)
+        try:
+            x = np.load(path, mmap_mode='r')
+            self._touch(key)
+            return x
+        except FileNotFoundError:
+            pass
+        x = self.decode(fns)
+        tmp_fn = os.path.join(self.cache_dir, f'.{key}.{os.getpid()}.tmp')  # rename, so readers never see a partial file
+        with open(tmp_fn, 'wb') as f:
+            np.save(f, x)
+        os.replace(tmp_fn, path)
+        self._evict_shared(keep=path)
+        try:
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:  # evicted by another process in the meantime
+            return x
+
+    def _evict_shared(self, keep:str):
+        """ remove the least recently used files from the shared cache until it is within the bound """
+        if self.max_memory is None: return
+        files = []
+        for fn in glob(os.path.join(self.cache_dir, '*.npy')):
+            try:
+                st = os.stat(fn)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime_ns, st.st_size, fn))
+        total = sum(f[1] for f in files)
+        for _, size, fn in sorted(files):
+            if total <= self.max_memory: break
+            if fn == keep: continue
+            try:
+                os.remove(fn)  # processes which have it memory-mapped keep their mapping
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _insert(self, key:str, x:np.ndarray):
+        if self.max_memory is not None and x.nbytes > self.max_memory: return  # too large to cache at all
+        self.arrays[key] = x
+        self.nbytes += x.nbytes
+        while self.max_memory is not None and self.nbytes > self.max_memory:
+            self._drop(next(iter(self.arrays)))
+
+    def _drop(self, key:str):
+        self.nbytes -= self.arrays.pop(key).nbytes
+
+    def clear(self):
+        """ drop the volumes held by this process """
+        self.arrays.clear()
+        self.nbytes = 0
+
+    def close(self):
+        """ drop the volumes held by this process and remove the shared cache directory if it was created here """
+        self.clear()
+        if self._owner:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self._owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CachedDataset(Dataset):
+    """
+    dataset of (source, target) volumes (as in niftidataset's MultimodalNiftiDataset and MultimodalTiffDataset),
+    i.e., samples of stacked source and target volumes ([C,H,W,D], or [C,H,W] for TIFF images), read through
+    a VolumeCache; the samples are those of the cache (read-only in shared mode), so the transform should begin
+    with a crop (if any) followed by copy_sample
+
+    Args:
+        source_dirs (List[str]): directories with the source images (one per input channel)
+        target_dirs (List[str]): directories with the target images (one per output channel)
+        cache (VolumeCache): cache to read the volumes through
+        transform (Callable): transform applied to each (source, target) sample [Default=None]
+        tiff (bool): the images are TIFF images instead of NIfTI images [Default=False]
+    """
+    def __init__(self, source_dirs:List[str], target_dirs:List[str], cache:VolumeCache,
+                 transform:Optional[Callable]=None, tiff:bool=False):
+        glob_imgs = glob_tiff if tiff else glob_nii
+        self.source_fns = [glob_imgs(d) for d in source_dirs]
+        self.target_fns = [glob_imgs(d) for d in target_dirs]
+        n_imgs = [len(fns) for fns in self.source_fns + self.target_fns]
+        if min(n_imgs) == 0 or len(set(n_imgs)) != 1:
+            raise SynthNNError(f'Each source and target directory must have the same (nonzero) number of images, '
+                               f'found {n_imgs} images in {list(source_dirs) + list(target_dirs)}.')
+        self.cache = cache
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.source_fns[0])
+
+    def __getitem__(self, idx:int):
+        sample = (self.cache.get([fns[idx] for fns in self.source_fns]),
+                  self.cache.get([fns[idx] for fns in self.target_fns]))
+        return self.transform(sample) if self.transform is not None else sample
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.distributed
+
+helper functions for distributed (multi-process) data parallel training,
+where each process trains a replica of the network on its own part of
+every batch and the gradients are all-reduced, with the processes
+started by torchrun or by launch (on a single machine)
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['all_reduce_mean',
+           'all_reduce_sum',
+           'dist_info',
+           'init_distributed',
+           'is_launched',
+           'launch',
+           'shared_tempdir']
+
+import logging
+import os
+import socket
+import tempfile
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from synthnn import SynthNNError
+
+logger = logging.getLogger(__name__)
+
+
+def is_launched() -> bool:
+    """ the process was started by torchrun (or launch), i.e., the environment defines the process group """
+    return 'WORLD_SIZE' in os.environ and 'RANK' in os.environ
+
+
+def dist_info() -> Tuple[int, int, int, int]:
+    """ rank, local rank, world size and local world size (the number of processes on this machine) of the process """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    return (int(os.environ.get('RANK', 0)), int(os.environ.get('LOCAL_RANK', 0)), world_size,
+            int(os.environ.get('LOCAL_WORLD_SIZE', world_size)))
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def _run(local_rank:int, fn:Callable[[Optional[List[str]]], int], args:Optional[List[str]], nproc:int, port:int):
+    """ entry point of a process started by launch, which sets up the environment torchrun would """
+    os.environ.update(MASTER_ADDR='localhost', MASTER_PORT=str(port), RANK=str(local_rank),
+                      LOCAL_RANK=str(local_rank), WORLD_SIZE=str(nproc), LOCAL_WORLD_SIZE=str(nproc))
+    retval = fn(args)
+    if retval != 0: raise SynthNNError(f'Process {local_rank} exited with {retval}.')
+
+
+def launch(fn:Callable[[Optional[List[str]]], int], args:Optional[List[str]], nproc:int) -> int:
+    """
+    run fn(args) in nproc processes on this machine (as torchrun --nproc-per-node nproc would), where a
+    single process runs in this one (so it is not copied)
+
+    Args:
+        fn (Callable): function (of the command line arguments) which returns 0 on success
+        args (List[str]): command line arguments passed to each process (None uses sys.argv, which the
+            started processes inherit)
+        nproc (int): number of processes
+
+    Returns:
+        retval (int): 0 if all processes succeeded (otherwise an exception is raised)
+    """
+    port = _free_port()
+    if nproc == 1:
+        env = dict(os.environ)
+        try:
+            _run(0, fn, args, 1, port)
+        finally:
+            os.environ.clear()
+            os.environ.update(env)
+    else:
+        logger.info(f'Starting {nproc} training processes')
+        mp.spawn(_run, args=(fn, args, nproc, port), nprocs=nproc, join=True)
+    return 0
+
+
+def init_distributed(backend:Optional[str]=None, use_cuda:bool=False,
+                     gpu_ids:Optional[Sequence[int]]=None) -> Tuple[torch.device, int, int]:
+    """
+    join the process group defined by the environment (see is_launched), where each process on a machine uses
+    its own gpu (selected from gpu_ids by its local rank) or, on the cpu, its share of the cores
+
+    Args:
+        backend (str): nccl or gloo [Default=nccl with cuda, otherwise gloo]
+        use_cuda (bool): train on the gpu
+        gpu_ids (Sequence[int]): gpus of this machine to use [Default=all]
+
+    Returns:
+        device (torch.device): device of this process
+        rank (int): rank of this process
+        world_size (int): number of processes
+    """
+    rank, local_rank, world_size, local_world_size = dist_info()
+    backend = backend or ('nccl' if use_cuda else 'gloo')
+    if backend == 'nccl' and not use_cuda: raise SynthNNError('The nccl backend requires CUDA, use gloo on the cpu.')
+    if use_cuda:
+        gpu_ids = list(range(torch.cuda.device_count())) if gpu_ids is None else list(gpu_ids)
+        if local_world_size > len(gpu_ids):
+            raise SynthNNError(f'{local_world_size} processes on this machine but only {len(gpu_ids)} gpus.')
+        device = torch.device(f'cuda:{gpu_ids[local_rank]}')
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+        # split the cores between the processes on this machine (instead of each using all of them)
+        torch.set_num_threads(max(os.cpu_count() // local_world_size, 1))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    logger.debug(f'Process {rank} of {world_size} on {device} ({backend})')
+    return device, rank, world_size
+
+
+def all_reduce_sum(values:Sequence[float], device:torch.device) -> List[float]:
+    """ elementwise sum of the values of all processes (of the process group, if initialized) """
+    total = torch.tensor(values, dtype=torch.float64, device=device)
+    if dist.is_available() and dist.is_initialized(): dist.all_reduce(total)
+    return total.tolist()
+
+
+def all_reduce_mean(values:Sequence[float], device:torch.device) -> float:
+    """ mean of the values of all processes (of the process group, if initialized), e.g., of the batch losses """
+    total, n = all_reduce_sum([sum(values), len(values)], device)
+    return total / n if n > 0 else float('nan')
+
+
+def shared_tempdir(prefix:str, dir:Optional[str]=None) -> str:
+    """
+    new temporary directory with the same name in every process (of the process group, if initialized), named
+    by the first process and created on each machine, so the processes of a machine can share files through it
+    (which the first process of each machine, see dist_info, should remove)
+
+    Args:
+        prefix (str): prefix of the directory name
+        dir (str): parent directory [Default=the temporary directory]
+
+    Returns:
+        path (str): path of the directory
+    """
+    path = [tempfile.mkdtemp(prefix=prefix, dir=dir) if dist_info()[0] == 0 else None]
+    if dist.is_available() and dist.is_initialized(): dist.broadcast_object_list(path, src=0)
+    os.makedirs(path[0], exist_ok=True)
+    return path[0]
@@ -12,6 +12,8 @@ Created on: Jan 28, 2018
 
 __all__ = ['get_args',
            'get_device',
+           'load_config',
+           'load_model',
            'setup_log',
            'write_out_config']
 
@@ -23,6 +25,60 @@ import torch
 
 from synthnn import SynthNNError
 
+# prediction options (and their defaults) which are written to the config file by nn-train,
+# these are filled in when missing so that config files from older versions can still be used
+PREDICT_OPTIONS = {
+    "autotune": False,
+    "autotune_cache": None,
+    "backend": "eager",
+    "background_value": 0.0,
+    "calc_var": False,
+    "calibration_dir": None,
+    "channels_last": False,
+    "compression_level": None,
+    "cpu_affinity": False,
+    "exported_model": None,
+    "foreground_threshold": None,
+    "manifest": None,
+    "mask_dir": None,
+    "max_memory": None,
+    "mc_batch_size": None,
+    "mc_stats": None,
+    "memory_budget": None,
+    "memory_map": True,
+    "monte_carlo": None,
+    "n_calibration": 2,
+    "output_compression": "gzip",
+    "output_dtype": None,
+    "patch_stride": None,
+    "patch_weight": "uniform",
+    "precision": "fp32",
+    "queue_depth": 0,
+    "resume": False,
+    "scratch_dir": None,
+    "shard": None,
+    "temperature_map": False,
+    "threads": None,
+    "workers": 1,
+    "writer_threads": 1
+}
+
+# training options (and their defaults) which are filled in when missing from a config file
+TRAIN_OPTIONS = {
+    "batch_augment": False,
+    "cache": "none",
+    "cache_dir": None,
+    "cache_dtype": "float32",
+    "cache_memory": None,
+    "dist_backend": None,
+    "distributed": False,
+    "nproc": None,
+    "patches_per_volume": 1,
+    "queue_size": None,
+    "store": None,
+    "train_precision": "fp32"  # named apart from the (prediction) precision option
+}
+
 
 def setup_log(verbosity):
     if verbosity == 1:
@@ -45,11 +101,19 @@ def get_args(args, arg_parser=None):
         args = arg_parser().parse_args(args)
     else:
         fn = sys.argv[1:][0] if args is None else args[0]
-        with open(fn, 'r') as f:
-            args = AttrDict({k: v for item in json.load(f).values() for k, v in item.items()})  # dict comp. flattens first layer of dict
+        args = load_config(fn)
     return args, no_config_file
 
 
+def load_config(fn):
+    """ load a config file (see write_out_config) as a flat dictionary whose keys are accessible as attributes """
+    with open(fn, 'r') as f:
+        args = AttrDict({k: v for item in json.load(f).values() for k, v in item.items()})  # dict comp. flattens first layer of dict
+    for k, v in PREDICT_OPTIONS.items(): args.setdefault(k, v)
+    for k, v in TRAIN_OPTIONS.items(): args.setdefault(k, v)
+    return args
+
+
 def get_device(args, logger):
     # define device to put tensors on
     cuda_avail = torch.cuda.is_available()
@@ -67,6 +131,34 @@ def get_device(args, logger):
     return device, use_cuda, n_gpus
 
 
+def load_model(args, device, enable_dropout=False):
+    """ recreate the network defined in a (flattened) config file, load its trained weights and put it on device """
+    if args.nn_arch.lower() == 'nconv':
+        from synthnn.models.nconvnet import SimpleConvNet
+        model = SimpleConvNet(args.n_layers, kernel_size=args.kernel_size, dropout_p=args.dropout_prob,
+                              n_input=args.n_input, n_output=args.n_output, is_3d=args.net3d)
+    elif args.nn_arch.lower() == 'unet':
+        from synthnn.models.unet import Unet
+        model = Unet(args.n_layers, kernel_size=args.kernel_size, dropout_p=args.dropout_prob,
+                     channel_base_power=args.channel_base_power, add_two_up=args.add_two_up, normalization=args.normalization,
+                     activation=args.activation, output_activation=args.out_activation, is_3d=args.net3d,
+                     interp_mode=args.interp_mode, enable_dropout=enable_dropout, enable_bias=args.enable_bias,
+                     n_input=args.n_input, n_output=args.n_output, no_skip=args.no_skip,
+                     ord_params=args.ord_params+[device] if args.ord_params is not None else None)
+    elif args.nn_arch == 'vae':
+        from synthnn.models.vae import VAE
+        model = VAE(args.n_layers, args.img_dim, channel_base_power=args.channel_base_power,
+                     activation=args.activation, is_3d=args.net3d,
+                     n_input=args.n_input, n_output=args.n_output, latent_size=args.latent_size)
+    else:
+        raise SynthNNError(f'Invalid NN type: {args.nn_arch}. {{nconv, unet}} are the only supported options.')
+    state_dict = torch.load(args.trained_model, map_location=device)
+    model.load_state_dict(state_dict)
+    model.eval()
+    if device.type == 'cuda': model.cuda(device=device)
+    return model
+
+
 def write_out_config(args, n_gpus, n_input, n_output, use_3d):
     arg_dict = {
         "Required": {
@@ -108,22 +200,29 @@ def write_out_config(args, n_gpus, n_input, n_output, use_3d):
             "out_activation": args.out_activation,
         },
         "Training Options": {
+            "cache": args.cache,
+            "cache_dir": args.cache_dir,
+            "cache_dtype": args.cache_dtype,
+            "cache_memory": args.cache_memory,
             "clip": args.clip,
+            "dist_backend": args.dist_backend,
+            "distributed": args.distributed,
             "fp16": args.fp16,
             "learning_rate": args.learning_rate,
             "lr_scheduler": args.lr_scheduler,
             "n_epochs": args.n_epochs,
             "n_jobs": args.n_jobs,
+            "nproc": args.nproc,
+            "patches_per_volume": args.patches_per_volume,
             "plot_loss": args.plot_loss,
+            "train_precision": args.train_precision,
+            "queue_size": args.queue_size,
+            "store": args.store,
             "valid_source_dir": args.valid_source_dir,
             "valid_split": args.valid_split,
             "valid_target_dir": args.valid_target_dir
         },
-        "Prediction Options": {
-            "calc_var": False,
-            "monte_carlo": None,
-            "temperature_map": False
-        },
+        "Prediction Options": dict(PREDICT_OPTIONS, channels_last=args.channels_last),  # predict as trained
         "VAE Options": {
             "img_dim": args.img_dim,
             "latent_size": args.latent_size if args.nn_arch == 'vae' else None
@@ -134,6 +233,7 @@ def write_out_config(args, n_gpus, n_input, n_output, use_3d):
             "n_output": n_output
         },
         "Data Augmentation Options": {
+            "batch_augment": args.batch_augment,
             "prob": args.prob,
             "rotate": args.rotate,
             "translate": args.translate,
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.foreground
+
+foreground masks (from an intensity threshold or otsu's method) and the
+slices/patches which contain foreground, so that prediction can skip
+the (e.g., air) regions which contain none
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['foreground_bbox',
+           'foreground_mask',
+           'foreground_patches',
+           'otsu_threshold']
+
+import logging
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from ..errors import SynthNNError
+from .patch import PatchPlan
+
+logger = logging.getLogger(__name__)
+
+
+def _slabs(x:np.ndarray, size:int=32):
+    """ slabs (as float32 arrays) of an array along its last axis, so (e.g., memory-mapped) channels are read in parts """
+    for i in range(0, x.shape[-1], size):
+        yield np.asarray(x[..., i:i+size], dtype=np.float32)
+
+
+def otsu_threshold(x:np.ndarray, bins:int=256) -> float:
+    """ intensity threshold which maximizes the between-class variance of the values above and below it (otsu's method) """
+    lo, hi = np.inf, -np.inf
+    for slab in _slabs(x):
+        slab = slab[np.isfinite(slab)]
+        if slab.size > 0: lo, hi = min(lo, slab.min()), max(hi, slab.max())
+    if not lo < hi: return float(lo) if np.isfinite(lo) else 0.
+    hist = np.zeros(bins, dtype=np.int64)
+    for slab in _slabs(x):
+        hist += np.histogram(slab[np.isfinite(slab)], bins, (lo, hi))[0]
+    edges = np.linspace(lo, hi, bins + 1)
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(hist, dtype=np.float64)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * centers)
+    mu0, mu1 = m0 / np.maximum(w0, 1), (m0[-1] - m0) / np.maximum(w1, 1)
+    return float(centers[np.argmax(w0 * w1 * (mu0 - mu1) ** 2)])
+
+
+def foreground_mask(img:Union[np.ndarray, Sequence[np.ndarray]], threshold:Union[float,str]) -> np.ndarray:
+    """
+    foreground of an image, i.e., the voxels above the threshold in any channel
+
+    Args:
+        img (Union[np.ndarray, Sequence[np.ndarray]]): image with channels first ([C,H,W,D] or [H,W,D]) or a
+            sequence of channels ([H,W,D] each, e.g., memory-mapped volumes, which are read slab-by-slab)
+        threshold (Union[float,str]): intensity threshold, or otsu to use otsu's method on each channel
+
+    Returns:
+        mask (np.ndarray): boolean foreground mask [H,W,D]
+    """
+    if isinstance(threshold, str) and threshold.lower() != 'otsu':
+        raise SynthNNError(f'Invalid foreground threshold: {threshold}. Expected a number or otsu.')
+    if isinstance(img, np.ndarray) and img.ndim == 3: img = img[np.newaxis, ...]
+    mask = np.zeros(img[0].shape, dtype=bool)
+    for channel in img:
+        t = otsu_threshold(channel) if isinstance(threshold, str) else float(threshold)
+        i = 0
+        for slab in _slabs(channel):
+            mask[..., i:i+slab.shape[-1]] |= slab > t
+            i += slab.shape[-1]
+    return mask
+
+
+def foreground_bbox(mask:np.ndarray) -> Optional[Tuple[slice, ...]]:
+    """ bounding box (as slices) of the foreground in a mask, None if the mask is empty """
+    if not mask.any(): return None
+    bbox = []
+    for axis in range(mask.ndim):
+        idxs = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        bbox.append(slice(int(idxs[0]), int(idxs[-1]) + 1))
+    return tuple(bbox)
+
+
+def foreground_patches(plan:PatchPlan, mask:np.ndarray) -> np.ndarray:
+    """ which patches in a tiling plan (see get_patch_plan) contain foreground, as a boolean array (in plan order) """
+    if mask.shape != plan.shape:
+        raise SynthNNError(f'Mask shape {mask.shape} does not match the image shape {plan.shape}.')
+    keep = np.zeros(plan.n_patches, dtype=bool)
+    bbox = foreground_bbox(mask)
+    if bbox is None: return keep
+    psz = plan.psz
+    for i in range(plan.n_patches):
+        corner = plan.corner(i)
+        if all(c < b.stop and c + psz > b.start for c, b in zip(corner, bbox)):  # only patches in the bbox are checked
+            keep[i] = mask[tuple(slice(c, c + psz) for c in corner)].any()
+    return keep
@@ -11,13 +11,18 @@ Created on: Nov 2, 2018
 """
 
 __all__ = ['split_filename',
-           'glob_nii']
+           'glob_nii',
+           'glob_tiff',
+           'lazy_nii']
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
 
 from glob import glob
 import os
 
+import nibabel as nib
+import numpy as np
+
 
 def split_filename(filepath: str) -> Tuple[str, str, str]:
     """ split a filepath into the directory, base, and extension """
@@ -34,3 +39,28 @@ def glob_nii(path: str) -> List[str]:
     """ grab all nifti files in a directory and sort them for consistency """
     fns = sorted(glob(os.path.join(path, '*.nii*')))
     return fns
+
+
+def glob_tiff(path: str) -> List[str]:
+    """ grab all tiff files in a directory and sort them for consistency """
+    fns = sorted(glob(os.path.join(path, '*.tif*')))
+    return fns
+
+
+def lazy_nii(fn: str, compressed: bool = False) -> Optional[Union[np.memmap, nib.arrayproxy.ArrayProxy]]:
+    """
+    image data of an uncompressed NIfTI file which is only read where it is indexed, i.e., a memory-mapped
+    array if the data are not scaled (otherwise the nibabel array proxy, which reads and scales only the
+    indexed slab), or None if the file is compressed (and so cannot be memory-mapped), unless compressed
+    is set, in which case the array proxy of a compressed file (kept open) is returned
+
+    note that NIfTI data are stored in fortran order, so slabs along the last axis are contiguous on disk,
+    and that compressed files are only read efficiently in ascending order along the last axis (since
+    reading an earlier slab restarts the decompression from the beginning of the file)
+    """
+    if split_filename(fn)[2] != '.nii':
+        return nib.load(fn, keep_file_open=True).dataobj if compressed else None
+    dataobj = nib.load(fn, mmap='r').dataobj
+    if not nib.is_proxy(dataobj): return np.asanyarray(dataobj)
+    if dataobj.slope == 1 and dataobj.inter == 0: return np.asanyarray(dataobj)  # memory-mapped (read-only)
+    return dataobj
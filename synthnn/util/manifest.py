@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.manifest
+
+record the finished subjects of a batch prediction so that an
+interrupted run can be resumed without recomputing them
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['config_hash',
+           'file_fingerprint',
+           'Manifest']
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterable, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+def _sha256(fn:str, chunk_size:int=1<<20) -> str:
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(fn:str, prev:Optional[dict]=None) -> dict:
+    """
+    size, modification time, and sha256 of a file, where the (slow) hash is
+    reused from a previous fingerprint if the size and modification time match
+    """
+    st = os.stat(fn)
+    fp = {'path': os.path.abspath(fn), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if prev is not None and prev.get('size') == fp['size'] and prev.get('mtime_ns') == fp['mtime_ns']:
+        fp['sha256'] = prev['sha256']
+    else:
+        fp['sha256'] = _sha256(fn)
+    return fp
+
+
+def config_hash(config:dict, exclude:Iterable[str]=(), files:Iterable[str]=()) -> str:
+    """
+    hash of a (flattened) config, ignoring the keys in exclude (e.g., options which do not change
+    the output), and of the contents of files (e.g., the trained model weights)
+    """
+    exclude = set(exclude)
+    h = hashlib.sha256(json.dumps({k: v for k, v in config.items() if k not in exclude},
+                                  sort_keys=True, default=str).encode())
+    for fn in files: h.update(_sha256(fn).encode())
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    append-only record (JSON lines) of the finished subjects of a batch prediction, where each line holds
+    the fingerprints of the inputs, the hash of the config, and the output filenames of one subject
+
+    lines are appended with a single write to a file opened in append mode, so concurrent
+    writers (threads or processes) do not interleave, and a line only exists once its outputs are saved
+
+    Args:
+        fn (str): path to the manifest file (created if it does not exist)
+        config_hash (str): hash of the config used for this run (see config_hash)
+    """
+    def __init__(self, fn:str, config_hash:str):
+        self.fn = fn
+        self.config_hash = config_hash
+        self._lock = threading.Lock()
+        self.entries = self._read()
+
+    def _read(self) -> dict:
+        entries = {}
+        if not os.path.isfile(self.fn): return entries
+        with open(self.fn, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # e.g., a line cut off by a crash
+                    continue
+                entries[self._key(fp['path'] for fp in entry['inputs'])] = entry  # later lines take precedence
+        self._terminate()
+        return entries
+
+    def _terminate(self):
+        """ end a line cut off by a crash, so the next record is not appended to (and lost with) it """
+        with open(self.fn, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0: return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b'\n': return
+        fd = os.open(self.fn, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, b'\n')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _key(inputs:Iterable[str]) -> tuple:
+        return tuple(os.path.abspath(fn) for fn in inputs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def is_complete(self, inputs:Sequence[str], outputs:Sequence[str]) -> bool:
+        """ the subject was finished with the same config, unchanged inputs, and its outputs still exist """
+        entry = self.entries.get(self._key(inputs))
+        if entry is None or entry['config'] != self.config_hash: return False
+        if entry['outputs'] != [os.path.abspath(fn) for fn in outputs]: return False
+        if not all(os.path.isfile(fn) for fn in outputs): return False
+        try:
+            return all(file_fingerprint(fn, prev)['sha256'] == prev['sha256'] for fn, prev in zip(inputs, entry['inputs']))
+        except OSError:
+            return False
+
+    def record(self, inputs:Sequence[str], outputs:Sequence[str]):
+        """ record a finished subject (call only after all of its outputs are saved) """
+        prev = self.entries.get(self._key(inputs), {}).get('inputs', [None] * len(inputs))
+        entry = {'inputs': [file_fingerprint(fn, p) for fn, p in zip(inputs, prev)],
+                 'config': self.config_hash,
+                 'outputs': [os.path.abspath(fn) for fn in outputs],
+                 'time': time.time()}
+        line = (json.dumps(entry) + '\n').encode()
+        with self._lock:
+            fd = os.open(self.fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.entries[self._key(inputs)] = entry
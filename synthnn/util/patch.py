@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.patch
+
+tiling plans and batched patch extraction/stitching
+for patch-based 3d synthesis
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['PatchPlan',
+           'get_patch_overlap',
+           'get_patch_plan',
+           'get_patch_weight',
+           'min_patch_stride',
+           'predict_patches',
+           'slab_memory',
+           'stream_patches']
+
+from functools import lru_cache
+import logging
+import math
+from typing import Callable, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from ..errors import SynthNNError
+
+logger = logging.getLogger(__name__)
+
+
+class PatchPlan(NamedTuple):
+    """
+    tiling of a 3d volume into (possibly overlapping) cubic patches
+
+    the tiling is a regular grid, i.e., the cartesian product of the patch
+    start indices along each axis, and the blending weight of a patch is the
+    outer product of a 1d window, so the total weight at a voxel is the outer
+    product of the per-axis weight sums (no full-size weight volume is needed)
+
+    the patches cover every voxel, where axes shorter than the patch size are
+    padded (at the end) up to the patch size
+
+    Args:
+        shape (Tuple[int,int,int]): spatial shape of the volume being tiled
+        psz (int): patch size (cubed)
+        stride (int): maximum step between consecutive patch starts along an axis
+        starts (Tuple[np.ndarray,...]): patch start indices along each axis
+        window (np.ndarray): 1d blending weight of a patch along an axis
+        norms (Tuple[np.ndarray,...]): sum of the blending weights at each (padded) index along each axis
+    """
+    shape: Tuple[int, int, int]
+    psz: int
+    stride: int
+    starts: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    window: np.ndarray
+    norms: Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+    @property
+    def grid(self) -> Tuple[int, int, int]:
+        return tuple(len(s) for s in self.starts)
+
+    @property
+    def n_patches(self) -> int:
+        return int(np.prod(self.grid))
+
+    def corner(self, i:int) -> Tuple[int, int, int]:
+        """ start index (corner) of the i-th patch in the plan (patches are ordered x-major) """
+        return tuple(int(s[j]) for s, j in zip(self.starts, np.unravel_index(i, self.grid)))
+
+    @property
+    def pad(self) -> Tuple[int, int, int]:
+        """ amount of padding needed at the end of each axis so that the axis fits a patch """
+        return tuple(max(self.psz - n, 0) for n in self.shape)
+
+    @property
+    def coverage(self) -> float:
+        """ fraction of voxels in the volume covered by at least one patch """
+        return float(np.prod([np.mean(c[:n] > 0) for c, n in zip(self.norms, self.shape)]))
+
+    @property
+    def redundancy(self) -> float:
+        """ number of voxels run through the network per voxel in the volume """
+        return self.n_patches * self.psz ** 3 / int(np.prod(self.shape))
+
+    @property
+    def uniform(self) -> bool:
+        return bool(np.all(self.window == 1))
+
+    def weight(self) -> np.ndarray:
+        """ 3d blending weight of a patch """
+        w = self.window
+        return w[:, None, None] * w[None, :, None] * w[None, None, :]
+
+    def normalize(self, out:np.ndarray) -> np.ndarray:
+        """ divide (in-place) an accumulated output by the total blending weight at each voxel """
+        for axis, c in enumerate(self.norms, out.ndim - 3):
+            shape = [1] * out.ndim
+            shape[axis] = -1
+            out /= np.where(c > 0, c, 1).reshape(shape)  # uncovered voxels have no output, avoid division by zero
+        return out
+
+
+def get_patch_weight(psz:int, mode:str='uniform', overlap:Optional[int]=None) -> np.ndarray:
+    """
+    get the 1d blending window for a patch (the 3d window is the outer product of this)
+    must be one of: uniform, gaussian, linear
+
+    Args:
+        psz (int): patch size
+        mode (str): uniform weights all voxels equally (i.e., plain averaging), gaussian uses a gaussian
+            with std. dev. of psz/8 centered in the patch and linear ramps up across the overlap region
+        overlap (int): number of voxels shared by neighboring patches (used by linear) [Default=psz//2]
+
+    Returns:
+        window (np.ndarray): blending weights for each index of the patch
+    """
+    i = np.arange(psz, dtype=np.float64)
+    if mode.lower() == 'uniform':
+        w = np.ones(psz)
+    elif mode.lower() == 'gaussian':
+        sigma = psz / 8
+        w = np.exp(-((i - (psz - 1) / 2) ** 2) / (2 * sigma ** 2))
+    elif mode.lower() == 'linear':
+        overlap = psz // 2 if overlap is None else overlap
+        w = np.minimum(np.minimum(i, psz - 1 - i) + 1, overlap + 1) / (overlap + 1)
+    else:
+        raise SynthNNError(f'Patch weight: "{mode}" not a valid weighting mode or not supported.')
+    return np.maximum(w, 1e-3).astype(np.float32)  # keep weights positive so that every covered voxel has some weight
+
+
+def min_patch_stride(psz:int) -> int:
+    """ smallest patch stride worth using (a quarter of the patch size), i.e., at most 64 patches per patch volume """
+    return max(psz // 4, 1)
+
+
+def get_patch_overlap(receptive_field:int, psz:int) -> int:
+    """
+    minimum overlap between neighboring patches for seam-free stitching, derived from
+    the receptive field of the network (e.g., Unet.receptive_field)
+
+    the outputs within (rf-1)/2 voxels of a patch border see the padding instead of the
+    image, and both neighboring patches have such a border at their seam, so they must
+    share both borders (i.e., rf-1 voxels) for every voxel to be covered by an output
+    computed from the image alone; if that leaves a stride below min_patch_stride (e.g.,
+    a unet whose receptive field exceeds the patch size), the number of patches would
+    explode, so an error is raised instead
+
+    Args:
+        receptive_field (int): receptive field of the network (in voxels along an axis)
+        psz (int): patch size
+
+    Returns:
+        overlap (int): minimum number of voxels shared by neighboring patches
+    """
+    overlap = max(receptive_field - 1, 0)
+    if psz - overlap < min_patch_stride(psz):
+        raise SynthNNError(f'The receptive field ({receptive_field}) is too large for seam-free stitching of patches '
+                           f'of size {psz} (the stride would be {max(psz - overlap, 0)}), use larger patches '
+                           f'(of at least {math.ceil(4 * overlap / 3)}) or set the patch stride.')
+    return int(overlap)
+
+
+def _axis_plan(n:int, psz:int, stride:int, window:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ fewest patch starts (evenly spread) that cover an axis without exceeding the stride """
+    n = max(n, psz)
+    n_patches = -(-(n - psz) // stride) + 1  # ceiling division
+    starts = np.round(np.linspace(0, n - psz, n_patches)).astype(np.int64)
+    norms = np.zeros(n, dtype=np.float32)
+    for s in starts:
+        norms[s:s+psz] += window
+    starts.flags.writeable = norms.flags.writeable = False  # plans are cached and shared, do not allow edits
+    return starts, norms
+
+
+@lru_cache(maxsize=32)
+def get_patch_plan(shape:Tuple[int,int,int], psz:int, stride:Optional[int]=None, weight:str='uniform') -> PatchPlan:
+    """
+    create (or fetch from cache) the tiling plan for a volume of a given shape,
+    such that cohorts of same-shaped images only compute the plan once
+
+    Args:
+        shape (Tuple[int,int,int]): spatial shape of the volume
+        psz (int): patch size (cubed)
+        stride (int): step between patches, defaults to half the patch size
+        weight (str): blending weight used to combine overlapping patches (see get_patch_weight)
+
+    Returns:
+        plan (PatchPlan): tiling plan for the volume
+    """
+    stride = stride or max(psz // 2, 1)
+    if stride > psz: raise SynthNNError(f'Patch stride ({stride}) must not be larger than the patch size ({psz}).')
+    window = get_patch_weight(psz, weight, psz - stride)
+    window.flags.writeable = False
+    starts, norms = zip(*[_axis_plan(n, psz, stride, window) for n in shape])
+    return PatchPlan(tuple(shape), psz, stride, starts, window, norms)
+
+
+def predict_patches(predict_fn:Callable[[torch.Tensor], np.ndarray], img:np.ndarray, plan:PatchPlan,
+                    batch_size:int, n_output:int, device:Optional[torch.device]=None,
+                    keep:Optional[np.ndarray]=None, fill:float=0.) -> np.ndarray:
+    """
+    synthesize a 3d volume patch-by-patch according to a tiling plan
+
+    patches are copied out of the image (via slicing, i.e., no index arrays) into
+    a single preallocated batch buffer, and the (weighted) network outputs are accumulated
+    into the output volume, which is then normalized by the (separable) total weight;
+    the last batch may be partial, i.e., every (kept) patch in the plan is run through the network
+
+    patches which are not kept (e.g., which contain no foreground, see foreground_patches) are skipped and
+    their region is filled with the fill value, so the output at voxels only covered by kept patches is the
+    same as if every patch were run through the network
+
+    Args:
+        predict_fn (Callable): function which takes a batch of patches ([N,C,H,W,D] tensor)
+            and returns the network output as a numpy array
+        img (np.ndarray): image to synthesize from (channels first, i.e., [C,H,W,D])
+        plan (PatchPlan): tiling plan for the image (see get_patch_plan)
+        batch_size (int): number of patches to run through the network at once
+        n_output (int): number of output channels of the network
+        device (torch.device): device to put the batches on
+        keep (np.ndarray): which patches to run through the network (boolean, in plan order) [Default=all]
+        fill (float): value of the output in the region of the skipped patches
+
+    Returns:
+        out_img (np.ndarray): synthesized image ([n_output,H,W,D])
+    """
+    psz = plan.psz
+    idxs = np.arange(plan.n_patches) if keep is None else np.flatnonzero(keep)
+    n = len(idxs)
+    if any(plan.pad): img = np.pad(img, [(0, 0)] + [(0, p) for p in plan.pad], mode='edge')
+    out_img = np.zeros((n_output,) + img.shape[1:], dtype=np.float32)
+    pin = device is not None and device.type == 'cuda'
+    batch = torch.empty((batch_size, img.shape[0]) + (psz,) * 3, dtype=torch.float32, pin_memory=pin)
+    batch_np = batch.numpy()  # shares memory with the tensor, so filling this fills the batch
+    weight = None if plan.uniform else plan.weight()
+    log_every = max(n // (20 * batch_size), 1)  # log roughly every 5%
+    for k, b in enumerate(range(0, n, batch_size)):
+        if k % log_every == 0: logger.info(f'{100 * b // n}% Complete')
+        corners = [plan.corner(i) for i in idxs[b:b+batch_size]]
+        for j, (x, y, z) in enumerate(corners):
+            batch_np[j] = img[:, x:x+psz, y:y+psz, z:z+psz]
+        predicted = predict_fn(batch[:len(corners)].to(device) if device is not None else batch[:len(corners)])
+        if weight is not None: predicted = predicted * weight
+        for j, (x, y, z) in enumerate(corners):
+            out_img[:, x:x+psz, y:y+psz, z:z+psz] += predicted[j]
+    out_img = plan.normalize(out_img)
+    if n < plan.n_patches:
+        skipped = np.zeros(img.shape[1:], dtype=bool)
+        for i in np.flatnonzero(~np.asarray(keep, dtype=bool)):
+            x, y, z = plan.corner(i)
+            skipped[x:x+psz, y:y+psz, z:z+psz] = True
+        out_img[:, skipped] = fill
+    if any(plan.pad): out_img = np.ascontiguousarray(out_img[(slice(None),) + tuple(slice(0, n) for n in plan.shape)])
+    return out_img
+
+
+def slab_memory(plan:PatchPlan, n_input:int, n_output:int, batch_size:int) -> int:
+    """
+    memory (in bytes) held by stream_patches for a plan, i.e., the input/output slabs (and a copy of each
+    when they move along the last axis) and the batches, but not the memory used by the network
+    """
+    slab = max(plan.shape[0], plan.psz) * max(plan.shape[1], plan.psz) * plan.psz
+    return 4 * (n_input + n_output) * (2 * slab + batch_size * plan.psz ** 3) + slab
+
+
+def stream_patches(predict_fn:Callable[[torch.Tensor], np.ndarray], img:Sequence[np.ndarray], plan:PatchPlan,
+                   batch_size:int, out:Sequence[np.ndarray], device:Optional[torch.device]=None,
+                   keep:Optional[np.ndarray]=None, fill:float=0.):
+    """
+    synthesize a 3d volume patch-by-patch according to a tiling plan, like predict_patches, but for volumes which
+    do not fit in memory, i.e., only a slab of psz planes (along the last axis) of the input and the output is held
+
+    the patches are run in slab order (by their start along the last axis, which is the slowest axis of NIfTI
+    files, so the slabs are contiguous on disk), where each input plane is read once (as the slab moves along the
+    last axis) and each output plane is normalized and written once no later patch overlaps it; the output equals
+    that of predict_patches up to floating point error (the overlapping patches are added in a different order)
+
+    Args:
+        predict_fn (Callable): function which takes a batch of patches ([N,C,H,W,D] tensor)
+            and returns the network output as a numpy array
+        img (Sequence[np.ndarray]): input channels ([H,W,D] each), e.g., memory-mapped arrays or array proxies,
+            which are read slab-by-slab in ascending order along the last axis (see lazy_nii)
+        plan (PatchPlan): tiling plan for the image (see get_patch_plan)
+        batch_size (int): number of patches to run through the network at once
+        out (Sequence[np.ndarray]): output channels ([H,W,D] each) to write the synthesized image into,
+            e.g., memory-mapped arrays in fortran order (so that the written planes are contiguous)
+        device (torch.device): device to put the batches on
+        keep (np.ndarray): which patches to run through the network (boolean, in plan order) [Default=all]
+        fill (float): value of the output in the region of the skipped patches
+    """
+    psz, (h, w, d) = plan.psz, plan.shape
+    hp, wp = max(h, psz), max(w, psz)
+    xs, ys, zs = plan.starts
+    nx, ny, nz = plan.grid
+    in_slab = np.empty((len(img), hp, wp, psz), dtype=np.float32)  # input planes [z0,z0+psz)
+    out_slab = np.zeros((len(out), hp, wp, psz), dtype=np.float32)  # accumulated output planes [z0,z0+psz)
+    skipped = np.zeros((hp, wp, psz), dtype=bool) if keep is not None else None
+    norm_x, norm_y, norm_z = (np.where(c > 0, c, 1) for c in plan.norms)
+    pin = device is not None and device.type == 'cuda'
+    batch = torch.empty((batch_size, len(img)) + (psz,) * 3, dtype=torch.float32, pin_memory=pin)
+    batch_np = batch.numpy()  # shares memory with the tensor, so filling this fills the batch
+    weight = None if plan.uniform else plan.weight()
+
+    def flush(z0, k):  # normalize and write out the first k (finished) planes of the output slab
+        k = min(k, d - z0)
+        if k <= 0: return
+        planes = out_slab[..., :k] / norm_x[:, None, None] / norm_y[None, :, None] / norm_z[z0:z0+k]
+        if skipped is not None: planes[:, skipped[..., :k]] = fill
+        for c, channel in enumerate(out): channel[:, :, z0:z0+k] = planes[c, :h, :w]
+
+    def run(corners):
+        predicted = predict_fn(batch[:len(corners)].to(device) if device is not None else batch[:len(corners)])
+        if weight is not None: predicted = predicted * weight
+        for j, (x, y) in enumerate(corners):
+            out_slab[:, x:x+psz, y:y+psz] += predicted[j]
+
+    z0, n_read = 0, 0  # start of the slab (along the last axis) and number of its planes read
+    for iz, z in enumerate(int(z) for z in zs):
+        shift = z - z0
+        if shift > 0:  # planes before z are finished, since the patches are run in order of their start
+            flush(z0, shift)
+            for slab in (in_slab, out_slab) + ((skipped,) if skipped is not None else ()):
+                slab[..., :psz-shift] = slab[..., shift:]
+            out_slab[..., psz-shift:] = 0
+            if skipped is not None: skipped[..., psz-shift:] = False
+            z0, n_read = z, max(n_read - shift, 0)
+        a, b = z0 + n_read, min(z0 + psz, d)  # only the planes not already in the slab are read
+        for c, channel in enumerate(img):
+            if b > a: in_slab[c, :h, :w, n_read:n_read+b-a] = np.asarray(channel[:, :, a:b], dtype=np.float32)
+            in_slab[c, :h, :w, max(d - z0, n_read):] = in_slab[c, :h, :w, d-z0-1:d-z0]  # pad (edge) past the end
+            in_slab[c, h:, :, n_read:] = in_slab[c, h-1:h, :, n_read:]
+            in_slab[c, :, w:, n_read:] = in_slab[c, :, w-1:w, n_read:]
+        n_read = psz
+        logger.info(f'{100 * iz // nz}% Complete')
+        corners = []
+        for ix, x in enumerate(xs):
+            for iy, y in enumerate(ys):
+                x, y = int(x), int(y)
+                if keep is not None and not keep[(ix * ny + iy) * nz + iz]:
+                    skipped[x:x+psz, y:y+psz] = True
+                    continue
+                batch_np[len(corners)] = in_slab[:, x:x+psz, y:y+psz]
+                corners.append((x, y))
+                if len(corners) == batch_size:
+                    run(corners)
+                    corners = []
+        if corners: run(corners)
+    flush(z0, psz)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.pipeline
+
+helpers to overlap i/o (e.g., loading and saving images) with
+computation by running the i/o in background threads
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['BackgroundExecutor',
+           'prefetch']
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()  # sentinel marking the end of a prefetch queue
+
+
+def prefetch(fn:Callable[[Any], Any], items:Iterable, depth:int=1) -> Iterator:
+    """
+    apply a function to each item in a background thread, keeping at most
+    `depth` results ready ahead of the consumer (so memory stays bounded)
+
+    Args:
+        fn (Callable): function to apply to each item (e.g., loading an image)
+        items (Iterable): items to apply the function to
+        depth (int): maximum number of results held in the queue,
+            if zero, then the function is applied in the calling thread
+
+    Yields:
+        result: output of fn for each item (in order)
+    """
+    if depth <= 0:
+        yield from map(fn, items)
+        return
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for item in items:
+                result = fn(item)
+                while not stop.is_set():
+                    try:
+                        q.put((result, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set(): return
+        except Exception as e:
+            q.put((None, e))
+        q.put((_DONE, None))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, err = q.get()
+            if err is not None: raise err
+            if result is _DONE: break
+            yield result
+    finally:
+        stop.set()  # consumer stopped early (or finished), so let the worker exit
+        while thread.is_alive():
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                thread.join(0.1)
+
+
+class BackgroundExecutor:
+    """
+    run jobs (e.g., saving images) on background threads, where submitting
+    a job blocks while `max_pending` jobs are still outstanding
+
+    errors raised in a job are re-raised on the next call to submit or on close
+
+    Args:
+        max_pending (int): maximum number of submitted but unfinished jobs
+        n_threads (int): number of threads to run the jobs on
+    """
+    def __init__(self, max_pending:int=1, n_threads:int=1):
+        self.executor = ThreadPoolExecutor(max_workers=n_threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, fn:Callable, *args, **kwargs):
+        self._check()
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def _check(self):
+        done = [f for f in self.futures if f.done()]
+        self.futures = [f for f in self.futures if not f.done()]
+        for f in done: f.result()  # re-raise any exception from the job
+
+    def close(self):
+        try:
+            for f in self.futures: f.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True)  # already failing, so do not mask the original error
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.sampler
+
+draw several random patches (or slices) from each loaded training volume
+and mix the patches of several volumes in a bounded shuffle buffer, so
+the cost of loading a volume is shared by many samples
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['PatchQueue']
+
+import logging
+import math
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+logger = logging.getLogger(__name__)
+
+
+class PatchQueue(IterableDataset):
+    """
+    iterable dataset which draws patches_per_volume samples from each item of a dataset (visited in a random
+    order each epoch) and yields them through a shuffle buffer of queue_size samples, i.e., each new sample
+    replaces (and yields) a random sample in the full buffer, so consecutive samples (and so batches) come from
+    about queue_size / patches_per_volume volumes; dataloader workers each visit a disjoint part of the items,
+    as do the processes of distributed training (num_replicas > 1), which share a permutation per epoch (drawn
+    from seed and the epoch, see set_epoch) and, when shuffled (i.e., for training, where every process must run
+    the same number of steps), are padded with repeated items to the same number of items; unshuffled items (e.g.,
+    for validation) are split without padding, so no item is counted twice
+
+    if transform is given, the items of the dataset are whole (e.g., uncropped) volumes, which are loaded once and
+    transformed (e.g., randomly cropped) for each sample; otherwise the dataset is indexed once per sample, for
+    datasets which crop themselves and read only the patch (e.g., StoreDataset)
+
+    Args:
+        dataset (Dataset): dataset of (source, target) volumes
+        patches_per_volume (int): number of samples drawn from each item
+        queue_size (int): number of samples in the shuffle buffer [Default=4 * patches_per_volume]
+        indices (Sequence[int]): items of the dataset to use (e.g., the training split) [Default=all items]
+        shuffle (bool): visit the items in a random order and shuffle the samples, otherwise the samples
+            are yielded in order (e.g., for validation) [Default=True]
+        transform (Callable): transform applied to a loaded item for each sample [Default=None]
+        num_replicas (int): number of processes in distributed training [Default=1]
+        rank (int): rank of this process in distributed training [Default=0]
+        seed (int): seed of the permutations shared by the processes in distributed training [Default=0]
+    """
+    def __init__(self, dataset:Dataset, patches_per_volume:int, queue_size:Optional[int]=None,
+                 indices:Optional[Sequence[int]]=None, shuffle:bool=True, transform:Optional[Callable]=None,
+                 num_replicas:int=1, rank:int=0, seed:int=0):
+        self.dataset = dataset
+        self.patches_per_volume = max(patches_per_volume, 1)
+        self.queue_size = max(queue_size or 4 * self.patches_per_volume, 1)
+        self.indices = list(range(len(dataset)) if indices is None else indices)
+        self.shuffle = shuffle
+        self.transform = transform
+        self.num_replicas, self.rank, self.seed = num_replicas, rank, seed
+        self._epoch = 0  # epoch of the next iteration
+
+    def __len__(self):
+        n = len(self.indices)
+        n = math.ceil(n / self.num_replicas) if self.shuffle else len(range(self.rank, n, self.num_replicas))
+        return n * self.patches_per_volume
+
+    def set_epoch(self, epoch:int):
+        """ set the epoch of the next iteration (as with DistributedSampler), which is then counted by the copies
+        of persistent dataloader workers """
+        self._epoch = epoch
+
+    def _replica_items(self, epoch:int) -> Sequence[int]:
+        """ items of this process in distributed training """
+        items = list(self.indices)
+        if not self.shuffle or len(items) == 0: return items[self.rank::self.num_replicas]
+        items = np.random.RandomState((self.seed + epoch) % (1 << 32)).permutation(items).tolist()
+        total = math.ceil(len(items) / self.num_replicas) * self.num_replicas
+        items = (items * math.ceil(total / len(items)))[:total]
+        return items[self.rank::self.num_replicas]
+
+    def _items(self, epoch:int) -> Sequence[int]:
+        """ items visited by this process (all of them, or a disjoint part in a dataloader worker) this epoch """
+        info = get_worker_info()
+        if self.num_replicas > 1:
+            items = self._replica_items(epoch)
+            return items if info is None else items[info.id::info.num_workers]
+        if not self.shuffle:
+            return self.indices if info is None else self.indices[info.id::info.num_workers]
+        if info is None: return np.random.permutation(self.indices).tolist()
+        # the workers of an epoch share a base seed, so they split the same permutation (the epoch is counted,
+        # since persistent workers keep their seed)
+        rng = np.random.RandomState((info.seed - info.id + epoch) % (1 << 32))
+        return rng.permutation(self.indices).tolist()[info.id::info.num_workers]
+
+    def _samples(self, epoch:int):
+        for idx in self._items(epoch):
+            if self.transform is None:
+                for _ in range(self.patches_per_volume): yield self.dataset[idx]
+            else:
+                volume = self.dataset[idx]
+                for _ in range(self.patches_per_volume): yield self.transform(volume)
+                del volume
+
+    def __iter__(self):
+        epoch, self._epoch = self._epoch, self._epoch + 1
+        if not self.shuffle:
+            yield from self._samples(epoch)
+            return
+        buffer = []
+        for sample in self._samples(epoch):
+            if len(buffer) < self.queue_size:
+                buffer.append(sample)
+                continue
+            i = np.random.randint(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield sample
+        np.random.shuffle(buffer)
+        yield from buffer
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.stats
+
+streaming statistics of (monte carlo dropout) network outputs
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['mc_predict',
+           'RunningStats']
+
+import re
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+from ..errors import SynthNNError
+
+
+class RunningStats:
+    """
+    streaming mean and variance (Welford's algorithm, with Chan's update to add
+    several samples at once), such that memory does not grow with the number of samples
+
+    Args:
+        stats (Sequence[str]): statistics to be computed, one of: mean, var, std, or qN
+            for the N-th percentile (e.g., q5, q50, q95); note that percentiles are computed
+            from all of the samples, so the samples are kept only if a percentile is requested
+    """
+    def __init__(self, stats:Sequence[str]=('mean', 'var')):
+        for s in stats:
+            if s not in ('mean', 'var', 'std') and re.fullmatch(r'q\d+(\.\d+)?', s) is None:
+                raise SynthNNError(f'Statistic: "{s}" not a valid statistic or not supported.')
+        self.stats = list(stats)
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self.samples = [] if any(s.startswith('q') for s in stats) else None
+
+    def update(self, samples:np.ndarray):
+        """ add samples (stacked in the first dimension) to the statistics """
+        k = samples.shape[0]
+        mean = samples.mean(axis=0)
+        m2 = ((samples - mean) ** 2).sum(axis=0)
+        if self.n == 0:
+            self.mean, self.m2 = mean, m2
+        else:
+            delta = mean - self.mean
+            n = self.n + k
+            self.mean += delta * (k / n)
+            self.m2 += m2 + delta ** 2 * (self.n * k / n)
+        self.n += k
+        if self.samples is not None: self.samples.append(samples)
+
+    @property
+    def var(self) -> np.ndarray:
+        return self.m2 / self.n
+
+    def get(self, stat:str) -> np.ndarray:
+        if stat == 'mean': return self.mean
+        if stat == 'var': return self.var
+        if stat == 'std': return np.sqrt(self.var)
+        return np.percentile(np.concatenate(self.samples), float(stat[1:]), axis=0)
+
+    def result(self) -> List[np.ndarray]:
+        """ requested statistics (in order) """
+        return [self.get(s) for s in self.stats]
+
+
+def mc_predict(predict_fn:Callable[[torch.Tensor], np.ndarray], x:torch.Tensor, n_samples:int,
+               max_batch:Optional[int]=None, stats:Sequence[str]=('mean',)) -> RunningStats:
+    """
+    run a (stochastic, e.g., with dropout enabled) network multiple times on the same input,
+    where the samples are folded into the batch dimension (up to max_batch inputs per forward pass)
+    and accumulated in a single pass with RunningStats
+
+    Args:
+        predict_fn (Callable): function which takes a batch ([N,C,...] tensor) and returns the output as numpy array
+        x (torch.Tensor): input batch
+        n_samples (int): number of (monte carlo) samples to draw for each input
+        max_batch (int): maximum number of inputs per forward pass [Default=size of x]
+        stats (Sequence[str]): statistics to compute (see RunningStats)
+
+    Returns:
+        running_stats (RunningStats): statistics of the output for each input in x
+    """
+    running_stats = RunningStats(stats)
+    bs = x.shape[0]
+    per_pass = max((max_batch or bs) // bs, 1)  # number of samples per forward pass
+    for i in range(0, n_samples, per_pass):
+        k = min(per_pass, n_samples - i)
+        out = predict_fn(x.repeat(k, *([1] * (x.ndim - 1))) if k > 1 else x)
+        running_stats.update(out.reshape((k, bs) + out.shape[1:]))
+    return running_stats
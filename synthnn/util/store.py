@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.store
+
+a preprocessed dataset store, i.e., the source and target images of each
+subject decoded once into an uncompressed file of cubic chunks (with an
+index of the shapes, dtypes, and intensity statistics of the images), from
+which random crops and slices are read by reading only the chunks they touch
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['build_store',
+           'ChunkStore',
+           'StoreDataset']
+
+import hashlib
+import json
+import logging
+import math
+import os
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from ..errors import SynthNNError
+from .cache import CACHE_DTYPES, load_volume
+from .io import glob_nii, glob_tiff, split_filename
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+
+_INDEX = 'index.json'
+
+
+def _file_info(fn:str) -> list:
+    st = os.stat(fn)
+    return [os.path.abspath(fn), st.st_size, st.st_mtime_ns]
+
+
+def _channel_stats(x:np.ndarray) -> dict:
+    return dict(min=float(x.min()), max=float(x.max()), mean=float(x.mean(dtype=np.float64)),
+                std=float(x.std(dtype=np.float64)))
+
+
+def _write_chunks(fn:str, x:np.ndarray, chunk_size:int, dtype:np.dtype):
+    """
+    write an image [C,...] as an .npy file of chunks [N_1,...,N_n,C,c,...,c], i.e., the image (padded with zeros
+    to a multiple of the chunk size c) split into cubes (squares for 2d images) of c voxels per side, each stored
+    contiguously; the file is written one slab of chunks at a time (to a temporary file which is then renamed)
+    """
+    c, n_ch, spatial = chunk_size, x.shape[0], x.shape[1:]
+    n_chunks = tuple(math.ceil(s / c) for s in spatial)
+    tmp_fn = f'{fn}.{os.getpid()}.tmp'
+    out = np.lib.format.open_memmap(tmp_fn, 'w+', dtype, n_chunks + (n_ch,) + (c,) * len(spatial))
+    # axes of a slab reshaped to [C,c,N_2,c,...,N_n,c] in the order [N_2,...,N_n,C,c,...,c]
+    perm = [2 * k for k in range(1, len(spatial))] + [0, 1] + [2 * k + 1 for k in range(1, len(spatial))]
+    for i in range(n_chunks[0]):
+        slab = np.zeros((n_ch, c) + tuple(n * c for n in n_chunks[1:]), dtype=dtype)
+        part = x[:, i * c:(i + 1) * c]
+        slab[(slice(None),) + tuple(slice(0, s) for s in part.shape[1:])] = part
+        slab = slab.reshape((n_ch, c) + tuple(d for n in n_chunks[1:] for d in (n, c)))
+        out[i] = slab.transpose(perm)
+    out.flush()
+    del out
+    os.replace(tmp_fn, fn)
+
+
+def build_store(path:str, source_dirs:Sequence[str], target_dirs:Sequence[str], chunk_size:int=32,
+                dtype:str='float32', tiff:bool=False) -> Tuple[int, int]:
+    """
+    create a dataset store from directories of source and target images (matched by their sorted order, as in
+    niftidataset's datasets), or add the subjects which are new (or whose images changed) to an existing store
+
+    Args:
+        path (str): directory of the store (created if it does not exist)
+        source_dirs (Sequence[str]): directories with the source images (one per input channel)
+        target_dirs (Sequence[str]): directories with the target images (one per output channel)
+        chunk_size (int): number of voxels per side of a chunk
+        dtype (str): dtype of the stored images (see CACHE_DTYPES)
+        tiff (bool): the images are TIFF images instead of NIfTI images
+
+    Returns:
+        n_added (int): number of subjects written to the store
+        n_skipped (int): number of subjects already in the store (and unchanged)
+    """
+    if dtype not in CACHE_DTYPES:
+        raise SynthNNError(f'Invalid store dtype: {dtype}. {{{", ".join(CACHE_DTYPES)}}} are the only supported options.')
+    if chunk_size < 1: raise SynthNNError(f'Invalid chunk size: {chunk_size}.')
+    glob_imgs = glob_tiff if tiff else glob_nii
+    fns = [glob_imgs(d) for d in list(source_dirs) + list(target_dirs)]
+    n_imgs = [len(f) for f in fns]
+    if min(n_imgs) == 0 or len(set(n_imgs)) != 1:
+        raise SynthNNError(f'Each source and target directory must have the same (nonzero) number of images, '
+                           f'found {n_imgs} images in {list(source_dirs) + list(target_dirs)}.')
+    n_input = len(source_dirs)
+    os.makedirs(path, exist_ok=True)
+    options = dict(chunk_size=chunk_size, dtype=dtype, n_input=n_input, n_output=len(target_dirs), tiff=tiff)
+    if os.path.exists(os.path.join(path, _INDEX)):
+        index = ChunkStore(path).index
+        mismatch = {k: index[k] for k, v in options.items() if index[k] != v}
+        if mismatch:
+            raise SynthNNError(f'Store {path} was built with {mismatch}, which does not match {options}.')
+    else:
+        index = dict(version=STORE_VERSION, source_dirs=[os.path.abspath(d) for d in source_dirs],
+                     target_dirs=[os.path.abspath(d) for d in target_dirs], subjects=[], **options)
+    subjects = {tuple(f[0] for f in s['files']): i for i, s in enumerate(index['subjects'])}
+    n_added = n_skipped = 0
+    for subj_fns in zip(*fns):
+        files = [_file_info(fn) for fn in subj_fns]
+        key = tuple(f[0] for f in files)
+        i = subjects.get(key)
+        if i is not None and index['subjects'][i]['files'] == files:
+            n_skipped += 1
+            continue
+        vols = [load_volume(fn) for fn in subj_fns]
+        if any(v.shape != vols[0].shape for v in vols):
+            raise SynthNNError(f'Images do not have the same shape: {", ".join(f"{fn} {v.shape}" for fn, v in zip(subj_fns, vols))}')
+        x = np.stack(vols)
+        del vols
+        if dtype == 'float16' and np.abs(x).max() > np.finfo(np.float16).max:
+            raise SynthNNError(f'Intensities of {subj_fns} overflow float16, store the images as float32 instead.')
+        name = split_filename(subj_fns[0])[1]
+        chunk_fn = f'{name}-{hashlib.sha1(json.dumps(key).encode()).hexdigest()[:12]}.npy'
+        _write_chunks(os.path.join(path, chunk_fn), x, chunk_size, np.dtype(dtype))
+        subject = dict(name=name, files=files, file=chunk_fn, shape=list(x.shape[1:]),
+                       stats=[_channel_stats(ch) for ch in x])
+        if i is None:
+            subjects[key] = len(index['subjects'])
+            index['subjects'].append(subject)
+        else:
+            index['subjects'][i] = subject
+        n_added += 1
+        logger.info(f'Stored {name} {tuple(x.shape[1:])} ({n_added + n_skipped}/{n_imgs[0]})')
+        _write_index(path, index)  # after each subject, so an interrupted build keeps the subjects stored so far
+    return n_added, n_skipped
+
+
+def _write_index(path:str, index:dict):
+    tmp_fn = os.path.join(path, f'.{_INDEX}.{os.getpid()}.tmp')
+    with open(tmp_fn, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_fn, os.path.join(path, _INDEX))
+
+
+class ChunkStore:
+    """
+    reader of a dataset store (see build_store), whose chunk files are memory-mapped (when first read in a
+    process, so the store can be passed to dataloader workers) and from which regions are read chunk by chunk
+
+    Args:
+        path (str): directory of the store
+    """
+    def __init__(self, path:str):
+        try:
+            with open(os.path.join(path, _INDEX)) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError) as e:
+            raise SynthNNError(f'{path} is not a dataset store (see nn-cache): {e}')
+        if self.index.get('version') != STORE_VERSION:
+            raise SynthNNError(f'Unsupported store version {self.index.get("version")} (expected {STORE_VERSION}).')
+        self.path = path
+        self.subjects = self.index['subjects']
+        self.chunk_size = self.index['chunk_size']
+        self.n_input, self.n_output = self.index['n_input'], self.index['n_output']
+        self.tiff = self.index['tiff']
+        self._chunks = {}
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_chunks'] = {}  # reopen the memory maps instead of pickling their data
+        return state
+
+    def shape(self, idx:int) -> Tuple[int, ...]:
+        """ spatial shape of the images of a subject """
+        return tuple(self.subjects[idx]['shape'])
+
+    def stats(self, idx:int) -> List[dict]:
+        """ intensity statistics (min, max, mean, std) of each (source then target) image of a subject """
+        return self.subjects[idx]['stats']
+
+    def chunks(self, idx:int) -> np.memmap:
+        """ chunks [N_1,...,N_n,C,c,...,c] of a subject (see _write_chunks) """
+        chunks = self._chunks.get(idx)
+        if chunks is None:
+            chunks = self._chunks[idx] = np.load(os.path.join(self.path, self.subjects[idx]['file']), mmap_mode='r')
+        return chunks
+
+    def read(self, idx:int, region:Optional[Sequence[Tuple[int, int]]]=None) -> np.ndarray:
+        """
+        read a region of the (source then target) images of a subject
+
+        Args:
+            idx (int): index of the subject
+            region (Sequence[Tuple[int,int]]): start and stop along each spatial axis [Default=the whole image]
+
+        Returns:
+            x (np.ndarray): the region as a (writable) float32 array [C,...]
+        """
+        shape, c = self.shape(idx), self.chunk_size
+        region = [(0, s) for s in shape] if region is None else region
+        if len(region) != len(shape) or any(not 0 <= a < b <= s for (a, b), s in zip(region, shape)):
+            raise SynthNNError(f'Invalid region {region} for an image of shape {shape}.')
+        first = [a // c for a, _ in region]
+        chunks = self.chunks(idx)[tuple(slice(f, (b - 1) // c + 1) for f, (_, b) in zip(first, region))]
+        n, n_ch = len(shape), chunks.shape[len(shape)]
+        perm = [n] + [ax for k in range(n) for ax in (k, n + 1 + k)]  # [C,N_1,c,...,N_n,c]
+        x = chunks.transpose(perm).reshape((n_ch,) + tuple(m * c for m in chunks.shape[:n]))
+        x = x[(slice(None),) + tuple(slice(a - f * c, b - f * c) for f, (a, b) in zip(first, region))]
+        return np.array(x, dtype=np.float32)
+
+
+class StoreDataset(Dataset):
+    """
+    dataset of (source, target) samples read from a ChunkStore, where each sample is cropped as
+    by niftidataset's transforms (RandomCrop3D, RandomCrop2D, or RandomSlice for NIfTI images, and
+    the whole image for TIFF images) but only the chunks the crop touches are read
+
+    Args:
+        store (ChunkStore): store to read the samples from
+        patch_size (int): patch size (cubed for 3d, squared for 2d), 0 uses the whole image (3d) or slice (2d)
+        net3d (bool): sample 3d patches instead of 2d slices (ignored for TIFF images)
+        sample_axis (int): axis to sample 2d slices along (None picks a random axis per sample)
+        transform (Callable): transform applied to each (source, target) sample [Default=None]
+    """
+    def __init__(self, store:ChunkStore, patch_size:int=64, net3d:bool=False, sample_axis:Optional[int]=2,
+                 transform:Optional[Callable]=None):
+        self.store = store
+        self.patch_size = patch_size
+        self.net3d = net3d
+        self.sample_axis = sample_axis
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.store)
+
+    def _crop(self, shape:Sequence[int]) -> List[Tuple[int, int]]:
+        psz = self.patch_size
+        if psz <= 0: return [(0, s) for s in shape]
+        region = []
+        for s in shape:
+            start = np.random.randint(0, s - psz + 1) if s > psz else 0
+            region.append((start, start + min(psz, s)))
+        return region
+
+    def __getitem__(self, idx:int):
+        shape = self.store.shape(idx)
+        axis = None
+        if self.store.tiff:
+            region = [(0, s) for s in shape]
+        elif self.net3d:
+            region = self._crop(shape)
+        else:
+            axis = self.sample_axis if self.sample_axis is not None else np.random.randint(0, len(shape))
+            i = np.random.randint(0, shape[axis])
+            region = self._crop(shape[:axis] + shape[axis+1:])
+            region.insert(axis, (i, i + 1))
+        x = self.store.read(idx, region)
+        if axis is not None: x = x[(slice(None),) * (axis + 1) + (0,)]
+        sample = (np.ascontiguousarray(x[:self.store.n_input]), np.ascontiguousarray(x[self.store.n_input:]))
+        return self.transform(sample) if self.transform is not None else sample
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+synthnn.util.writer
+
+write NIfTI images with selectable compression (none, single-stream gzip
+at a given level, or block gzip compressed on multiple threads) on a
+pool of background threads
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+__all__ = ['BgzfWriter',
+           'COMPRESSIONS',
+           'NiftiWriter',
+           'output_ext',
+           'write_nifti']
+
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+import gzip
+import io
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Callable, Optional, Sequence
+
+import nibabel as nib
+from nibabel.fileholders import FileHolder
+
+from ..errors import SynthNNError
+from .io import split_filename
+from .pipeline import BackgroundExecutor
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = ('none', 'gzip', 'bgzip')
+
+_BGZF_BLOCK = 0xff00  # uncompressed bytes per block (as in bgzip), so a compressed block fits in 64 KiB
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def _bgzf_block(data:bytes, level:int) -> bytes:
+    """ compress data into a single BGZF block, i.e., a gzip member whose extra field holds the block size """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)  # raw deflate, the gzip header and footer are added here
+    deflated = c.compress(data) + c.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                         len(deflated) + 25)  # total block size minus one (18 header + 8 footer bytes)
+    return header + deflated + struct.pack('<2I', zlib.crc32(data), len(data))
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    write-only file object which compresses its input in BGZF format (blocked gzip, as written by bgzip), where
+    the blocks are compressed in parallel on an executor (zlib releases the gil); the output is a multi-member
+    gzip file, which standard gzip readers (e.g., gzip, zlib, nibabel) read like a single-stream gzip file
+
+    Args:
+        fileobj (io.IOBase): (binary) file object to write the compressed data to (not closed by this writer)
+        level (int): compression level (1 is fastest, 9 compresses most) [Default=6]
+        executor (Executor): executor to compress the blocks on [Default=compress in the calling thread]
+        max_pending (int): maximum number of blocks being compressed at once [Default=4]
+    """
+    def __init__(self, fileobj, level:int=6, executor:Optional[Executor]=None, max_pending:int=4):
+        super().__init__()
+        self.fileobj = fileobj
+        self.level = level
+        self.executor = executor
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET and offset == self.pos: return self.pos
+        raise io.UnsupportedOperation('BgzfWriter can only write sequentially')
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.buffer += data
+        self.pos += len(data)
+        while len(self.buffer) >= _BGZF_BLOCK:
+            self._submit(bytes(self.buffer[:_BGZF_BLOCK]))
+            del self.buffer[:_BGZF_BLOCK]
+        return len(data)
+
+    def _submit(self, block:bytes):
+        if self.executor is None:
+            self.fileobj.write(_bgzf_block(block, self.level))
+            return
+        self.pending.append(self.executor.submit(_bgzf_block, block, self.level))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())  # blocks are written in order
+
+    def close(self):
+        if self.closed: return
+        try:
+            if self.buffer: self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+            while self.pending: self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(_BGZF_EOF)
+        finally:
+            super().close()
+
+
+def output_ext(compression:str) -> str:
+    """ file extension of the images written with a compression (see COMPRESSIONS) """
+    if compression not in COMPRESSIONS:
+        raise SynthNNError(f'Invalid compression: {compression}. {{{", ".join(COMPRESSIONS)}}} are the only supported options.')
+    return '.nii' if compression == 'none' else '.nii.gz'
+
+
+def write_nifti(img:nib.Nifti1Image, fn:str, compression:str='gzip', level:Optional[int]=None,
+                executor:Optional[Executor]=None, max_pending:int=4):
+    """
+    write a NIfTI image with a compression (see COMPRESSIONS), where gzip uses nibabel's default
+    level if level is None and bgzip compresses the blocks on the executor (if given)
+    """
+    output_ext(compression)
+    if compression == 'none' or (compression == 'gzip' and level is None):
+        img.to_filename(fn)
+        return
+    with open(fn, 'wb') as f:
+        if compression == 'gzip':
+            cf = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level, mtime=0)
+        else:
+            cf = BgzfWriter(f, 6 if level is None else level, executor, max_pending)
+        with cf:
+            img.to_file_map({'image': FileHolder(fileobj=cf)})
+
+
+class NiftiWriter:
+    """
+    write NIfTI images on background threads, where each image is written by its own job (so, e.g., the output
+    channels of a subject are written concurrently) and submitting blocks while max_pending jobs are outstanding;
+    images are written to a temporary file which is then renamed, so partially written images never exist
+
+    errors raised when writing are re-raised on the next call to submit or wait, or on close
+
+    Args:
+        compression (str): compression of the images (see COMPRESSIONS) [Default=gzip]
+        level (int): compression level (1 is fastest, 9 compresses most) [Default=nibabel's default for gzip, 6 for bgzip]
+        n_threads (int): number of threads writing images (and compressing blocks for bgzip) [Default=1]
+        max_pending (int): maximum number of submitted but unwritten images [Default=n_threads]
+    """
+    def __init__(self, compression:str='gzip', level:Optional[int]=None, n_threads:int=1,
+                 max_pending:Optional[int]=None):
+        output_ext(compression)
+        self.compression = compression
+        self.level = level
+        self.n_threads = max(n_threads or 1, 1)
+        self.saver = BackgroundExecutor(max_pending or self.n_threads, self.n_threads)
+        # blocks are compressed on a separate pool, since the write jobs wait for them
+        self.compressor = ThreadPoolExecutor(self.n_threads) if compression == 'bgzip' and self.n_threads > 1 else None
+
+    def write(self, img:nib.Nifti1Image, fn:str):
+        """ write an image in the calling thread """
+        path, base, ext = split_filename(fn)
+        tmp_fn = os.path.join(path, f'.{base}.tmp{ext}')
+        write_nifti(img, tmp_fn, self.compression, self.level, self.compressor, 2 * self.n_threads)
+        os.replace(tmp_fn, fn)
+
+    def submit(self, imgs:Sequence[nib.Nifti1Image], fns:Sequence[str], callback:Optional[Callable[[], None]]=None):
+        """ write the images concurrently and call callback (on a writer thread) once all of them are written """
+        remaining = [len(imgs)]
+        lock = threading.Lock()
+        def job(img, fn):
+            self.write(img, fn)
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done and callback is not None: callback()
+        for img, fn in zip(imgs, fns): self.saver.submit(job, img, fn)
+        if not imgs and callback is not None: callback()
+
+    def wait(self):
+        """ wait until all submitted images are written """
+        for f in list(self.saver.futures): f.result()
+        self.saver._check()
+
+    def close(self):
+        try:
+            self.saver.close()
+        finally:
+            if self.compressor is not None: self.compressor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.saver.__exit__(exc_type, exc_val, exc_tb)
+            if self.compressor is not None: self.compressor.shutdown(wait=True)
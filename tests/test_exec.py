@@ -15,11 +15,22 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
 import unittest
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
+import torch
 
 from synthnn.exec.nn_train import main as nn_train
+from synthnn.exec.nn_cache import main as nn_cache
 from synthnn.exec.nn_predict import main as nn_predict
+from synthnn.exec.nn_export import main as nn_export
+from synthnn.exec.nn_serve import request_stats, request_synthesis, ServedModel, SynthesisServer
+from synthnn import BatchAugment, CachedDataset, ChunkStore, copy_sample, Predictor
 from synthnn.util.io import glob_nii, split_filename
+from synthnn.util.patch import min_patch_stride
 
 try:
     import fastai
@@ -52,14 +63,15 @@ class TestCLI(unittest.TestCase):
         self.predict_args = f'-s {self.train_dir} -o {self.out_dir}/test'.split()
         self.jsonfn = f'{self.out_dir}/test.json'
 
-    def __modify_ocf(self, jsonfn, multi=1, temperature_map=False, calc_var=False):
+    def __modify_ocf(self, jsonfn, multi=1, temperature_map=False, calc_var=False, predict_dir=None, **predict_options):
         with open(jsonfn, 'r') as f:
             arg_dict = json.load(f)
         with open(jsonfn, 'w') as f:
-            arg_dict['Required']['predict_dir'] = [f'{self.nii_dir}'] * multi
+            arg_dict['Required']['predict_dir'] = [predict_dir or f'{self.nii_dir}'] * multi
             arg_dict['Required']['predict_out'] = f'{self.out_dir}/test'
             arg_dict['Prediction Options']['calc_var'] = calc_var
             arg_dict['Prediction Options']['temperature_map'] = temperature_map
+            arg_dict['Prediction Options'].update(predict_options)
             json.dump(arg_dict, f, sort_keys=True, indent=2)
 
     def test_nconv_nopatch_cli(self):
@@ -81,6 +93,61 @@ class TestCLI(unittest.TestCase):
         retval = nn_predict([self.jsonfn])
         self.assertEqual(retval, 0)
 
+    def test_nconv_cache_cli(self):
+        for cache in ('memory', 'shared'):
+            args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 2 -nl 1 -ps 16 '
+                                      f'-ocf {self.jsonfn} -bs 2 -n 2 --cache {cache} --cache-memory 64M').split()
+            retval = nn_train(args)
+            self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
+    def test_nconv_cache_tiff_cli(self):
+        train_args = f'-s {self.train_dir}/1/ -t {self.train_dir}/2/'.split()
+        cache_dir = os.path.join(self.out_dir, 'cache')
+        args = train_args + (f'-o {self.out_dir}/nconv.mdl -na nconv -ne 2 -nl 1 -ps 0 -bs 2 --tiff '
+                             f'--cache shared --cache-dtype float16 --cache-dir {cache_dir}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.assertTrue(os.listdir(cache_dir))
+
+    def test_nconv_store_cli(self):
+        store = os.path.join(self.out_dir, 'store')
+        retval = nn_cache(self.train_args + f'-o {store} -cs 8'.split())
+        self.assertEqual(retval, 0)
+        subjects = ChunkStore(store).subjects
+        shape = list(nib.load(glob_nii(self.nii_dir)[0]).shape)
+        self.assertEqual([s['shape'] for s in subjects], [shape] * 8)
+        mtimes = [os.path.getmtime(os.path.join(store, s['file'])) for s in subjects]
+        retval = nn_cache(self.train_args + f'-o {store} -cs 8'.split())  # the unchanged subjects are skipped
+        self.assertEqual(retval, 0)
+        self.assertEqual(ChunkStore(store).subjects, subjects)
+        self.assertEqual([os.path.getmtime(os.path.join(store, s['file'])) for s in subjects], mtimes)
+        for net3d in ('', '-3d'):
+            args = (f'--store {store} -o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 '
+                    f'-ocf {self.jsonfn} -bs 2 -n 2 {net3d}').split()
+            retval = nn_train(args)
+            self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
+    def test_nconv_patches_per_volume_cli(self):
+        for n_jobs in (0, 2):
+            args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 -3d '
+                                      f'-ocf {self.jsonfn} -bs 4 -ppv 4 -qs 8 -n {n_jobs} --cache memory').split()
+            # count the volume loads and the patches (cropped from the cached volumes) in this process
+            with mock.patch.object(CachedDataset, '__getitem__', autospec=True, side_effect=CachedDataset.__getitem__) as load, \
+                 mock.patch('synthnn.exec.nn_train.copy_sample', side_effect=copy_sample) as crop:
+                retval = nn_train(args)
+            self.assertEqual(retval, 0)
+            if n_jobs == 0:  # each of the 8 (training and validation) volumes is loaded once for its 4 patches
+                self.assertEqual((load.call_count, crop.call_count), (8, 32))
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
     def test_nconv_lr_scheduler_cli(self):
         args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 3 -nl 1 -ps 16 '
                                   f'-ocf {self.jsonfn} -bs 2 -lrs -v').split()
@@ -113,6 +180,30 @@ class TestCLI(unittest.TestCase):
         retval = nn_predict([self.jsonfn])
         self.assertEqual(retval, 0)
 
+    def test_nconv_batch_augment_3d_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 2 -ps 16 -bs 2 '
+                                  f'-ocf {self.jsonfn} --net3d --batch-augment -p 1 1 1 1 -r 10 -ts 0.1 -sc 0.1 '
+                                  f'-hf -vf -g 0.01 -gn 0.01 -std 1 -tx -ty').split()
+        batches = []
+        def augment(self, src, tgt):
+            out = BatchAugment.__call__(self, src, tgt)
+            batches.append((src.shape, out[0].shape, torch.equal(src, out[0])))
+            return out
+        # the whole batches are augmented (on the device) instead of each sample in the dataloader workers
+        with mock.patch.object(BatchAugment, '__call__', augment), \
+             mock.patch('niftidataset.transforms.get_transforms') as get_transforms:
+            retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        get_transforms.assert_not_called()
+        self.assertTrue(batches)
+        for src_shape, out_shape, unchanged in batches:
+            self.assertTrue(len(src_shape) == 5 and src_shape[0] <= 2)  # [N,C,H,W,D] batches of up to -bs samples
+            self.assertEqual(out_shape, src_shape)
+            self.assertFalse(unchanged)  # with -p 1 1 1 1 (and noise), every batch is augmented
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
     def test_nconv_clip_cli(self):
         args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 '
                                   f'-ocf {self.jsonfn} -bs 2 -c 0.25').split()
@@ -150,6 +241,44 @@ class TestCLI(unittest.TestCase):
         retval = nn_predict([self.jsonfn])
         self.assertEqual(retval, 0)
 
+    def test_unet_precision_bf16_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 2 -nl 3 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn} --precision bf16 -cl').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
+    def test_unet_ord_precision_bf16_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -ps 16 -bs 2 '
+                                  f'-ocf {self.jsonfn} -ord 1 10 2 -vs 0.5 --precision bf16').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+
+    def test_nconv_distributed_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/nconv.mdl -na nconv -ne 2 -nl 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn} --distributed --nproc 2 --dist-backend gloo').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        state_dict = torch.load(f'{self.out_dir}/nconv.mdl', map_location='cpu')
+        self.assertFalse(any(k.startswith('module.') for k in state_dict))  # the network itself, not the DDP wrapper
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        out = nib.load(f'{self.out_dir}/testtest_0.nii.gz').get_fdata(dtype=np.float32)
+        img = nib.load(glob_nii(self.nii_dir)[0]).get_fdata(dtype=np.float32)
+        self.assertTrue(np.allclose(out, Predictor.from_config(self.jsonfn).predict(img)[0], atol=1e-5))
+
+    def test_unet_distributed_patches_per_volume_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn} --distributed -ppv 2 -n 1').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
     def test_unet_cli(self):
         args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 3 -cbp 1 -ps 16 -bs 2 --net3d '
                                   f'-ocf {self.jsonfn}').split()
@@ -159,6 +288,195 @@ class TestCLI(unittest.TestCase):
         retval = nn_predict([self.jsonfn])
         self.assertEqual(retval, 0)
 
+    def test_unet_patch_stride_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 3 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        for stride, weight in ((12, 'gaussian'), (12, 'linear'), ('auto', 'uniform')):
+            self.__modify_ocf(self.jsonfn, patch_stride=stride, patch_weight=weight)
+            retval = nn_predict([self.jsonfn])
+            self.assertEqual(retval, 0)
+
+    def test_nconv_queue_depth_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 '
+                                  f'-ocf {self.jsonfn} -bs 2').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, queue_depth=2, output_dtype='int16')
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
+    def test_nconv_workers_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 '
+                                  f'-ocf {self.jsonfn} -bs 2').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, workers=2, threads=1, cpu_affinity=True)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, workers=1, shard='0/2')
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
+    def test_nconv_memory_map_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 '
+                                  f'-ocf {self.jsonfn} -bs 2').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        predict_dir = os.path.join(self.out_dir, 'predict')
+        os.mkdir(predict_dir)
+        nib.save(nib.load(glob_nii(self.nii_dir)[0]), os.path.join(predict_dir, 'test.nii'))  # uncompressed
+        out = []
+        for memory_map in (True, False):
+            self.__modify_ocf(self.jsonfn, predict_dir=predict_dir, memory_map=memory_map)
+            retval = nn_predict([self.jsonfn])
+            self.assertEqual(retval, 0)
+            out.append(nib.load(f'{self.out_dir}/testtest_0.nii.gz').get_fdata(dtype=np.float32))
+        self.assertTrue(np.array_equal(out[0], out[1]))  # the lazily read inputs give the same output
+
+    def test_nconv_resume_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 '
+                                  f'-ocf {self.jsonfn} -bs 2').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, resume=True)
+        predict_dir = os.path.join(self.out_dir, 'predict')
+        os.mkdir(predict_dir)
+        nii = glob_nii(self.nii_dir)[0]
+        shutil.copy(nii, predict_dir)
+        with open(self.jsonfn, 'r') as f:
+            arg_dict = json.load(f)
+        arg_dict['Required']['predict_dir'] = [predict_dir]
+        with open(self.jsonfn, 'w') as f:
+            json.dump(arg_dict, f, sort_keys=True, indent=2)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        out_fn = f'{self.out_dir}/testtest_0.nii.gz'
+        mtime = os.path.getmtime(out_fn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        self.assertEqual(os.path.getmtime(out_fn), mtime)
+        # an image added to the prediction directory (which sorts first) is predicted, the finished one is kept
+        shutil.copy(nii, os.path.join(predict_dir, 'a.nii.gz'))
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        self.assertEqual(os.path.getmtime(out_fn), mtime)
+        self.assertTrue(os.path.isfile(f'{self.out_dir}/testa_0.nii.gz'))
+
+    def test_unet_autotune_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, autotune=True, memory_budget='1G')
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        self.assertTrue(os.path.isfile(f'{self.out_dir}/unet.autotune.json'))
+        with open(f'{self.out_dir}/unet.autotune.json') as f:
+            plan, = json.load(f).values()
+        if plan['patch_size'] > 0:  # tiled with the configured (default) stride, never collapsed to one
+            self.assertGreaterEqual(plan['patch_stride'] or plan['patch_size'] // 2, min_patch_stride(plan['patch_size']))
+        retval = nn_predict([self.jsonfn])  # uses the cached plan
+        self.assertEqual(retval, 0)
+
+    def test_nconv_output_compression_cli(self):
+        args = self.train_args + f'-o {self.out_dir}/nconv.mdl -na nconv -ne 1 -nl 2 -bs 2 -ocf {self.jsonfn}'.split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, output_compression='bgzip', compression_level=1, writer_threads=2, queue_depth=1)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        with open(f'{self.out_dir}/testtest_0.nii.gz', 'rb') as f:
+            header = f.read(14)
+        self.assertEqual((header[:4], header[12:14]), (b'\x1f\x8b\x08\x04', b'BC'))  # gzip with the bgzf extra field
+        self.__modify_ocf(self.jsonfn, output_compression='none')
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        out = nib.load(f'{self.out_dir}/testtest_0.nii').get_fdata(dtype=np.float32)
+        self.assertTrue(np.array_equal(out, nib.load(f'{self.out_dir}/testtest_0.nii.gz').get_fdata(dtype=np.float32)))
+
+    def test_unet_foreground_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        out_fn = f'{self.out_dir}/testtest_0.nii.gz'
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        full = nib.load(out_fn).get_fdata(dtype=np.float32)
+        self.__modify_ocf(self.jsonfn, foreground_threshold='otsu')
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, foreground_threshold=None, mask_dir=self.mask_dir, background_value=-7.)
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        out = nib.load(out_fn).get_fdata(dtype=np.float32)
+        mask = nib.load(glob_nii(self.mask_dir)[0]).get_fdata() != 0
+        self.assertTrue(np.allclose(out[mask], full[mask], atol=1e-5))  # the foreground is unchanged
+        background = out == -7.
+        self.assertTrue(background.any())  # patches without foreground are skipped
+        self.assertFalse((background & mask).any())
+
+    def test_unet_out_of_core_cli(self):
+        args = self.train_args + f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -bs 4 -ocf {self.jsonfn}'.split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, max_memory='1M', scratch_dir=self.out_dir)  # the image and output need > 1MB
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
+    def test_unet_export_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn)
+        retval = nn_export([self.jsonfn, '-f', 'torchscript'])
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, backend='torchscript')
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+
+    def test_unet_precision_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-ocf {self.jsonfn}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        for precision in ('bf16', 'static_int8'):
+            self.__modify_ocf(self.jsonfn, precision=precision, calibration_dir=[self.nii_dir], n_calibration=1)
+            retval = nn_predict([self.jsonfn])
+            self.assertEqual(retval, 0)
+
+    def test_unet_channels_last_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 2 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'--channels-last -ocf {self.jsonfn}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        out_fn = f'{self.out_dir}/testtest_0.nii.gz'
+        outputs = []
+        for channels_last in (True, False):  # the config predicts as trained, i.e., channels-last
+            self.__modify_ocf(self.jsonfn, channels_last=channels_last)
+            retval = nn_predict([self.jsonfn])
+            self.assertEqual(retval, 0)
+            outputs.append(nib.load(out_fn).get_fdata())
+        self.assertTrue(np.allclose(outputs[0], outputs[1], atol=1e-4))
+
+    def test_unet_mc_stats_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 3 -cbp 1 -ps 16 -bs 2 --net3d '
+                                  f'-dp 0.5 -ocf {self.jsonfn}').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        self.__modify_ocf(self.jsonfn, monte_carlo=4, mc_batch_size=4, mc_stats=['mean', 'var', 'q5', 'q95'])
+        retval = nn_predict([self.jsonfn])
+        self.assertEqual(retval, 0)
+        out = {stat: nib.load(f'{self.out_dir}/testtest_0_{stat}.nii.gz').get_fdata(dtype=np.float32)
+               for stat in ('mean', 'var', 'q5', 'q95')}
+        self.assertTrue(np.all(out['var'] >= 0))
+        self.assertTrue(np.all(out['q5'] <= out['q95'] + 1e-4))
+        self.assertGreater(float(out['var'].max()), 0)  # dropout is active in each monte carlo sample
+
     def test_unet_ord_2d_cli(self):
         train_args = f'-s {self.train_dir}/1/ -t {self.train_dir}/2/'.split()
         args = train_args + (f'-o {self.out_dir}/unet.mdl -na unet -ne 1 -nl 3 -cbp 1 -bs 4 --tiff '
@@ -271,6 +589,23 @@ class TestCLI(unittest.TestCase):
         retval = nn_predict([self.jsonfn])
         self.assertEqual(retval, 0)
 
+    def test_nconv_serve_cli(self):
+        args = self.train_args + (f'-o {self.out_dir}/nconv_patch.mdl -na nconv -ne 1 -nl 1 -ps 16 '
+                                  f'-ocf {self.jsonfn} -bs 2').split()
+        retval = nn_train(args)
+        self.assertEqual(retval, 0)
+        server = SynthesisServer(('127.0.0.1', 0), {'nconv': ServedModel(self.jsonfn, max_batch=4)})
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        port = server.server_address[1]
+        img = nib.load(glob_nii(self.nii_dir)[0]).get_data()
+        out = request_synthesis(img, 'nconv', port=port)
+        self.assertEqual(out.shape, (1,) + img.shape)
+        self.assertTrue(np.allclose(out, Predictor.from_config(self.jsonfn).predict(img), atol=1e-5))
+        self.assertEqual(request_stats(port=port)['nconv']['requests'], 1)
+        server.shutdown()
+        server.server_close()
+
     def tearDown(self):
         shutil.rmtree(self.out_dir)
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+tests.test_inference
+
+test the in-memory predictor for runtime errors and consistency with the network
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from synthnn import (autotune, export_onnx, get_patch_plan, load_backend, export_torchscript, OnnxRuntimeModel, parse_memory, PlanCache,
+                     precision_report, Predictor, reduce_precision, SynthNNError, TorchScriptModel)
+from synthnn.models.nconvnet import SimpleConvNet
+from synthnn.util.exec import AttrDict
+from synthnn.models.unet import Unet
+
+try:
+    import onnx
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class TestInference(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.out_dir = tempfile.mkdtemp()
+        self.img = np.random.randn(1, 12, 10, 8).astype(np.float32)
+
+    def test_predict_2d_matches_model(self):
+        model = Unet(2, channel_base_power=2, is_3d=False, enable_dropout=False).eval()
+        for axis in (0, 1, 2):
+            out = Predictor(model, batch_size=5, sample_axis=axis).predict(self.img)
+            slices = torch.from_numpy(np.moveaxis(self.img, axis + 1, 0).copy())
+            with torch.no_grad():
+                expected = np.moveaxis(model.predict(slices).numpy(), 0, axis + 1)
+            self.assertEqual(out.shape, self.img.shape)
+            self.assertTrue(np.allclose(out, expected, atol=1e-5))
+
+    def test_predict_channels_last(self):
+        for is_3d, kwargs in ((False, dict(batch_size=5)), (True, dict(patch_size=8, batch_size=4))):
+            model = Unet(2, channel_base_power=2, is_3d=is_3d, enable_dropout=False).eval()
+            expected = Predictor(model, **kwargs).predict(self.img)
+            out = Predictor(model, channels_last=True, **kwargs).predict(self.img)
+            self.assertTrue(np.allclose(expected, out, atol=1e-4))
+
+    def test_auto_patch_stride(self):
+        model = Unet(2, channel_base_power=1, is_3d=True, enable_dropout=False).eval()  # receptive field of 46
+        with self.assertLogs('synthnn.inference.predictor', level='WARNING'):
+            predictor = Predictor(model, patch_size=16, patch_stride='auto')
+        self.assertIsNone(predictor.patch_stride)  # the default stride, not a stride of one
+        self.assertEqual(get_patch_plan((40, 40, 40), 16, predictor.patch_stride).stride, 8)
+        self.assertEqual(Predictor(model, patch_size=64, patch_stride='auto').patch_stride, 19)
+        model = Unet(1, channel_base_power=1, is_3d=True, enable_dropout=False).eval()  # receptive field of 16
+        self.assertEqual(Predictor(model, patch_size=32, patch_stride='auto').patch_stride, 17)
+
+    def test_autotune(self):
+        model = Unet(2, channel_base_power=1, is_3d=True, enable_dropout=False).eval()
+        make = lambda **kwargs: Predictor(model, **kwargs)
+        plan = autotune(make, (1, 40, 40, 40), parse_memory('1G'), max_batch=4, patch_sizes=(16, 32), repeats=1)
+        self.assertIn(plan.patch_size, (0, 16, 32))
+        self.assertLessEqual(plan.batch_size, 4)
+        for stride in (None, 'auto', 16):  # the configured stride (a receptive field of 46 falls back to the default)
+            tuned = autotune(make, (1, 40, 40, 40), parse_memory('1G'), max_batch=2, patch_sizes=(16, 32), repeats=1,
+                             patch_stride=stride)
+            if tuned.patch_size > 0:
+                expected = min(stride, tuned.patch_size) if isinstance(stride, int) else tuned.patch_size // 2
+                self.assertEqual(get_patch_plan((40, 40, 40), tuned.patch_size, tuned.patch_stride).stride, expected)
+        tuned = autotune(make, (1, 40, 40, 40), parse_memory('1G'), max_batch=2, patch_sizes=(16, 32), repeats=1,
+                         patch_stride=2)  # stride collapses below a quarter of the patches, so the image is used
+        self.assertEqual(tuned.patch_size, 0)
+        self.assertLessEqual(plan.peak_memory, parse_memory('1G'))
+        with self.assertRaises(SynthNNError):
+            autotune(make, (1, 40, 40, 40), parse_memory('1K'), patch_sizes=(16,), repeats=1)
+        cache = PlanCache(os.path.join(self.out_dir, 'plans.json'))
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', plan)
+        self.assertEqual(cache.get('key'), plan)
+        model = Unet(2, channel_base_power=1, is_3d=False, enable_dropout=False).eval()
+        plan = autotune(lambda **kwargs: Predictor(model, **kwargs), self.img.shape, parse_memory(1024), repeats=1)
+        self.assertEqual(plan.patch_size, 0)
+        self.assertLessEqual(plan.batch_size, self.img.shape[1])
+
+    def test_predict_channels(self):
+        model = Unet(2, channel_base_power=2, n_input=2, is_3d=False, enable_dropout=False).eval()
+        img = np.random.randn(2, 12, 10, 8).astype(np.float32)
+        fn = os.path.join(self.out_dir, 'img.npy')
+        np.save(fn, np.asfortranarray(img[1]))  # fortran order, as in nifti files
+        channels = [img[0], np.load(fn, mmap_mode='r')]
+        for axis in (0, 2):
+            expected = Predictor(model, batch_size=5, sample_axis=axis).predict(img)
+            self.assertTrue(np.allclose(Predictor(model, batch_size=5, sample_axis=axis).predict(channels), expected))
+        with self.assertRaises(SynthNNError):
+            Predictor(model).predict([img[0], img[1, :5]])
+
+    def test_predict_3d_patches(self):
+        model = SimpleConvNet(2, kernel_size=1, is_3d=True).eval()
+        for layer in model.layers: layer[3] = torch.nn.Identity()  # pointwise, so patches match the whole image
+        whole = Predictor(model).predict(torch.from_numpy(self.img[0]))
+        patches = Predictor(model, patch_size=6, patch_weight='gaussian', batch_size=4).predict(self.img)
+        self.assertEqual(whole.shape, self.img.shape)
+        self.assertTrue(np.allclose(whole, patches, atol=1e-5))
+
+    def test_predict_mask(self):
+        mask = np.zeros(self.img.shape[1:], dtype=bool)
+        mask[3:5, 2:4, 1:3] = True
+        model = Unet(2, channel_base_power=2, is_3d=False, enable_dropout=False).eval()
+        for axis in (0, 2):
+            full = Predictor(model, batch_size=3, sample_axis=axis).predict(self.img)
+            masked = Predictor(model, batch_size=3, sample_axis=axis, background=-1.).predict(self.img, mask)
+            self.assertTrue(np.array_equal(masked[:, mask], full[:, mask]))
+            self.assertTrue(np.all(masked[:, :3] == -1.) if axis == 0 else np.all(masked[..., 3:] == -1.))
+        model = SimpleConvNet(2, kernel_size=3, is_3d=True).eval()
+        full = Predictor(model, patch_size=4, batch_size=2).predict(self.img)
+        masked = Predictor(model, patch_size=4, batch_size=2).predict(self.img, mask)
+        self.assertTrue(np.array_equal(masked[:, mask], full[:, mask]))
+        self.assertTrue(np.all(masked[:, 8:] == 0.))  # the patches starting at index 8 contain no foreground
+        with self.assertRaises(SynthNNError):
+            Predictor(model).predict(self.img, mask[:5])
+
+    def test_predict_out(self):
+        for model, kwargs in ((Unet(2, channel_base_power=2, is_3d=False, enable_dropout=False), dict(batch_size=3)),
+                              (SimpleConvNet(2, kernel_size=3, is_3d=True), dict(patch_size=4, batch_size=2)),
+                              (SimpleConvNet(2, kernel_size=3, is_3d=True), {})):
+            predictor = Predictor(model.eval(), **kwargs)
+            expected = predictor.predict(self.img)
+            out = [np.zeros(self.img.shape[1:], dtype=np.float32, order='F')]
+            self.assertIs(predictor.predict(list(self.img), out=out), out)
+            self.assertTrue(np.allclose(out[0], expected[0], atol=1e-5))
+        with self.assertRaises(SynthNNError):
+            predictor.predict(self.img, out=[np.zeros((2, 2, 2), dtype=np.float32)])
+
+    def test_predict_stats(self):
+        model = Unet(2, channel_base_power=2, dropout_p=0.5, is_3d=False, enable_dropout=True)
+        predictor = Predictor(model, batch_size=4, monte_carlo=5, stats=('mean', 'std'))
+        out = predictor.predict(self.img)
+        self.assertEqual(out.shape, (2,) + self.img.shape)
+        self.assertTrue(np.all(out[1] >= 0) and np.any(out[1] > 0))
+
+    def test_from_checkpoint(self):
+        model = SimpleConvNet(2, kernel_size=3, is_3d=True).eval()
+        fn = os.path.join(self.out_dir, 'model.pth')
+        torch.save(model, fn)
+        out = Predictor.from_checkpoint(fn).predict(self.img)
+        self.assertTrue(np.allclose(out, Predictor(model).predict(self.img)))
+        torch.save(model.state_dict(), fn)
+        with self.assertRaises(SynthNNError):
+            Predictor.from_checkpoint(fn)
+
+    def test_wrong_channels(self):
+        model = SimpleConvNet(2, kernel_size=3, n_input=2, is_3d=True).eval()
+        with self.assertRaises(SynthNNError):
+            Predictor(model).predict(self.img)
+
+    def test_export_torchscript(self):
+        model = Unet(2, channel_base_power=2, is_3d=True, enable_dropout=False).eval()
+        expected = Predictor(model, patch_size=8, batch_size=4).predict(self.img)
+        for method in ('trace', 'script'):
+            fn = os.path.join(self.out_dir, f'model_{method}.ts')
+            if method == 'script':
+                model = SimpleConvNet(2, kernel_size=3, is_3d=True).eval()
+                expected = Predictor(model, patch_size=8, batch_size=4).predict(self.img)
+            export_torchscript(model, torch.randn(1, 1, 8, 8, 8), fn, method)
+            exported = TorchScriptModel(fn, 1, 1, True)
+            out = Predictor(exported, patch_size=8, batch_size=4, device=torch.device('cpu')).predict(self.img)
+            self.assertTrue(np.allclose(out, expected, atol=1e-5))
+        # temperature_map is fixed at export, so a config which sets it differently is rejected when loading
+        config = AttrDict(exported_model=fn, n_input=1, n_output=1, net3d=True, temperature_map=False)
+        self.assertFalse(load_backend(config, torch.device('cpu'), 'torchscript').metadata['temperature_map'])
+        with self.assertRaises(SynthNNError):
+            load_backend(AttrDict(config, temperature_map=True), torch.device('cpu'), 'torchscript')
+
+    @unittest.skipIf(onnxruntime is None, 'onnx and onnxruntime are not installed')
+    def test_export_onnx(self):
+        model = Unet(2, channel_base_power=2, is_3d=False, enable_dropout=False).eval()
+        fn = os.path.join(self.out_dir, 'model.onnx')
+        export_onnx(model, torch.randn(1, 1, 16, 16), fn)
+        exported = OnnxRuntimeModel(fn, 1, 1, False)
+        out = Predictor(exported, batch_size=3, device=torch.device('cpu')).predict(self.img)
+        self.assertTrue(np.allclose(out, Predictor(model, batch_size=3).predict(self.img), atol=1e-4))
+        config = AttrDict(exported_model=fn, n_input=1, n_output=1, net3d=False, temperature_map=True)
+        with self.assertRaises(SynthNNError):
+            load_backend(config, torch.device('cpu'), 'onnxruntime')
+
+    def test_reduce_precision(self):
+        model = Unet(2, channel_base_power=3, is_3d=True, enable_dropout=False, normalization='batch').eval()
+        reference = Predictor(model, patch_size=8, batch_size=4)
+        def calibrate(m): Predictor(m, patch_size=8, batch_size=4).predict(self.img)
+        for precision, tol in (('fp32', 0), ('bf16', 0.1), ('dynamic_int8', 0), ('static_int8', 0.2)):
+            reduced = reduce_precision(model, precision, calibrate)
+            candidate = Predictor(reduced, patch_size=8, batch_size=4)
+            report = precision_report(reference.predict, candidate.predict, self.img)
+            scale = np.abs(reference.predict(self.img)).max()
+            self.assertLessEqual(report['max_abs_dev'], tol * scale)
+            self.assertLessEqual(report['mean_abs_dev'], report['max_abs_dev'])
+        with self.assertRaises(SynthNNError):
+            reduce_precision(model, 'static_int8')  # requires calibration
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
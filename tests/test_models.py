@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+tests.test_models
+
+test the neural network models for runtime errors and consistency
+
+Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
+
+Created on: Oct 16, 2026
+"""
+
+import unittest
+
+import torch
+
+from synthnn.models.memory_format import channels_last_format, to_channels_last
+from synthnn.models.nconvnet import SimpleConvNet
+from synthnn.models.optimize import optimize_for_inference
+from synthnn.models.unet import Unet
+from synthnn.models.vae import VAE
+
+
+class TestModels(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_unet_receptive_field(self):
+        for n_layers in (1, 2, 3):
+            model = Unet(n_layers, channel_base_power=1, normalization='none', activation='lrelu', is_3d=False,
+                         enable_dropout=False)
+            x = torch.randn(1, 1, 256, 256, requires_grad=True)
+            model(x)[0, 0, 128, 128].backward()
+            idxs = (x.grad[0, 0].abs() > 0).nonzero()
+            empirical = (idxs[:, 0].max() - idxs[:, 0].min() + 1).item()
+            self.assertLessEqual(abs(model.receptive_field - empirical), 2)  # pooling alignment changes rf slightly
+
+    def test_optimize_for_inference(self):
+        for kwargs in (dict(is_3d=True, normalization='batch'), dict(is_3d=False, normalization='instance'),
+                       dict(is_3d=True, normalization='none', activation='linear', no_skip=True)):
+            model = Unet(2, channel_base_power=2, enable_dropout=False, **kwargs)
+            x = torch.randn((2, 1, 16, 16, 16) if kwargs['is_3d'] else (2, 1, 32, 32))
+            with torch.no_grad():
+                model(x)  # update the batch norm running statistics
+            model.eval()
+            optimized = optimize_for_inference(model)
+            self.assertFalse(any(isinstance(m, (torch.nn.ReplicationPad3d, torch.nn.ReflectionPad2d,
+                                                torch.nn.BatchNorm3d)) for m in optimized.modules()))
+            self.assertFalse(any(isinstance(m, torch.nn.LeakyReLU) and m.negative_slope == 1 for m in optimized.modules()))
+            with torch.no_grad():
+                self.assertTrue(torch.allclose(model.predict(x), optimized.predict(x), atol=1e-5))
+        model = SimpleConvNet(2, is_3d=True).eval()
+        x = torch.randn(1, 1, 8, 8, 8)
+        optimized = optimize_for_inference(model, fold_padding=False)
+        self.assertTrue(any(isinstance(m, torch.nn.ReplicationPad3d) for m in optimized.modules()))
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(model(x), optimized(x)))
+
+    def test_channels_last(self):
+        for is_3d in (True, False):
+            fmt = channels_last_format(is_3d)
+            model = Unet(2, channel_base_power=2, is_3d=is_3d, enable_dropout=False).eval()
+            x = torch.randn((2, 1, 16, 16, 16) if is_3d else (2, 1, 32, 32))
+            with torch.no_grad():
+                expected = model(x)
+                to_channels_last(model)
+                outputs = []
+                for m in model.modules(): m.register_forward_hook(lambda m, i, o: outputs.append(o))
+                out = model(x.contiguous(memory_format=fmt))
+            self.assertTrue(torch.allclose(expected, out, atol=1e-5))
+            self.assertTrue(all(o.is_contiguous(memory_format=fmt) for o in outputs if o.shape[1] > 1))
+
+    def test_loss_float32_under_autocast(self):
+        dev = torch.device('cpu')
+        x = torch.rand(2, 1, 32, 32)
+        for model in (Unet(2, channel_base_power=2, ord_params=[0, 2, 10, dev], is_3d=False),
+                      VAE(3, [32, 32], channel_base_power=2, latent_size=16, is_3d=False)):
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                out = model(x)
+                outs = out if isinstance(out, tuple) else (out,)
+                loss = model.criterion(x, *outs)
+            self.assertTrue(all(o.dtype == torch.bfloat16 for o in outs))
+            self.assertEqual(loss.dtype, torch.float32)
+            self.assertTrue(torch.isclose(loss, model.criterion(x, *[o.float() for o in outs])))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
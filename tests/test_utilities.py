@@ -11,9 +11,30 @@ Created on: May 01, 2018
 """
 
 import os
+import shutil
+import tempfile
 import unittest
 
-from synthnn import split_filename, glob_nii
+import numpy as np
+import torch
+
+from synthnn import (split_filename, glob_nii, get_patch_overlap, get_patch_plan, predict_patches,
+                     prefetch, BackgroundExecutor, mc_predict, RunningStats, config_hash, Manifest, lazy_nii,
+                     NiftiWriter, SynthNNError, otsu_threshold, foreground_mask, foreground_bbox, foreground_patches,
+                     stream_patches, VolumeCache, CachedDataset, copy_sample, build_store, ChunkStore, StoreDataset,
+                     PatchQueue, BatchAugment, all_reduce_mean, init_distributed, launch,
+                     shared_tempdir)
+
+
+def _shared_tempdir(args):
+    """ process of test_shared_tempdir, which records the directory it was given """
+    import torch.distributed as dist
+    _, rank, _ = init_distributed()
+    path = shared_tempdir('synthnn-test-', args[0])
+    with open(os.path.join(args[0], f'{rank}.txt'), 'w') as f:
+        f.write(path)
+    dist.destroy_process_group()
+    return 0
 
 
 class TestUtilities(unittest.TestCase):
@@ -35,6 +56,361 @@ class TestUtilities(unittest.TestCase):
         self.assertEqual(fn, 'test')
         self.assertEqual(ext, '.nii.gz')
 
+    def test_patch_plan_cached(self):
+        plan = get_patch_plan((20, 24, 16), 8)
+        self.assertIs(plan, get_patch_plan((20, 24, 16), 8))
+        self.assertEqual(plan.stride, 4)
+        self.assertEqual(plan.grid, (4, 5, 3))
+        self.assertEqual(plan.corner(plan.n_patches - 1), (12, 16, 8))
+
+    def test_predict_patches(self):
+        img = np.random.randn(2, 20, 24, 16).astype(np.float32)
+        plan = get_patch_plan(img.shape[1:], 8)
+        def predict_fn(batch): return 2 * batch[:, :1].numpy()
+        out = predict_patches(predict_fn, img, plan, 3, 1)  # 60 patches, so the last batch is partial
+        self.assertEqual(out.shape, (1, 20, 24, 16))
+        self.assertTrue(np.allclose(out, 2 * img[:1], atol=1e-6))
+
+    def test_predict_patches_weighted(self):
+        img = np.random.randn(1, 20, 24, 16).astype(np.float32)
+        def predict_fn(batch): return batch.numpy()
+        for weight in ('gaussian', 'linear'):
+            plan = get_patch_plan(img.shape[1:], 8, 6, weight)
+            out = predict_patches(predict_fn, img, plan, 4, 1)
+            self.assertTrue(np.allclose(out, img, atol=1e-5))
+
+    def test_patch_plan_coverage(self):
+        img = np.random.randn(1, 21, 30, 5).astype(np.float32)  # last axis is smaller than the patch
+        plan = get_patch_plan(img.shape[1:], 8, 6)
+        self.assertEqual(plan.grid, (4, 5, 1))
+        self.assertEqual(plan.pad, (0, 0, 3))
+        self.assertEqual(plan.coverage, 1.)
+        self.assertAlmostEqual(plan.redundancy, 20 * 8 ** 3 / (21 * 30 * 5))
+        def predict_fn(batch): return batch.numpy()
+        out = predict_patches(predict_fn, img, plan, 3, 1)
+        self.assertTrue(np.allclose(out, img, atol=1e-6))
+
+    def test_stream_patches(self):
+        def predict_fn(batch):  # not pointwise, so the patches differ where they overlap
+            x = batch[:, :1].numpy()
+            return x + np.cumsum(x, axis=2) / 10
+        for shape, psz, stride, weight in (((20, 24, 16), 8, 3, 'gaussian'), ((21, 5, 30), 8, 6, 'uniform')):
+            img = np.random.randn(2, *shape).astype(np.float32)
+            plan = get_patch_plan(shape, psz, stride, weight)
+            keep = np.random.rand(plan.n_patches) > 0.3
+            for k in (None, keep):
+                expected = predict_patches(predict_fn, img, plan, 3, 1, keep=k, fill=-1.)
+                out = [np.zeros(shape, dtype=np.float32, order='F')]
+                stream_patches(predict_fn, list(img), plan, 3, out, keep=k, fill=-1.)
+                self.assertTrue(np.allclose(out[0], expected[0], atol=1e-5))
+
+    def test_patch_overlap(self):
+        self.assertEqual(get_patch_overlap(7, 64), 6)
+        self.assertEqual(get_patch_overlap(46, 64), 45)
+        with self.assertRaises(SynthNNError):  # a stride of one (or less) would be millions of patches
+            get_patch_overlap(106, 64)
+        with self.assertRaises(SynthNNError):
+            get_patch_overlap(46, 16)
+        # outputs away from the volume border match the whole-volume output with the derived stride
+        torch.manual_seed(0)
+        net = torch.nn.Sequential(*[torch.nn.Conv3d(1, 1, 3, padding=1) for _ in range(3)])  # rf = 7
+        x = torch.randn(1, 1, 40, 40, 40)
+        with torch.no_grad():
+            expected = net(x)[0].numpy()
+            predict_fn = lambda p: net(p).numpy()
+            plan = get_patch_plan(x.shape[2:], 16, 16 - get_patch_overlap(7, 16), 'gaussian')
+            out = predict_patches(predict_fn, x[0].numpy(), plan, 1, 1)[0]
+        self.assertTrue(np.allclose(out[3:-3, 3:-3, 3:-3], expected[0, 3:-3, 3:-3, 3:-3], atol=5e-2))
+
+    def test_prefetch(self):
+        for depth in (0, 1, 3):
+            self.assertEqual(list(prefetch(lambda x: x ** 2, range(10), depth)), [x ** 2 for x in range(10)])
+        def fail(x):
+            if x == 2: raise ValueError
+            return x
+        with self.assertRaises(ValueError):
+            list(prefetch(fail, range(5), 2))
+        self.assertEqual(next(prefetch(lambda x: x, range(100), 2)), 0)  # stopping early does not hang
+
+    def test_background_executor(self):
+        results = []
+        with BackgroundExecutor(2) as executor:
+            for i in range(5):
+                executor.submit(results.append, i)
+        self.assertEqual(results, list(range(5)))
+        def fail(): raise ValueError
+        with self.assertRaises(ValueError):
+            with BackgroundExecutor(1) as executor:
+                executor.submit(fail)
+
+    def test_running_stats(self):
+        samples = np.random.randn(10, 3, 4).astype(np.float64)
+        rs = RunningStats(['mean', 'var', 'std', 'q50'])
+        for i in range(0, 10, 3):
+            rs.update(samples[i:i+3])
+        mean, var, std, median = rs.result()
+        self.assertTrue(np.allclose(mean, samples.mean(axis=0)))
+        self.assertTrue(np.allclose(var, samples.var(axis=0)))
+        self.assertTrue(np.allclose(std, samples.std(axis=0)))
+        self.assertTrue(np.allclose(median, np.median(samples, axis=0)))
+
+    def test_mc_predict(self):
+        x = torch.randn(2, 1, 4, 4)
+        calls = []
+        def predict_fn(batch):
+            calls.append(batch.shape[0])
+            return (batch + torch.randn_like(batch)).numpy()
+        rs = mc_predict(predict_fn, x, 5, max_batch=4, stats=['mean', 'var'])
+        self.assertEqual(calls, [4, 4, 2])  # two samples folded into each forward pass
+        self.assertEqual(rs.n, 5)
+        self.assertEqual(rs.mean.shape, (2, 1, 4, 4))
+
+    def test_manifest(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            in_fn, out_fn = os.path.join(out_dir, 'in.nii.gz'), os.path.join(out_dir, 'out.nii.gz')
+            shutil.copy(self.img_fn, in_fn)
+            shutil.copy(self.img_fn, out_fn)
+            cfg = config_hash({'a': 1, 'verbosity': 0}, exclude=('verbosity',))
+            self.assertEqual(cfg, config_hash({'a': 1, 'verbosity': 2}, exclude=('verbosity',)))
+            manifest = Manifest(os.path.join(out_dir, 'manifest.jsonl'), cfg)
+            self.assertFalse(manifest.is_complete([in_fn], [out_fn]))
+            manifest.record([in_fn], [out_fn])
+            self.assertTrue(Manifest(manifest.fn, cfg).is_complete([in_fn], [out_fn]))
+            self.assertFalse(Manifest(manifest.fn, config_hash({'a': 2})).is_complete([in_fn], [out_fn]))
+            with open(manifest.fn, 'a') as f: f.write('{"inputs": [')  # line cut off by a crash
+            in2_fn, out2_fn = os.path.join(out_dir, 'in2.nii.gz'), os.path.join(out_dir, 'out2.nii.gz')
+            shutil.copy(self.img_fn, in2_fn)
+            shutil.copy(self.img_fn, out2_fn)
+            Manifest(manifest.fn, cfg).record([in2_fn], [out2_fn])  # resumed run records after the cut-off line
+            resumed = Manifest(manifest.fn, cfg)
+            self.assertTrue(resumed.is_complete([in_fn], [out_fn]) and resumed.is_complete([in2_fn], [out2_fn]))
+            with open(in_fn, 'ab') as f: f.write(b'0')
+            self.assertFalse(Manifest(manifest.fn, cfg).is_complete([in_fn], [out_fn]))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_lazy_nii(self):
+        import nibabel as nib
+        out_dir = tempfile.mkdtemp()
+        try:
+            img = nib.load(self.img_fn)
+            data = img.get_fdata(dtype=np.float32)
+            fn = os.path.join(out_dir, 'img.nii')
+            nib.Nifti1Image(data, img.affine).to_filename(fn)
+            self.assertIsNone(lazy_nii(self.img_fn))  # compressed files cannot be memory-mapped
+            lazy = lazy_nii(fn)
+            self.assertIsInstance(lazy, np.memmap)
+            self.assertTrue(np.array_equal(lazy[:, :, 2:5], data[:, :, 2:5]))
+            scaled = nib.Nifti1Image(data, img.affine)
+            scaled.header.set_slope_inter(2., 1.)
+            scaled.to_filename(fn)
+            lazy = lazy_nii(fn)
+            self.assertTrue(nib.is_proxy(lazy))
+            self.assertTrue(np.allclose(lazy[:, :, 2:5], 2 * data[:, :, 2:5] + 1))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_foreground(self):
+        img = np.zeros((2, 10, 12, 14), dtype=np.float32)
+        img[0, 2:5, 3:6, 4:7] = 10.
+        img[1, 6:8, 3:6, 4:7] = 5.
+        self.assertTrue(0. < otsu_threshold(img[0]) < 10.)
+        mask = foreground_mask(img, 'otsu')
+        self.assertEqual(mask.sum(), 27 + 18)
+        self.assertTrue(np.array_equal(foreground_mask(list(img), 1.), mask))
+        self.assertEqual(foreground_bbox(mask), (slice(2, 8), slice(3, 6), slice(4, 7)))
+        self.assertIsNone(foreground_bbox(np.zeros_like(mask)))
+        plan = get_patch_plan(mask.shape, 4, 2)
+        keep = foreground_patches(plan, mask)
+        for i in range(plan.n_patches):
+            x, y, z = plan.corner(i)
+            self.assertEqual(keep[i], mask[x:x+4, y:y+4, z:z+4].any())
+        with self.assertRaises(SynthNNError):
+            foreground_mask(img, 'mean')
+
+    def test_nifti_writer(self):
+        import gzip
+        import nibabel as nib
+        out_dir = tempfile.mkdtemp()
+        try:
+            img = nib.load(self.img_fn)
+            data = img.get_fdata(dtype=np.float32)
+            imgs = [nib.Nifti1Image(data + i, img.affine) for i in range(2)]
+            for compression, level, n_threads in (('none', None, 1), ('gzip', 1, 2), ('bgzip', None, 2), ('bgzip', 9, 1)):
+                fns = [os.path.join(out_dir, f'{compression}_{i}.nii' + ('' if compression == 'none' else '.gz'))
+                       for i in range(2)]
+                done = []
+                with NiftiWriter(compression, level, n_threads) as writer:
+                    writer.submit(imgs, fns, lambda: done.append(True))
+                self.assertEqual(done, [True])
+                for i, fn in enumerate(fns):
+                    self.assertTrue(np.array_equal(nib.load(fn).get_fdata(dtype=np.float32), data + i))
+                if compression == 'bgzip':  # readable by standard gzip readers (as multiple members)
+                    with gzip.open(fns[0]) as f:
+                        self.assertEqual(len(f.read()), os.path.getsize(os.path.join(out_dir, 'none_0.nii')))
+            self.assertFalse(any(f.startswith('.') for f in os.listdir(out_dir)))  # no temporary files are left
+            with self.assertRaises(SynthNNError):
+                NiftiWriter('zstd')
+            with self.assertRaises(OSError):
+                with NiftiWriter() as writer:
+                    writer.submit(imgs[:1], [os.path.join(out_dir, 'missing', 'img.nii.gz')])
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_volume_cache(self):
+        import nibabel as nib
+        out_dir = tempfile.mkdtemp()
+        try:
+            data = nib.load(self.img_fn).get_fdata(dtype=np.float32)
+            for i in range(3): shutil.copy(self.img_fn, os.path.join(out_dir, f'img{i}.nii.gz'))
+            fns = sorted(os.path.join(out_dir, f) for f in os.listdir(out_dir))
+            with VolumeCache('memory', max_memory=2 * data.nbytes) as cache:
+                x = cache.get(fns[:1])
+                self.assertIs(cache.get(fns[:1]), x)
+                self.assertTrue(np.array_equal(x, data[np.newaxis]))
+                cache.get(fns[1:2])
+                cache.get(fns[2:3])  # evicts the least recently used volume
+                self.assertEqual(len(cache.arrays), 2)
+                self.assertIsNot(cache.get(fns[:1]), x)
+            cache_dir = os.path.join(out_dir, 'cache')
+            with self.assertRaises(SynthNNError):  # the intensities of the test image overflow float16
+                VolumeCache('memory', 'float16').get(fns[:1])
+            scale = float(np.abs(data).max())
+            with VolumeCache('shared', 'float16', max_memory=3 * (data.nbytes // 2) + 1024, cache_dir=cache_dir,
+                             loader=lambda fn: nib.load(fn).get_fdata(dtype=np.float32) / scale) as cache:
+                x = cache.get(fns[:2])
+                self.assertEqual((x.shape, x.dtype), ((2,) + data.shape, np.float16))
+                self.assertFalse(x.flags.writeable)
+                self.assertTrue(np.allclose(x[1], data / scale, atol=1e-3))
+                cache.clear()  # e.g., another worker, which memory-maps the file written by the first
+                self.assertTrue(np.array_equal(cache.get(fns[:2]), x))
+                cache.get(fns[2:3])  # the shared cache holds at most 3 volumes (in float16)
+                cache.get(fns[1:3])
+                self.assertEqual(len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]), 2)
+            self.assertTrue(os.path.isdir(cache_dir))  # a given cache directory is kept
+            with VolumeCache('shared', cache_dir=cache_dir, owner=True):  # e.g., shared by distributed training
+                pass
+            self.assertFalse(os.path.exists(cache_dir))
+            with VolumeCache('shared') as cache:
+                cache.get(fns[:1])
+                self.assertTrue(os.path.isdir(cache.cache_dir))
+            self.assertFalse(os.path.exists(cache.cache_dir))
+            dataset = CachedDataset([out_dir, out_dir], [out_dir], VolumeCache('memory'),
+                                    lambda s: copy_sample((s[0][:, :4], s[1][:, :4])))
+            src, tgt = dataset[1]
+            self.assertEqual((len(dataset), src.shape, tgt.shape), (3, (2, 4) + data.shape[1:], (1, 4) + data.shape[1:]))
+            self.assertTrue(src.flags.writeable)
+            with self.assertRaises(SynthNNError):
+                VolumeCache('disk')
+            with self.assertRaises(SynthNNError):
+                CachedDataset([out_dir], [self.mask_dir], VolumeCache('memory'))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_store(self):
+        import nibabel as nib
+        out_dir = tempfile.mkdtemp()
+        try:
+            data = nib.load(self.img_fn).get_fdata(dtype=np.float32)
+            for d in ('src', 'tgt'): os.mkdir(os.path.join(out_dir, d))
+            for i in range(2):
+                shutil.copy(self.img_fn, os.path.join(out_dir, 'src', f'img{i}.nii.gz'))
+                shutil.copy(self.mask_fn, os.path.join(out_dir, 'tgt', f'img{i}.nii.gz'))
+            mask = nib.load(self.mask_fn).get_fdata(dtype=np.float32)
+            store_dir = os.path.join(out_dir, 'store')
+            dirs = ([os.path.join(out_dir, 'src')], [os.path.join(out_dir, 'tgt')])
+            self.assertEqual(build_store(store_dir, *dirs, chunk_size=8), (2, 0))
+            self.assertEqual(build_store(store_dir, *dirs, chunk_size=8), (0, 2))  # unchanged subjects are skipped
+            shutil.copy(self.img_fn, os.path.join(out_dir, 'src', 'img2.nii.gz'))
+            shutil.copy(self.mask_fn, os.path.join(out_dir, 'tgt', 'img2.nii.gz'))
+            self.assertEqual(build_store(store_dir, *dirs, chunk_size=8), (1, 2))
+            store = ChunkStore(store_dir)
+            self.assertEqual((len(store), store.shape(2)), (3, data.shape))
+            self.assertAlmostEqual(store.stats(0)[0]['mean'], data.mean(dtype=np.float64), places=3)
+            expected = np.stack((data, mask))
+            self.assertTrue(np.array_equal(store.read(1), expected))
+            region = [(1, 10), (3, 4), (5, data.shape[2])]  # crosses chunk boundaries and reaches the padded edge
+            self.assertTrue(np.array_equal(store.read(1, region), expected[:, 1:10, 3:4, 5:]))
+            src, tgt = StoreDataset(store, 8, True)[0]
+            self.assertEqual((src.shape, tgt.shape), ((1, 8, 8, 8), (1, 8, 8, 8)))
+            src, tgt = StoreDataset(store, 0, False, sample_axis=1)[0]
+            self.assertEqual(src.shape, (1, data.shape[0], data.shape[2]))
+            with self.assertRaises(SynthNNError):
+                build_store(store_dir, *dirs, chunk_size=16)  # does not match the store
+            with self.assertRaises(SynthNNError):
+                ChunkStore(out_dir)
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_patch_queue(self):
+        from collections import Counter
+        from torch.utils.data import DataLoader
+        loads = Counter()
+        class Volumes(torch.utils.data.Dataset):
+            def __len__(self): return 6
+            def __getitem__(self, idx):
+                loads[idx] += 1
+                return np.full(4, idx, dtype=np.float32)
+        crop = lambda x: x[np.random.randint(4)]  # a "patch" is the item index
+        queue = PatchQueue(Volumes(), 3, 5, indices=[0, 2, 3, 5], transform=crop)
+        samples = [int(x) for x in queue]
+        self.assertEqual((len(queue), Counter(samples)), (12, Counter({0: 3, 2: 3, 3: 3, 5: 3})))
+        self.assertEqual(loads, Counter({0: 1, 2: 1, 3: 1, 5: 1}))  # each volume is loaded once per epoch
+        ordered = PatchQueue(Volumes(), 2, shuffle=False, transform=crop)
+        self.assertEqual([int(x) for x in ordered], [i for i in range(6) for _ in range(2)])
+        loader = DataLoader(PatchQueue(Volumes(), 2, transform=crop), batch_size=4, num_workers=2)
+        for _ in range(2):  # the workers visit disjoint volumes
+            self.assertEqual(Counter(torch.cat(list(loader)).tolist()), Counter({i: 2 for i in range(6)}))
+        # the processes of distributed training split (padded) shared permutations of the volumes each epoch
+        for epoch in range(2):
+            parts = []
+            for rank in range(4):
+                replica = PatchQueue(Volumes(), 2, indices=[0, 2, 3, 5, 1], transform=crop, num_replicas=4,
+                                     rank=rank, seed=1)
+                replica.set_epoch(epoch)
+                parts.append([int(x) for x in replica])
+                self.assertEqual(len(parts[-1]), len(replica))
+            self.assertTrue(all(len(p) == 4 for p in parts))
+            self.assertEqual(set(x for p in parts for x in p), {0, 1, 2, 3, 5})
+        parts = [[int(x) for x in PatchQueue(Volumes(), 1, indices=[0, 2, 3, 5, 1], shuffle=False, transform=crop,
+                                             num_replicas=4, rank=rank)] for rank in range(4)]
+        self.assertEqual(sorted(x for p in parts for x in p), [0, 1, 2, 3, 5])  # no padding without shuffling
+        self.assertEqual(all_reduce_mean([1., 2., 6.], torch.device('cpu')), 3.)  # without a process group
+
+    def test_shared_tempdir(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            path = shared_tempdir('synthnn-test-', out_dir)  # without a process group
+            self.assertTrue(os.path.isdir(path))
+            self.assertEqual(launch(_shared_tempdir, [out_dir], 2), 0)
+            paths = []
+            for rank in range(2):
+                with open(os.path.join(out_dir, f'{rank}.txt')) as f:
+                    paths.append(f.read())
+            self.assertEqual(paths[0], paths[1])  # all processes use the directory named by the first
+            self.assertTrue(os.path.isdir(paths[0]) and paths[0] != path)
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_batch_augment(self):
+        torch.manual_seed(0)
+        for shape in ((4, 2, 16, 12), (3, 1, 8, 12, 10)):
+            x = torch.randn(shape)
+            src, tgt = BatchAugment([0, 0, 0, 0], rotate=10, hflip=True, gamma=.5, noise_std=1.)(x, x[:, :1])
+            self.assertTrue(torch.equal(src, x) and torch.equal(tgt, x[:, :1]))
+            src, tgt = BatchAugment([0, 1, 0, 0], hflip=True, vflip=True)(x, x[:, :1])
+            self.assertTrue(torch.equal(src, x.flip(-1).flip(-2)) and torch.equal(tgt, src[:, :1]))
+            aug = BatchAugment([1, .5, 1, 1], rotate=30, translate=.1, scale=.2, hflip=True, gamma=.2, gain=.1,
+                               noise_std=.1, tfm_x=False, tfm_y=False)
+            src, tgt = aug(x, x[:, :1].clone())
+            self.assertEqual(src.shape, x.shape)
+            self.assertFalse(torch.allclose(src, x))
+            self.assertTrue(torch.equal(src[:, :1], tgt))  # the same geometry for the source and target
+            src, tgt = BatchAugment([0, 0, 1, 1], gamma=.2, gain=.1, noise_std=.1, tfm_y=False)(x.abs(), x[:, :1])
+            self.assertTrue(torch.isfinite(src).all() and torch.equal(tgt, x[:, :1]))
+            self.assertFalse(torch.allclose(src, x.abs()))
+
     def tearDown(self):
         pass
 